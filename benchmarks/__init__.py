@@ -0,0 +1,2 @@
+from gaeworkers import standins
+standins.install()  # benchmarks run without App Engine SDK
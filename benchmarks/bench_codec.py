@@ -0,0 +1,76 @@
+'''
+Benchmark comparing state codecs with the old repr()/eval() way
+of saving worker's state.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_codec
+
+Created on 2011-11-25
+
+@author: xion
+'''
+from gaeworkers import codec
+import cPickle
+import timeit
+
+
+def legacy_save(state):
+    ''' Saves the state the way gae-workers used to: as (type_name, repr) pairs. '''
+    return dict((attr, (type(value).__name__, repr(value)))
+                for attr, value in state.iteritems())
+
+def legacy_restore(saved_state):
+    ''' Reverses legacy_save(). '''
+    return dict((attr, eval(value_repr))
+                for attr, (_, value_repr) in saved_state.iteritems())
+
+
+STATE_SHAPES = {
+    'int_list_50k': lambda: {'items': range(50000), 'cursor': 12345},
+    'str_list_50k': lambda: {'items': ["item-%d" % i for i in xrange(50000)], 'cursor': 12345},
+    'nested_dicts': lambda: {'index': dict(("key-%d" % i, {'count': i, 'tags': ['a', 'b'], 'ratio': i / 7.0})
+                                           for i in xrange(5000)),
+                             'cursor': "abcdef"},
+    'mixed_small': lambda: {'counter': 42, 'name': u"worker", 'flags': set([1, 2, 3]),
+                            'pairs': [(i, str(i)) for i in xrange(100)]},
+    'scalars_40': lambda: dict([("count_%d" % i, i * 1000) for i in xrange(20)]
+                               + [("label_%d" % i, "label-%d" % i) for i in xrange(10)]
+                               + [("ratio_%d" % i, i / 3.0) for i in xrange(10)]),
+}
+
+
+def bench(func, number):
+    ''' Returns the best time (in milliseconds) of calling func. '''
+    return min(timeit.repeat(func, number = number, repeat = 3)) / number * 1000.0
+
+def payload_size(saved_state):
+    ''' Size of the saved state, as memcache would store it. '''
+    if isinstance(saved_state, str):    return len(saved_state)
+    return len(cPickle.dumps(saved_state, cPickle.HIGHEST_PROTOCOL))
+
+
+def main(number = 5):
+    row_format = "%-14s %-8s %12s %12s %12s"
+    print row_format % ('shape', 'codec', 'save [ms]', 'restore [ms]', 'size [B]')
+
+    for shape_name, make_state in sorted(STATE_SHAPES.iteritems()):
+        state = make_state()
+
+        saved = legacy_save(state)
+        print row_format % (shape_name, 'repr',
+                            "%.3f" % bench(lambda: legacy_save(state), number),
+                            "%.3f" % bench(lambda: legacy_restore(saved), number),
+                            payload_size(saved))
+
+        for codec_name in ('marshal', 'pickle'):
+            payload = codec.encode(state, codec_name)
+            assert codec.decode(payload) == state
+            print row_format % (shape_name, codec_name,
+                                "%.3f" % bench(lambda: codec.encode(state, codec_name), number),
+                                "%.3f" % bench(lambda: codec.decode(payload), number),
+                                payload_size(payload))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+'''
+Benchmark suite measuring the costs that gae-workers adds to workers:
+serialization of state values, checkpoints, runner's overhead per spin,
+handoffs between tasks of a simulated job, and tasks of a forked job.
+
+Everything runs in-process against stand-in backends (see gaeworkers.simulation),
+so App Engine SDK is not needed. Run from the repository root:
+
+    python -m benchmarks.suite [--quick] [--json results.json] [--compare baseline.json]
+
+Results are printed as a table; with --json, they are also written
+as JSON document which a later run can be --compare'd against.
+
+Created on 2011-12-05
+
+@author: xion
+'''
+from benchmarks import workers
+from benchmarks.bench_codec import STATE_SHAPES
+from gaeworkers import Worker, codec, data, state, storage
+from gaeworkers.simulation import Simulation
+import itertools
+import json
+import logging
+import optparse
+import platform
+import sys
+import time
+import timeit
+
+
+class MeteredStorage(storage.Storage):
+    ''' Storage counting the values and bytes written to it. '''
+    def __init__(self, storage):
+        self.storage = storage
+        self.reset()
+
+    def reset(self):
+        self.values_written = 0
+        self.bytes_written = 0
+
+    def get_multi(self, keys):
+        return self.storage.get_multi(keys)
+
+    def set_multi(self, mapping, lifetime = 0, durable = False):
+        self.values_written += len(mapping)
+        self.bytes_written += sum(len(key) + len(value) for key, value in mapping.iteritems())
+        return self.storage.set_multi(mapping, lifetime, durable)
+
+    def delete_multi(self, keys, durable = False):
+        self.storage.delete_multi(keys, durable)
+
+
+class BenchWorker(Worker):
+    ''' Worker whose state is set by the checkpoint benchmarks. '''
+    pass
+
+
+def ops_per_sec(func, number):
+    ''' Returns the best rate of calling func. '''
+    return number / min(timeit.repeat(func, number = number, repeat = 3))
+
+
+###############################################################################
+# Benchmarks
+
+def bench_serialization(results, number):
+    ''' Measures data.save_value()/restore_value() and codec on realistic state shapes. '''
+    for shape_name, make_state in sorted(STATE_SHAPES.iteritems()):
+        values = make_state()
+        saved = dict((attr, data.save_value(value)) for attr, value in values.iteritems())
+        payload = codec.encode(values)
+
+        prefix = "serialization/%s/" % shape_name
+        results[prefix + 'save_value_ops_per_sec'] = \
+            ops_per_sec(lambda: [data.save_value(value) for value in values.itervalues()], number)
+        results[prefix + 'restore_value_ops_per_sec'] = \
+            ops_per_sec(lambda: [data.restore_value(value) for value in saved.itervalues()], number)
+        results[prefix + 'encode_ops_per_sec'] = ops_per_sec(lambda: codec.encode(values), number)
+        results[prefix + 'decode_ops_per_sec'] = ops_per_sec(lambda: codec.decode(payload), number)
+        results[prefix + 'payload_bytes'] = len(payload)
+
+
+def bench_checkpoints(results, number):
+    '''
+    Measures checkpoints of worker's state: bytes written by the first (full)
+    checkpoint, by the next one after a single small attribute has changed,
+    and the rate of both kinds. Workers whose class declares state schema
+    (see Worker.state_fields) are measured separately.
+    '''
+    metered = MeteredStorage(storage.DictStorage())
+    storage.set_storage(metered)
+    try:
+        for (shape_name, make_state), declared in itertools.product(sorted(STATE_SHAPES.iteritems()), (False, True)):
+            values = make_state()
+            worker_class = BenchWorker
+            if declared:
+                state_fields = [(attr, type(value)) for attr, value in sorted(values.iteritems())]
+                worker_class = type('SchemaBenchWorker', (BenchWorker,),
+                                    {'state_fields': state_fields + [('progress', int)]})
+            def full_checkpoint():
+                worker = worker_class(None, 'bench-worker')
+                for attr, value in values.iteritems():
+                    setattr(worker, attr, value)
+                state.save_state(worker)
+                return worker
+
+            metered.reset()
+            worker = full_checkpoint()
+            prefix = "%s/%s/" % ('checkpoint_schema' if declared else 'checkpoint', shape_name)
+            results[prefix + 'full_bytes'] = metered.bytes_written
+            results[prefix + 'full_ops_per_sec'] = ops_per_sec(full_checkpoint, number)
+
+            def incremental_checkpoint():
+                worker.progress = getattr(worker, 'progress', 0) + 1
+                state.save_state(worker)
+
+            incremental_checkpoint()
+            metered.reset()
+            incremental_checkpoint()
+            results[prefix + 'incremental_bytes'] = metered.bytes_written
+            results[prefix + 'incremental_ops_per_sec'] = ops_per_sec(incremental_checkpoint, number)
+
+            restored = worker_class(None, 'bench-worker')
+            results[prefix + 'restore_ops_per_sec'] = ops_per_sec(lambda: state.restore_state(restored), number)
+    finally:
+        storage.set_storage(None)
+
+
+def bench_runner(results, quick):
+    '''
+    Measures spins per second of trivial and heavy run() generators,
+    executed by the runner in a single simulated task.
+    '''
+    for name, worker_class in (('trivial', workers.TrivialWorker), ('heavy', workers.HeavyWorker)):
+        spins = worker_class.spins / (10 if quick else 1)
+        bare_worker = worker_class()
+        bare_worker.setup()
+        bare_worker.spins = spins
+        start = time.time()
+        for _ in bare_worker.run():
+            pass
+        bare_time = time.time() - start
+
+        with Simulation() as sim:
+            with _class_attribute(worker_class, 'spins', spins):
+                worker_class().start()
+                start = time.time()
+                sim.run()
+                runner_time = time.time() - start
+
+        prefix = "runner/%s/" % name
+        results[prefix + 'spins_per_sec'] = spins / runner_time
+        results[prefix + 'bare_spins_per_sec'] = spins / bare_time
+        results[prefix + 'overhead_us_per_spin'] = (runner_time - bare_time) / spins * 1e6
+
+
+def bench_handoffs(results, quick):
+    '''
+    Simulates a job of many items taking some (virtual) time each,
+    counting the tasks needed to finish it. Job is executed in clean
+    environment and in one where memcache evicts items and tasks are retried.
+    '''
+    # quick job has fewer, but longer items, so that it takes the same (virtual) time
+    scale = 10 if quick else 1
+    items_count = workers.ScanWorker.items_count / scale
+    item_time = workers.ScanWorker.item_time * scale
+    environments = (('clean', dict()),
+                    ('faulty', dict(eviction_rate = 0.2, retry_rate = 0.25)))
+    for env_name, env_params in environments:
+        with Simulation(tick = 0.0001, **env_params) as sim:
+            with _class_attribute(workers.ScanWorker, 'items_count', items_count), \
+                 _class_attribute(workers.ScanWorker, 'item_time', item_time):
+                workers.clock = sim.clock
+                workers.ScanWorker().start()
+                start = time.time()
+                sim.run()
+                wall_time = time.time() - start
+
+        prefix = "handoffs/%s/" % env_name
+        results[prefix + 'tasks'] = sim.stats['tasks']
+        results[prefix + 'handoffs'] = sim.stats['tasks'] - 1 - sim.stats['retries']     # redeliveries aren't handoffs
+        results[prefix + 'retries'] = sim.stats['retries']
+        results[prefix + 'evictions'] = sim.stats['evictions']
+        results[prefix + 'virtual_secs'] = sim.elapsed
+        results[prefix + 'items_per_virtual_sec'] = items_count / sim.elapsed
+        results[prefix + 'wall_secs'] = wall_time
+
+
+def bench_forks(results, quick):
+    '''
+    Simulates a job split between children of forked worker, counting the tasks
+    it takes, in clean environment and in one where memcache evicts items
+    and tasks are retried. Fork which doesn't complete is reported as an error.
+    '''
+    shards_count = workers.ForkWorker.shards_count / (2 if quick else 1)
+    items_count = shards_count * workers.ForkWorker.shard_size
+    environments = (('clean', dict()),
+                    ('faulty', dict(eviction_rate = 0.2, retry_rate = 0.25)))
+    for env_name, env_params in environments:
+        del workers.fork_results[:]
+        with Simulation(tick = 0.0001, **env_params) as sim:
+            with _class_attribute(workers.ForkWorker, 'shards_count', shards_count):
+                workers.clock = sim.clock
+                workers.ForkWorker().start()
+                sim.run()
+        if workers.fork_results != [sum(xrange(items_count))]:
+            raise RuntimeError("Fork has not completed in %s environment: %s" % (env_name, workers.fork_results))
+
+        prefix = "forks/%s/" % env_name
+        results[prefix + 'tasks'] = sim.stats['tasks']
+        results[prefix + 'retries'] = sim.stats['retries']
+        results[prefix + 'evictions'] = sim.stats['evictions']
+        results[prefix + 'virtual_secs'] = sim.elapsed
+
+
+class _class_attribute(object):
+    '''
+    Context manager setting class attribute temporarily. Workers' parameters
+    are set this way, since runner creates worker objects by itself.
+    '''
+    def __init__(self, class_, attr, value):
+        self.class_, self.attr, self.value = class_, attr, value
+
+    def __enter__(self):
+        self.saved_value = getattr(self.class_, self.attr)
+        setattr(self.class_, self.attr, self.value)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        setattr(self.class_, self.attr, self.saved_value)
+
+
+###############################################################################
+# Reporting
+
+def compare(results, baseline):
+    ''' Prints the changes of results relative to the baseline. '''
+    row_format = "%-58s %16s %16s %9s"
+    print row_format % ('metric', 'baseline', 'current', 'change')
+    for metric in sorted(set(results) | set(baseline)):
+        value, baseline_value = results.get(metric), baseline.get(metric)
+        change = "%+.1f%%" % ((value - baseline_value) * 100.0 / baseline_value) \
+                 if value is not None and baseline_value else ""
+        print row_format % (metric, _format(baseline_value), _format(value), change)
+
+def _format(value):
+    if value is None:               return "-"
+    if isinstance(value, float):    return "%.3f" % value
+    return str(value)
+
+
+def main(argv = None):
+    parser = optparse.OptionParser(usage = "python -m benchmarks.suite [options]")
+    parser.add_option('--quick', action = 'store_true', help = "run smaller benchmarks")
+    parser.add_option('--json', metavar = 'FILE', help = "write results to FILE as JSON")
+    parser.add_option('--compare', metavar = 'FILE', help = "compare results with those in FILE")
+    options, _ = parser.parse_args(argv)
+    number = 2 if options.quick else 10
+
+    results = {}
+    bench_serialization(results, number)
+    bench_checkpoints(results, number)
+    bench_runner(results, options.quick)
+    bench_handoffs(results, options.quick)
+    bench_forks(results, options.quick)
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f)['results'])
+    else:
+        for metric in sorted(results):
+            print "%-58s %16s" % (metric, _format(results[metric]))
+
+    if options.json:
+        document = {'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    'quick': bool(options.quick),
+                    'results': results}
+        with open(options.json, 'w') as f:
+            json.dump(document, f, indent = 2, sort_keys = True)
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.ERROR)
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+'''
+Workers used by the benchmark suite.
+
+Created on 2011-12-05
+
+@author: xion
+'''
+from gaeworkers import Worker
+import random
+
+
+# virtual clock of the simulation running the workers; set by the benchmark
+clock = None
+
+
+class TrivialWorker(Worker):
+    ''' Worker doing nothing but yielding, to measure runner's overhead per spin. '''
+    spins = 100000
+
+    def setup(self):
+        self.done = 0
+
+    def run(self):
+        while self.done < self.spins:
+            self.done += 1
+            yield
+
+
+class HeavyWorker(Worker):
+    ''' Worker doing some real computation in every spin. '''
+    spins = 2000
+
+    def setup(self):
+        self.done = 0
+        self.items = [random.random() for _ in xrange(1000)]
+
+    def run(self):
+        while self.done < self.spins:
+            sorted(self.items)
+            self.done += 1
+            yield
+
+
+class ScanWorker(Worker):
+    '''
+    Worker processing a job of many items, each of which takes
+    some virtual time. It's used to count the handoffs between tasks.
+    '''
+    items_count = 100000
+    item_time = 0.05
+
+    def setup(self):
+        self.processed = 0
+
+    def run(self):
+        while self.processed < self.items_count:
+            clock.advance(self.item_time)
+            self.processed += 1
+            yield
+
+
+# results of ForkWorker's job, appended by parent once its children have finished
+fork_results = []
+
+
+class ForkWorker(Worker):
+    '''
+    Worker splitting a job of items between children (see Worker.FORK),
+    each of which takes some virtual time per item. It's used to check
+    that the fork completes despite memcache evictions and task retries.
+    '''
+    shards_count = 10
+    shard_size = 100
+    item_time = 0.5
+
+    def setup(self):
+        self.total = None
+
+    def run(self):
+        if self.shard is not None:
+            clock.advance(self.item_time * len(self.shard))
+            yield Worker.JOIN(sum(self.shard))
+            return
+        if self.total is None:
+            items_count = self.shards_count * self.shard_size
+            counts = yield Worker.FORK([range(i, i + self.shard_size)
+                                        for i in xrange(0, items_count, self.shard_size)])
+            self.total = sum(counts)
+        fork_results.append(self.total)
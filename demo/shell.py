@@ -6,11 +6,10 @@ Created on 2011-09-12
 @author: xion
 '''
 from demo.shell_worker import ShellWorker
-from google.appengine.api import memcache
+from gaeworkers import results
 import json
 import webapp2
 import os
-import time
 import jinja2
 
 
@@ -19,6 +18,7 @@ jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(os.path.dirname(
 class ShellRequestHandler(webapp2.RequestHandler):
     
     TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'shell.jhtml')
+    RESULT_TIMEOUT = 15
     
     def get(self):
         worker = ShellWorker()
@@ -38,34 +38,18 @@ class ShellRequestHandler(webapp2.RequestHandler):
             self.respond_with("")
             return
         
-        shell_worker = ShellWorker(id = worker_id)
-        shell_worker.post_message(shell_input)
+        request_id = results.new_request_id()
+        shell_worker = ShellWorker(worker_id = worker_id)
+        shell_worker.post_message((request_id, shell_input))
         
-        result, has_result = self.__try_to_obtain_result()
-        result = result if has_result else "<Failed to evaluate input>"
+        try:
+            result = results.wait_result(worker_id, request_id, timeout = self.RESULT_TIMEOUT)
+        except results.ResultTimeout:
+            result = "<Failed to evaluate input>"
         
-        resp = { 'input': input, 'result': result }   
+        resp = { 'input': shell_input, 'result': result }   
         self.respond_with(json.dumps(resp))
         
-    def __try_to_obtain_result(self):
-        ''' Retrieves the result of shell command delegated to worker
-        - or at least attempts to. '''
-        # soft busy waiting... yes, I know
-        result, has_result = None, False
-        sleep_time = 0
-        while sleep_time < 5:
-            sleep_time += 1
-            time.sleep(sleep_time)
-            results = memcache.get('shell_results', namespace = 'gaeworkers_shell') #@UndefinedVariable
-            if results:
-                result = results[0]
-                memcache.delete('shell_results', namespace = 'gaeworkers_shell') #@UndefinedVariable
-                has_result = True
-                break
-            
-        return result, has_result
-        
-        
     def render(self, **kwargs):
         params = { 'columns': 80, 'history_rows': 30, 'prompt_rows': 3 }
         params.update(kwargs)
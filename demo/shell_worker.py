@@ -7,18 +7,19 @@ from gaeworkers.worker import Worker
 
 
 class ShellWorker(Worker):
+    priority = 'high'   # user is waiting for the results
+    
     def setup(self):
         self.session = {}
         
     def run(self):
         while True:
-            msgs = yield Worker.GET_MESSAGES()
+            msgs = yield Worker.WAIT_MESSAGES()
             if not msgs:    continue
             
-            results = []
-            for msg in msgs:
-                res = eval(msg, self.session)
-                results.append(res)
-                yield
-                
-            memcache.set('shell_results', results, namespace = 'gaeworkers_shell') #@UndefinedVariable
+            for request_id, shell_input in msgs:
+                try:
+                    result = repr(eval(shell_input, {}, self.session))
+                except Exception, e:
+                    result = "%s: %s" % (e.__class__.__name__, e)
+                yield Worker.PUBLISH_RESULT(request_id, result)
@@ -7,4 +7,8 @@ using task queue for code execution and memcache for preserving state.
 @license: MIT
 @since: 2011-08-30
 '''
-from worker import Worker
+import standins
+if standins.sdk_available():
+    from worker import Worker
+# otherwise, Worker is exported once gaeworkers.simulation installs the stand-ins
+
@@ -0,0 +1,51 @@
+'''
+Module with the Budget class, describing how much time is left
+for worker's code in current task.
+
+Created on 2011-12-01
+
+@author: xion
+'''
+from gaeworkers import config
+
+
+class Budget(object):
+    '''
+    Time budget of the worker, as returned by Worker.TIME_LEFT call.
+    '''
+    def __init__(self, time_left, spin_estimate):
+        '''
+        @param time_left: Seconds left before the runner has to save worker's state
+                          and hand it over to next task
+        @param spin_estimate: Runner's estimate (in seconds) of how long a spin
+                              of worker's run() takes
+        '''
+        self.time_left = max(time_left, 0.0)
+        self.spin_estimate = spin_estimate
+
+    def batch_size(self, item_seconds, min_size = 1, max_size = None, utilization = None):
+        '''
+        Computes the number of items worker can process before yielding
+        without risking that the task's deadline is exceeded.
+        @param item_seconds: Estimated time (in seconds) of processing single item
+        @param min_size: Minimum size of the batch
+        @param max_size: Maximum size of the batch, or None if there is no limit
+        @param utilization: Fraction (0-1) of time left that the batch may take,
+                            allowing for errors in item_seconds estimate;
+                            config.BUDGET_UTILIZATION by default
+        @return: Number of items in the batch
+        '''
+        utilization = utilization or config.BUDGET_UTILIZATION
+        usable_time = self.time_left * utilization
+        if item_seconds > 0:
+            size = int(usable_time / item_seconds)
+        else:
+            size = max_size or min_size
+
+        size = max(size, min_size)
+        if max_size is not None:
+            size = min(size, max_size)
+        return size
+
+    def __repr__(self):
+        return "<Budget: %.3fs left, %.3fs per spin>" % (self.time_left, self.spin_estimate)
@@ -0,0 +1,231 @@
+'''
+Codecs for converting worker's state into compact, memcache-friendly
+binary payloads and back.
+
+Every payload starts with a short header identifying the format version
+and the codec that produced it, so that codecs can be switched
+(see config.STATE_CODEC) without making previously saved states unreadable.
+
+Created on 2011-11-25
+
+@author: xion
+'''
+from gaeworkers import config, data
+import cPickle
+import gc
+import marshal
+import struct
+
+
+class CodecError(data.DataError):
+    ''' Exception signaling that value could not be encoded or decoded. '''
+    pass
+
+
+_PAYLOAD_MAGIC = 'W'
+_PAYLOAD_VERSION = 1
+_PAYLOAD_HEADER = struct.Struct('!cBB')   # magic, format version, codec ID
+
+
+def encode(value, codec_name = None):
+    '''
+    Encodes the value into binary payload which can be converted back
+    by calling decode().
+    @param codec_name: Name of the codec to use; config.STATE_CODEC by default
+    @return: Binary string
+    '''
+    codec = get_codec(codec_name or config.STATE_CODEC)
+    header = _PAYLOAD_HEADER.pack(_PAYLOAD_MAGIC, _PAYLOAD_VERSION, codec.codec_id)
+    return header + codec.encode(value)
+
+
+def decode(payload):
+    '''
+    Decodes the value from payload produced by encode().
+    Codec is picked based on payload's header, regardless of the current
+    config.STATE_CODEC setting.
+    '''
+    if not is_payload(payload):
+        raise CodecError("Not a gae-workers payload")
+    _, version, codec_id = _PAYLOAD_HEADER.unpack_from(payload)
+    if version != _PAYLOAD_VERSION:
+        raise CodecError("Unsupported payload version: %s" % version)
+
+    codec = _codecs_by_id.get(codec_id)
+    if not codec:
+        raise CodecError("Unknown codec ID: %s" % codec_id)
+    return codec.decode(buffer(payload, _PAYLOAD_HEADER.size))
+
+
+def is_payload(value):
+    ''' Checks whether given value looks like payload produced by encode(). '''
+    return isinstance(value, str) and len(value) >= _PAYLOAD_HEADER.size \
+           and value[0] == _PAYLOAD_MAGIC
+
+
+###############################################################################
+# Codecs
+
+class Codec(object):
+    '''
+    Base class for codecs.
+    '''
+    name = None         # name used to refer to the codec, e.g. in config.STATE_CODEC
+    codec_id = None     # number (0-255) stored in payload header; must never change
+
+    def encode(self, value):
+        ''' Encodes the value, returning binary string. '''
+        raise NotImplementedError()
+
+    def decode(self, body):
+        ''' Decodes the value from string (or buffer) returned by encode(). '''
+        raise NotImplementedError()
+
+
+class MarshalCodec(Codec):
+    '''
+    Default codec, based on the marshal module.
+
+    Values consisting only of built-in types (including arbitrarily nested
+    collections) are dumped by marshal in one go. If there is anything else
+    inside, the value is converted into tagged tree first, with unsupported
+    objects saved through data handlers (data.save_value).
+    @note: Marshal would write subclasses of built-in types (e.g. db.Text)
+           and objects supporting buffer protocol (e.g. array.array) as their
+           base types or raw bytes, so they never take the fast path.
+    '''
+    name = 'marshal'
+    codec_id = 1
+
+    _PLAIN = 'M'
+    _TAGGED = 'T'
+
+    _TAG_LIST, _TAG_TUPLE, _TAG_DICT, _TAG_SET, _TAG_FROZENSET, _TAG_EXT = range(6)
+    _SCALAR_TYPES = frozenset([type(None), bool, int, long, float, complex, str, unicode])
+    _PLAIN_TYPES = _SCALAR_TYPES | frozenset([list, tuple, dict, set, frozenset])
+    _MAX_PLAIN_DEPTH = 100
+
+    def encode(self, value):
+        try:
+            if self._is_plain(value):
+                return self._PLAIN + marshal.dumps(value, 2)
+            return self._TAGGED + marshal.dumps(self._to_tree(value), 2)
+        except RuntimeError, e:     # e.g. recursion limit exceeded with self-referencing values
+            raise CodecError("Could not encode value: %s" % e)
+
+    def _is_plain(self, value):
+        '''
+        Checks whether the value consists only of exact built-in types, which marshal preserves.
+        Value's tree is examined level by level, with gc.get_referents() listing elements
+        of all containers at once, as a walk in Python would take longer than marshal itself.
+        '''
+        level = [value]
+        for _ in xrange(self._MAX_PLAIN_DEPTH):
+            types = set(map(type, level))
+            if self._SCALAR_TYPES.issuperset(types):
+                return True
+            if not self._PLAIN_TYPES.issuperset(types):
+                return False
+            level = gc.get_referents(*level)
+        return False    # too deeply nested (or self-referencing) for marshal anyway
+
+    def decode(self, body):
+        kind = body[0]
+        try:
+            value = marshal.loads(body[1:])
+        except (EOFError, ValueError, TypeError), e:
+            raise CodecError("Corrupt payload: %s" % e)
+
+        if kind == self._PLAIN:     return value
+        if kind == self._TAGGED:    return self._from_tree(value)
+        raise CodecError("Unknown payload kind: %r" % kind)
+
+    def _to_tree(self, value):
+        '''
+        Converts the value into tree of marshallable objects.
+        Tuples are reserved for tagged nodes, i.e. (tag, payload) pairs.
+        '''
+        type_ = type(value)
+        if type_ in self._SCALAR_TYPES:
+            return value
+
+        to_tree = self._to_tree
+        if type_ is list:       return (self._TAG_LIST, [to_tree(v) for v in value])
+        if type_ is tuple:      return (self._TAG_TUPLE, [to_tree(v) for v in value])
+        if type_ is dict:       return (self._TAG_DICT, [(to_tree(k), to_tree(v))
+                                                         for k, v in value.iteritems()])
+        if type_ is set:        return (self._TAG_SET, [to_tree(v) for v in value])
+        if type_ is frozenset:  return (self._TAG_FROZENSET, [to_tree(v) for v in value])
+
+        saved_value = data.save_value(value)
+        if not isinstance(saved_value, tuple) or len(saved_value) != 2:
+            raise CodecError("Data handler returned invalid saved value for %r" % (value,))
+        try:
+            marshal.dumps(saved_value, 2)
+        except ValueError:
+            raise CodecError("Data handler returned unmarshallable saved value for %r" % (value,))
+        return (self._TAG_EXT, saved_value)
+
+    def _from_tree(self, node):
+        ''' Reverses the transformation done by _to_tree(). '''
+        if type(node) is not tuple:
+            return node
+
+        tag, payload = node
+        from_tree = self._from_tree
+        if tag == self._TAG_LIST:       return [from_tree(v) for v in payload]
+        if tag == self._TAG_TUPLE:      return tuple(from_tree(v) for v in payload)
+        if tag == self._TAG_DICT:       return dict((from_tree(k), from_tree(v)) for k, v in payload)
+        if tag == self._TAG_SET:        return set(from_tree(v) for v in payload)
+        if tag == self._TAG_FROZENSET:  return frozenset(from_tree(v) for v in payload)
+        if tag == self._TAG_EXT:        return data.restore_value(payload)
+        raise CodecError("Unknown tag in payload: %r" % tag)
+
+
+class PickleCodec(Codec):
+    '''
+    Codec based on cPickle. Handles any picklable object without
+    involving data handlers, at the cost of bigger payloads.
+    '''
+    name = 'pickle'
+    codec_id = 2
+
+    def encode(self, value):
+        try:
+            return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError), e:
+            raise CodecError("Could not pickle value: %s" % e)
+
+    def decode(self, body):
+        try:
+            return cPickle.loads(str(body))
+        except Exception, e:
+            raise CodecError("Could not unpickle value: %s" % e)
+
+
+###############################################################################
+# Codec registry
+
+_codecs_by_name = {}
+_codecs_by_id = {}
+
+def register_codec(codec):
+    '''
+    Registers a codec, making it available for encode() and decode().
+    @param codec: Codec object
+    '''
+    existing = _codecs_by_id.get(codec.codec_id)
+    if existing and existing.name != codec.name:
+        raise ValueError("Codec ID %s is already used by '%s' codec" % (codec.codec_id, existing.name))
+
+    _codecs_by_name[codec.name] = codec
+    _codecs_by_id[codec.codec_id] = codec
+
+def get_codec(name):
+    ''' Retrieves registered codec of given name. '''
+    try:                return _codecs_by_name[name]
+    except KeyError:    raise CodecError("Unknown codec: %s" % name)
+
+
+register_codec(MarshalCodec())
+register_codec(PickleCodec())
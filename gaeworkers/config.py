@@ -10,12 +10,30 @@ Created on 2011-08-31
 # accessible under this URL for the library to function correctly.
 WORKER_URL = '/_ah/worker'
 
+# URL for the handler reporting workers' runtime metrics as JSON (see metrics.py).
+# It should be restricted to administrators, e.g. with "login: admin" in app.yaml.
+STATS_URL = '/_ah/worker/stats'
+
 # Minimum number of seconds gae-workers will reserve for storing the worker's
 # state in memcache and delegating work to next task.
 # Depending on actual estimates from running worker's code, the actual time
-# before dropping work in current task may be higher. 
+# before dropping work in current task may be higher. It's also raised
+# for workers whose checkpoints are measured to take long.
 SAFETY_MARGIN = 5
 
+# Name of the deadline estimator predicting how long the worker's next spin
+# (code between subsequent yields) will take; see estimator.py.
+# Estimators' statistics are persisted between tasks running the same worker.
+DEADLINE_ESTIMATOR = 'histogram'
+
+# Percentile of spin durations used as prediction by 'histogram' deadline estimator.
+# The higher it is, the smaller the risk of exceeding task's deadline.
+DEADLINE_PERCENTILE = 0.99
+
+# Default fraction of the time left in task that batches sized with
+# Budget.batch_size() (see Worker.TIME_LEFT) are allowed to take.
+BUDGET_UTILIZATION = 0.5
+
 
 ###############################################################################
 
@@ -25,6 +43,22 @@ SAFETY_MARGIN = 5
 # You don't generally need to change it.
 QUEUE_NAME = 'gae-workers'
 
+# Priority lanes: task queues for workers of respective priorities (see Worker.priority),
+# from the highest priority to the lowest. Queues of the lanes in use must be defined
+# in queue.yaml, with rates that keep latency-sensitive workers from waiting behind
+# long batch jobs. Several lanes can share a queue.
+PRIORITY_LANES = [('high', QUEUE_NAME + '-high'),
+                  ('normal', QUEUE_NAME),
+                  ('low', QUEUE_NAME + '-low')]
+
+# Priority of workers which don't declare one.
+DEFAULT_PRIORITY = 'normal'
+
+# Number of times worker runs out of task's time and is handed off to next task
+# before it's demoted to the next lower lane (and again after as many more);
+# None disables demotion. Worker classes can override it (see Worker.demote_after).
+DEMOTE_AFTER = None
+
 # A total amount of seconds request is allowed to be ran on App Engine.
 # Currently, it is 10 minutes.
 # You shouldn't need to modify this unless the deadline limit is changed in GAE. 
@@ -42,6 +76,141 @@ MEMCACHE_NAMESPACE = 'gae-workers'
 # You don't generally need to change this.
 MEMCACHE_DATA_LIFETIME = int(0.9 * DEADLINE_SECONDS)
 
+# How often (in seconds) the attributes of worker's state that don't change
+# are written to memcache again, so that they don't expire.
+# They are kept in memcache for this much longer than the rest of the state.
+# You don't generally need to change this.
+MEMCACHE_STATE_REFRESH_INTERVAL = 60 * 60
+
+# Maximum size (in bytes) of a single value stored in memcache.
+# Bigger values of worker's state attributes are split into chunks of this size.
+# It must be below memcache's limit for value size, which is 1 MB.
+MEMCACHE_CHUNK_SIZE = 900 * 1024
+
+# Size (in bytes) above which values of worker's state attributes are compressed
+# before storing, and zlib compression level used for that (1-9).
+STATE_COMPRESSION_THRESHOLD = 16 * 1024
+STATE_COMPRESSION_LEVEL = 1
+
+# Whether worker's state shall also be persisted in datastore, so that
+# it can be restored even if memcache evicts it.
+DURABLE_STATE = True
+
+# How long (in seconds) the task continuing worker's execution waits for its state
+# to be written. When handing the worker off, state is written concurrently
+# with adding the next task, which can start before it's done.
+# If the state doesn't appear in time, the task continues from an older checkpoint.
+HANDOFF_STATE_TIMEOUT = 2
+
+# Execution lease of worker keeps it from being run by two tasks at once,
+# e.g. when a task is retried while it's still running. Task running the worker
+# holds the lease for this many seconds longer than worker's next spin is expected
+# to take (or the time left in the task, for spins sized with Worker.TIME_LEFT),
+# renewing it while the worker spins. If the task dies, its retries have to wait
+# until the lease expires to run the worker.
+LEASE_TIME = 60
+
+# How long (in seconds) the task continuing worker's execution waits for the
+# previous one to release the lease. If it isn't released in time, the task fails
+# and is retried later by the task queue.
+LEASE_WAIT_TIMEOUT = 2
+
+# How long (in seconds) released lease is remembered, so that retries of tasks
+# which have already run the worker are recognized and dropped.
+LEASE_RELEASED_LIFETIME = 24 * 60 * 60
+
+# How often (in seconds) the task continuing worker's execution checks
+# whether its state has been written and its lease released.
+HANDOFF_POLL_DELAY = 0.1
+
+# How often the runner checkpoints worker's state in the middle of a task:
+# every that many seconds and/or spins (None disables either trigger).
+# If the task dies before handing the worker off to the next one,
+# work is redone from the last checkpoint. Periodic checkpoints are written
+# asynchronously, and completed before the worker's next spin.
+CHECKPOINT_INTERVAL = 60
+CHECKPOINT_SPINS = None
+
+# Minimum number of seconds between checkpoints of worker's state written
+# to datastore. Checkpoints in between are only written to memcache.
+DURABLE_CHECKPOINT_INTERVAL = 5 * 60
+
+# Datastore kind of entities holding the durable copy of worker's state.
+# You don't generally need to change this.
+DATASTORE_STATE_KIND = '_GAEWorkersState'
+
+# How long (in seconds) messages posted to workers are kept in memcache.
+MEMCACHE_MESSAGE_LIFETIME = 60 * 60
+
+# Maximum number of messages a worker receives in single GET_MESSAGES call.
+MAX_RECEIVED_MESSAGES = 1000
+
+# How long (in seconds) worker waits for a message whose poster has reserved
+# a slot in worker's mailbox, but hasn't stored the message there.
+# After that, the message is considered lost and skipped.
+MESSAGE_SLOT_TIMEOUT = 10
+
+# How long (in seconds) the state of worker waiting for messages (WAIT_MESSAGES)
+# is kept in memcache. It is also written to datastore if DURABLE_STATE is enabled.
+PARKED_STATE_LIFETIME = 24 * 60 * 60
+
+# How long (in seconds) results published by workers wait to be retrieved.
+MEMCACHE_RESULT_LIFETIME = 10 * 60
+
+# Default number of seconds clients wait for worker's results (see results.wait_result).
+RESULT_WAIT_TIMEOUT = 30
+
+# Delays (in seconds) between subsequent checks for worker's results.
+# Delay starts at the minimum and doubles after every check, up to the maximum.
+RESULT_POLL_MIN_DELAY = 0.01
+RESULT_POLL_MAX_DELAY = 1.0
+
+# How long (in seconds) the join barrier of forked workers (FORK) and results
+# of its children are kept in memcache. Parent's state is kept for PARKED_STATE_LIFETIME.
+FORK_DATA_LIFETIME = 24 * 60 * 60
+
+# Maximum number of workers run in turns by single task (see Worker.start_many).
+# Their IDs are passed in task's URL, which must not get too long.
+MAX_MULTIPLEXED_WORKERS = 100
+
+# Weight of previous values in rolling aggregates of workers' runtime metrics,
+# applied with every recorded task. The closer it is to 1, the more tasks
+# the aggregates reflect.
+METRICS_DECAY = 0.98
+
+# Maximum number of most recently run workers of each class whose
+# individual metrics are reported by the stats handler.
+METRICS_MAX_WORKERS = 100
+
+# How long (in seconds) workers' runtime metrics are kept in memcache
+# since they were last updated.
+METRICS_LIFETIME = 24 * 60 * 60
+
+# Number of entities fetched by single datastore call when iterating over
+# queries with Worker.iterate_query().
+QUERY_BATCH_SIZE = 100
+
+# Number of batches of entities that Worker.prefetch_query() fetches in advance,
+# while the worker processes the current one. Fewer batches are fetched if they
+# couldn't be processed before task's deadline anyway.
+QUERY_PREFETCH_DEPTH = 2
+
+# Number of datastore mutations buffered by Worker.mutations after which
+# they are written in a batch. Datastore accepts up to 500 entities per call.
+MUTATION_BATCH_SIZE = 500
+
+# Rate limits of resources shared by workers, e.g. datastore kinds they all write
+# or external services (see Worker.THROTTLE and ratelimit.py). Maps resource names
+# to pairs: (tokens per second, bucket size). Bucket of every resource is shared
+# by all workers and refilled in full every (bucket size / rate) seconds.
+RATE_LIMITS = {}
+
+# Name of the codec used to serialize worker's state (see codec.py).
+# Changing it is safe even with workers running, because payloads
+# record the codec they were encoded with.
+# You don't generally need to change this.
+STATE_CODEC = 'marshal'
+
 
 # Minimum amount of seconds workers can SLEEP.
 # Internal shorten than that is considered to be not enforceable anyway,
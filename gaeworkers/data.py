@@ -7,6 +7,9 @@ Created on 2011-09-02
 @author: Xion
 '''
 from google.appengine.ext import db
+import __builtin__
+import array
+import itertools
 import logging
 
 
@@ -22,12 +25,15 @@ def save_value(value):
     '''
     if value is None:   return None
     
-    for dh_class in _list_data_handlers():
-        dh = dh_class()
-        if dh.can_save(value):
-            return dh.save(value)
-    
-    logging.warning("[gae-workers] Failed to save value '%s' using specialized data handler; using default", value)
+    class_ = getattr(value, '__class__', None) or type(value)
+    try:
+        dh = _save_dispatch[class_]
+    except KeyError:
+        dh = _save_dispatch[class_] = _find_save_handler(value)
+        
+    _handler_hits[dh][0] += 1
+    if dh is not None:
+        return dh.save(value)
     return (_get_type_name(value), repr(value))
         
 
@@ -37,26 +43,106 @@ def restore_value(saved_value):
     '''
     try:
         type_name, value_repr = saved_value
-    except KeyError:
+    except (TypeError, ValueError):
         logging.error("[gae-workers] Invalid format of saved value '%s'", saved_value)
         return None
     
-    for dh_class in _list_data_handlers():
-        dh = dh_class()
-        if dh.can_restore(type_name, value_repr):
-            return dh.restore(type_name, value_repr)
+    try:
+        dh = _restore_dispatch[type_name]
+    except KeyError:
+        dh = _restore_dispatch[type_name] = _find_restore_handler(type_name, value_repr)
         
-    logging.warning("[gae-workers] Failed to restore value '%s' using specialized data handler; using default", saved_value)
-    return _find_type(type_name)(value_repr)
+    _handler_hits[dh][1] += 1
+    if dh is not None:
+        return dh.restore(type_name, value_repr)
+    try:
+        return _find_type(type_name)(value_repr)
+    except (TypeError, ValueError), e:
+        raise DataError("Could not restore value of type %s: %s" % (type_name, e))
+
+
+###############################################################################
+# Data handlers registry
+
+_data_handlers = []         # list of (priority, registration_order, handler), sorted
+_auto_handlers = set()      # handlers registered automatically, as their classes were defined
+_registration_order = itertools.count()
+_save_dispatch = {}         # class -> handler (or None if there is no specialized handler)
+_restore_dispatch = {}      # type name -> handler (or None)
+_handler_hits = {None: [0, 0]}  # handler -> [saves, restores]; None stands for default handling
+
+def register_data_handler(handler, priority = None):
+    '''
+    Registers a data handler, so that it's used by save_value/restore_value.
+    Subclasses of DataHandler are registered automatically when they are defined;
+    registering such class (or its instance) again replaces that handler,
+    e.g. to change its priority.
+    @param handler: DataHandler subclass or instance
+    @param priority: Priority of the handler; if omitted, handler's priority attribute is used.
+                     The lower the priority, the sooner handler is asked whether
+                     it can save/restore a value of new type.
+    @return: Registered handler instance
+    '''
+    if isinstance(handler, type):
+        handler = handler()
+    if priority is None:
+        priority = handler.priority
+        
+    hits = [0, 0]
+    for item in list(_data_handlers):
+        if item[2] in _auto_handlers and item[2].__class__ is handler.__class__:
+            _data_handlers.remove(item)
+            _auto_handlers.discard(item[2])
+            hits = _handler_hits.pop(item[2])
+        
+    _data_handlers.append((priority, _registration_order.next(), handler))
+    _data_handlers.sort(key = lambda item: item[:2])
+    _handler_hits[handler] = hits
+    
+    # handler may take over types which were previously dispatched elsewhere
+    _save_dispatch.clear()
+    _restore_dispatch.clear()
+    return handler
+
+
+def get_handler_stats():
+    '''
+    Retrieves the number of values saved and restored by every data handler.
+    @return: Dictionary mapping handler class names to (saves, restores) pairs.
+             Values saved and restored without specialized handler are listed under None.
+    '''
+    return dict((dh.__class__.__name__ if dh is not None else None, tuple(hits))
+                for dh, hits in _handler_hits.iteritems())
+
+def reset_handler_stats():
+    ''' Resets the counters reported by get_handler_stats(). '''
+    for hits in _handler_hits.itervalues():
+        hits[:] = [0, 0]
 
 
 ###############################################################################
 # Data handlers for different object types
 
+class _DataHandlerType(type):
+    '''
+    Metaclass of data handlers, which registers them as they are defined
+    (see register_data_handler()). Classes which don't implement can_save()
+    (e.g. base classes of other handlers) are left out.
+    '''
+    def __init__(cls, name, bases, attrs):
+        super(_DataHandlerType, cls).__init__(name, bases, attrs)
+        if not any(isinstance(base, _DataHandlerType) for base in bases):
+            return  # DataHandler itself
+        if cls.can_save.im_func is not DataHandler.can_save.im_func:
+            _auto_handlers.add(register_data_handler(cls))
+
+
 class DataHandler(object):
     '''
-    Base class for data handlers.
+    Base class for data handlers. Subclasses are registered automatically.
     '''
+    __metaclass__ = _DataHandlerType
+    
     priority = 0    # the lower the priority, the sooner handler's can_save/can_restore is invoked
     
     def can_save(self, value):
@@ -64,6 +150,8 @@ class DataHandler(object):
         Checks whether saving this value is supported by this data handler.
         If it does, then save() will be used to obtain memcache-friendly
         representation of the value.
+        @note: The answer is cached for value's class, so it shall depend
+               only on the class of the value.
         '''
         raise NotImplementedError()
         
@@ -79,6 +167,7 @@ class DataHandler(object):
         '''
         Checks whether restoring saved value of this type is supported by this data handler.
         If it is, then restore() will be used to recover the original value.
+        @note: The answer is cached for type_name, so it shall not depend on value_repr.
         '''
         raise NotImplementedError()
     
@@ -95,28 +184,74 @@ class DbModelHandler(DataHandler):
     def can_save(self, value):
         return isinstance(value, db.Model)
     def can_restore(self, type_name, value_repr):
-        return _find_type(type_name) == db.Model
+        try:                return issubclass(_find_type(type_name), db.Model)
+        except DataError:   return False
     
     def save(self, value):
         entity_protobuf = db.model_to_protobuf(value)
-        return (_get_type_name(value), str(entity_protobuf))
+        return (_get_type_name(value), entity_protobuf.Encode())
     def restore(self, type_name, value_repr):
         return db.model_from_protobuf(value_repr)
     
     
 class CollectionsHandler(DataHandler):
     '''
-    Data handler for built-in collections.
+    Data handler for built-in collections and their subclasses (e.g. OrderedDict).
+    Collections are stored as binary payloads of the state codec. Subclasses are
+    stored as their plain contents, along with default_factory of defaultdict-like
+    ones, if it's a class.
     '''
     def can_save(self, value):
         return isinstance(value, (list, dict))
     def can_restore(self, type_name, value_repr):
-        return type_name in ['list', 'dict']
+        if type_name in ['list', 'dict']:
+            return True
+        try:                return issubclass(_find_type(type_name), (list, dict))
+        except DataError:   return False
+    
+    def save(self, value):
+        from gaeworkers import codec
+        if type(value) in (list, dict):
+            return (_get_type_name(value), codec.encode(value))
+        
+        contents = list(value) if isinstance(value, list) else value.items()
+        factory = getattr(value, 'default_factory', None)
+        if factory is not None and not isinstance(factory, type):
+            raise DataError("Cannot save default_factory of %s: %r" % (_get_type_name(value), factory))
+        factory_name = _get_class_name(factory) if factory is not None else None
+        return (_get_type_name(value), codec.encode((contents, factory_name)))
+    def restore(self, type_name, value_repr):
+        from gaeworkers import codec
+        if not codec.is_payload(value_repr):
+            return eval(value_repr)     # value saved by older version of gae-workers
+        if type_name in ['list', 'dict']:
+            return codec.decode(value_repr)
+        
+        contents, factory_name = codec.decode(value_repr)
+        class_ = _find_type(type_name)
+        collection = class_(_find_type(factory_name)) if factory_name else class_()
+        if isinstance(collection, list):    collection.extend(contents)
+        else:                               collection.update(contents)
+        return collection
+    
+    
+class BinaryHandler(DataHandler):
+    '''
+    Data handler for mutable binary buffers: bytearray and array.array.
+    '''
+    def can_save(self, value):
+        return isinstance(value, (bytearray, array.array))
+    def can_restore(self, type_name, value_repr):
+        return type_name in ['bytearray', 'array.array']
     
     def save(self, value):
-        return (_get_type_name(value), repr(value))
+        if isinstance(value, array.array):
+            return ('array.array', value.typecode + value.tostring())
+        return ('bytearray', str(value))
     def restore(self, type_name, value_repr):
-        return eval(value_repr)
+        if type_name == 'array.array':
+            return array.array(value_repr[0], value_repr[1:])
+        return bytearray(value_repr)
     
     
 class StringHandler(DataHandler):
@@ -134,17 +269,36 @@ class StringHandler(DataHandler):
         return _find_type(type_name)(value_repr)
         
 
-###############################################################################
-# Utility functions
+def _find_save_handler(value):
+    '''
+    Finds data handler capable of saving given value.
+    @return: Data handler or None
+    '''
+    for _, _, dh in _data_handlers:
+        if dh.can_save(value):
+            return dh
+        
+    logging.warning("[gae-workers] No specialized data handler for saving values of type %s; using default",
+                    _get_type_name(value))
+    return None
 
-def _list_data_handlers():
+def _find_restore_handler(type_name, value_repr):
     '''
-    Lists all data handler classes, sorted by descending priority.
+    Finds data handler capable of restoring value of given type.
+    @return: Data handler or None
     '''
-    data_handlers = DataHandler.__subclasses__()
-    data_handlers = sorted(data_handlers, key = lambda dh: dh.priority)
-    return data_handlers
-    
+    for _, _, dh in _data_handlers:
+        if dh.can_restore(type_name, value_repr):
+            return dh
+        
+    logging.warning("[gae-workers] No specialized data handler for restoring values of type %s; using default",
+                    type_name)
+    return None
+
+
+
+###############################################################################
+# Utility functions
 
 def _get_type_name(value):
     '''
@@ -153,15 +307,22 @@ def _get_type_name(value):
     '''
     class_ = getattr(value, '__class__', None)
     if class_:
-        type_ = class_
+        type_ = class_.__name__
         module = getattr(class_, '__module__', None)
         if module and module != '__builtin__':
-            type_ = module + "." + class_
+            type_ = module + "." + type_
     else:
         type_ = type(value).__name__
         
     return type_
 
+def _get_class_name(class_):
+    ''' Retrieves the name of given class, in the form understood by _find_type(). '''
+    module = getattr(class_, '__module__', None)
+    if module and module != '__builtin__':
+        return module + "." + class_.__name__
+    return class_.__name__
+
 def _find_type(type_name):
     '''
     Utility function that finds type based on given name.
@@ -171,11 +332,12 @@ def _find_type(type_name):
     if '.' in type_name:
         try:
             module, class_name = type_name.rsplit('.', 1)
-            class_ = __import__(module, globals(), locals(), fromlist = [class_name])
-        except ImportError:
+            module = __import__(module, globals(), locals(), fromlist = [class_name])
+            class_ = getattr(module, class_name)
+        except (ImportError, AttributeError):
             raise DataError, "Could not import class %s" % type_name
     else:
-        try:                class_ = globals()[type_name]
-        except KeyError:    raise DataError, "Type %s not found" % type_name
+        try:                class_ = getattr(__builtin__, type_name)
+        except AttributeError:  raise DataError, "Type %s not found" % type_name
         
     return class_
@@ -0,0 +1,188 @@
+'''
+Deadline estimators, predicting how long the next spin of worker's run()
+will take. The runner uses them to decide whether another spin fits
+before the task's deadline.
+
+Estimator's statistics are persisted along with worker's state,
+so that every task handling the worker starts with what previous
+ones have learned.
+
+Created on 2011-11-30
+
+@author: xion
+'''
+from gaeworkers import config
+import math
+
+
+class DeadlineEstimator(object):
+    '''
+    Base class for deadline estimators.
+    '''
+    name = None     # name used to refer to the estimator, e.g. in config.DEADLINE_ESTIMATOR
+
+    def observe(self, spin_duration):
+        ''' Records the duration (in seconds) of a spin. '''
+        raise NotImplementedError()
+
+    def estimate(self):
+        ''' Predicts the duration (in seconds) of next spin. '''
+        raise NotImplementedError()
+
+    def get_state(self):
+        ''' Returns estimator's statistics as marshallable object, for persisting. '''
+        raise NotImplementedError()
+
+    def set_state(self, state):
+        ''' Restores statistics returned by get_state(). '''
+        raise NotImplementedError()
+
+
+class MaxAverageEstimator(DeadlineEstimator):
+    '''
+    Estimator predicting the maximum of running averages of spin duration.
+    This is how gae-workers used to estimate the deadline. It's very conservative,
+    since a few slow spins inflate the estimate for good.
+    '''
+    name = 'max_average'
+
+    def __init__(self):
+        self.total_time = 0.0
+        self.spins_count = 0
+        self.max_average = 0.0
+
+    def observe(self, spin_duration):
+        self.total_time += spin_duration
+        self.spins_count += 1
+        self.max_average = max(self.max_average, self.total_time / self.spins_count)
+
+    def estimate(self):
+        return self.max_average
+
+    def get_state(self):
+        return (self.total_time, self.spins_count, self.max_average)
+
+    def set_state(self, state):
+        self.total_time, self.spins_count, self.max_average = state
+
+
+class HistogramEstimator(DeadlineEstimator):
+    '''
+    Estimator tracking the distribution of spin durations in a histogram
+    with logarithmic buckets, along with exponentially weighted moving average.
+    Older observations gradually lose their weight, so the estimate adapts
+    to changes in worker's behavior.
+
+    Estimate is the higher of config.DEADLINE_PERCENTILE percentile
+    (upper bound of its bucket) and the moving average. Until enough spins
+    are observed, the longest spin so far is used.
+    '''
+    name = 'histogram'
+
+    MIN_BUCKET = 0.001  # upper bound (in seconds) of the first bucket
+    BUCKET_GROWTH = 1.5
+    BUCKETS_COUNT = 36  # the last one goes up to ~2000 secs
+    MIN_SPINS = 10
+
+    DECAY = 0.995       # weight of previous observations kept with every new one
+    EWMA_ALPHA = 0.05
+    _RESCALE_WEIGHT = 1e9
+
+    _LOG_GROWTH = math.log(BUCKET_GROWTH)
+
+    def __init__(self):
+        self.counts = [0.0] * self.BUCKETS_COUNT
+        self.total_weight = 0.0
+        self.weight = 1.0   # weight of next observation; grows instead of decaying older ones
+        self.spins_count = 0
+        self.ewma = 0.0
+        self.max_spin = 0.0
+        self._estimate = None
+
+    def observe(self, spin_duration):
+        if spin_duration <= self.MIN_BUCKET:
+            bucket = 0
+        else:
+            bucket = min(int(math.ceil(math.log(spin_duration / self.MIN_BUCKET) / self._LOG_GROWTH)),
+                         self.BUCKETS_COUNT - 1)
+
+        self.weight /= self.DECAY
+        self.counts[bucket] += self.weight
+        self.total_weight += self.weight
+        if self.weight > self._RESCALE_WEIGHT:
+            self._rescale()
+
+        self.spins_count += 1
+        if self.spins_count > 1:
+            self.ewma += self.EWMA_ALPHA * (spin_duration - self.ewma)
+        else:
+            self.ewma = spin_duration
+        self.max_spin = max(self.max_spin, spin_duration)
+        self._estimate = None
+
+    def estimate(self):
+        if self._estimate is None:
+            if self.spins_count < self.MIN_SPINS:
+                self._estimate = self.max_spin
+            else:
+                self._estimate = max(self.percentile(config.DEADLINE_PERCENTILE), self.ewma)
+        return self._estimate
+
+    def percentile(self, p):
+        ''' Retrieves upper bound of spin duration for given percentile (0-1) of spins. '''
+        threshold = p * self.total_weight
+        cumulative = 0.0
+        for bucket, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                break
+        return self.MIN_BUCKET * self.BUCKET_GROWTH ** bucket
+
+    def get_state(self):
+        self._rescale()
+        return (self.counts, self.total_weight, self.spins_count, self.ewma, self.max_spin)
+
+    def set_state(self, state):
+        counts, self.total_weight, self.spins_count, self.ewma, self.max_spin = state
+        self.counts = list(counts)
+        self.weight = 1.0
+        self._estimate = None
+
+    def _rescale(self):
+        ''' Normalizes the counts so that weight of next observation is 1 again. '''
+        self.counts = [count / self.weight for count in self.counts]
+        self.total_weight /= self.weight
+        self.weight = 1.0
+
+
+###############################################################################
+# Estimator registry
+
+_estimators = {}
+
+def register_estimator(estimator_class):
+    '''
+    Registers deadline estimator class, so that it can be referred to
+    by name in config.DEADLINE_ESTIMATOR or Worker.deadline_estimator.
+    '''
+    _estimators[estimator_class.name] = estimator_class
+    return estimator_class
+
+def create_estimator(name = None, state = None):
+    '''
+    Creates deadline estimator.
+    @param name: Name of the estimator; config.DEADLINE_ESTIMATOR by default
+    @param state: Persisted statistics of the estimator, as returned by get_state()
+    '''
+    name = name or config.DEADLINE_ESTIMATOR
+    try:                estimator_class = _estimators[name]
+    except KeyError:    raise ValueError("Unknown deadline estimator: %s" % name)
+
+    estimator = estimator_class()
+    if state is not None:
+        estimator.set_state(state)
+    return estimator
+
+
+register_estimator(MaxAverageEstimator)
+register_estimator(HistogramEstimator)
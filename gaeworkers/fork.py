@@ -0,0 +1,171 @@
+'''
+Module implementing fan-out/fan-in of workers: Worker.FORK call
+splitting the work into shards processed by child workers,
+and the join barrier which resumes the parent once they all finish.
+
+The barrier is a memcache counter of children that haven't finished yet.
+Every child stores its result with memcache.add (so that retried tasks
+don't count twice) and decrements the counter. The child which brings
+it down to zero wakes up the parent, using task parameters left
+by the parent in fork's record. Fork's record and children's results
+are also written to durable tier of state storage (see storage.py), so that
+the parent isn't stranded if memcache evicts them; if the counter is evicted,
+children check the results directly instead.
+
+Created on 2011-12-01
+
+@author: xion
+'''
+from gaeworkers import codec, config, data
+from gaeworkers.storage import get_storage
+from gaeworkers.worker import _generate_worker_id
+from google.appengine.api import memcache
+from google.appengine.api.taskqueue import Task, TaskAlreadyExistsError, TombstonedTaskError
+import hashlib
+import logging
+import uuid
+
+
+_FORK_MEMCACHE_KEY = "worker://%(id)s/forks/%(fork_id)s"
+_FORK_PENDING_MEMCACHE_KEY = "worker://%(id)s/forks/%(fork_id)s/pending"
+_FORK_RESULT_MEMCACHE_KEY = "worker://%(id)s/forks/%(fork_id)s/results/%(index)s"
+
+
+class ForkError(Exception):
+    '''
+    Raised when some children of the fork could not be started.
+    Task failing with this error is retried later by the task queue, and forks anew.
+    '''
+    pass
+
+
+def new_fork_id():
+    ''' Generates unique ID of a fork. '''
+    return hashlib.md5(uuid.uuid4().bytes).hexdigest()[:16]
+
+
+def create_children(parent, fork_id, shards):
+    '''
+    Creates child workers for given shards. Children are of the same class
+    as the parent and get deep copy of its state, with shard attribute
+    set to their part of the work.
+    @return: List of child workers
+    '''
+    parent_state = codec.encode(parent._get_state_dict())
+
+    children = []
+    for index, shard in enumerate(shards):
+        child = parent.__class__(None, _generate_worker_id())
+        for attr, value in codec.decode(parent_state).iteritems():
+            setattr(child, attr, value)
+        child.shard = shard
+        child._runner_data['fork_parent'] = (parent._id, fork_id, index, len(shards))
+        children.append(child)
+    return children
+
+
+def open_barrier(parent, fork_id, shards_count, queue_name, wakeup_task_params):
+    '''
+    Sets up the join barrier for children of given fork.
+    @param wakeup_task_params: Parameters of the task that resumes the parent,
+                               as taken by Task constructor. They must include
+                               unique name of the task.
+    @return: Whether the barrier has been set up
+    '''
+    pending_key = _FORK_PENDING_MEMCACHE_KEY % {'id': parent._id, 'fork_id': fork_id}
+    if not memcache.set(pending_key, shards_count, config.FORK_DATA_LIFETIME, #@UndefinedVariable
+                        namespace = config.MEMCACHE_NAMESPACE):
+        return False
+    return rearm_barrier(parent, fork_id, queue_name, wakeup_task_params)
+
+def rearm_barrier(parent, fork_id, queue_name, wakeup_task_params):
+    ''' Replaces the parameters of task resuming the parent once all children finish. '''
+    fork_key = _FORK_MEMCACHE_KEY % {'id': parent._id, 'fork_id': fork_id}
+    return get_storage().set(fork_key, codec.encode((queue_name, wakeup_task_params)),
+                             config.FORK_DATA_LIFETIME, durable = True)
+
+
+def join(child, result = None):
+    '''
+    Reports that child worker has finished, passing the result to its parent.
+    Wakes up the parent if this was the last child to finish.
+    @return: Whether the result has been accepted (False for workers that are not
+             children of any fork, and for children that have already joined)
+    '''
+    fork_parent = child._runner_data.pop('fork_parent', None)
+    if not fork_parent:
+        return False
+    parent_id, fork_id, index, shards_count = fork_parent
+
+    try:
+        payload = codec.encode(result)
+    except data.DataError, e:
+        logging.error("[gae-workers] Could not save result of worker '%s' (ID=%s): %s",
+                      child._name, child._id, e)
+        payload = codec.encode(None)
+
+    result_key = _result_key(parent_id, fork_id, index)
+    if not memcache.add(result_key, payload, config.FORK_DATA_LIFETIME, #@UndefinedVariable
+                        namespace = config.MEMCACHE_NAMESPACE):
+        logging.warning("[gae-workers] Worker '%s' (ID=%s) has already joined its parent",
+                        child._name, child._id)
+        return False
+    if not get_storage().set(result_key, payload, config.FORK_DATA_LIFETIME, durable = True):
+        logging.error("[gae-workers] Could not save result of worker '%s' (ID=%s) durably",
+                      child._name, child._id)
+
+    pending_key = _FORK_PENDING_MEMCACHE_KEY % {'id': parent_id, 'fork_id': fork_id}
+    pending = memcache.decr(pending_key, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+    if pending is None or pending <= 0:
+        # counter has been evicted (or decremented twice by a child whose result was evicted); check the results
+        pending = shards_count - len(_get_result_payloads(parent_id, fork_id, shards_count))
+    if pending == 0:
+        wake_parent(parent_id, fork_id)
+    return True
+
+
+def collect_results(parent, fork_id, shards_count):
+    '''
+    Collects results of all children of given fork, cleaning up after the fork.
+    @return: List of results, in the order of shards; None if some children haven't finished
+    '''
+    payloads = _get_result_payloads(parent._id, fork_id, shards_count)
+    if len(payloads) < shards_count:
+        return None
+
+    results = []
+    for index in xrange(shards_count):
+        try:
+            results.append(codec.decode(payloads[_result_key(parent._id, fork_id, index)]))
+        except data.DataError, e:
+            logging.error("[gae-workers] Invalid result #%s of fork of worker '%s' (ID=%s): %s",
+                          index, parent._name, parent._id, e)
+            results.append(None)
+
+    fork_keys = payloads.keys() + [_FORK_MEMCACHE_KEY % {'id': parent._id, 'fork_id': fork_id},
+                                   _FORK_PENDING_MEMCACHE_KEY % {'id': parent._id, 'fork_id': fork_id}]
+    get_storage().delete_multi(fork_keys, durable = True)
+    return results
+
+
+def wake_parent(parent_id, fork_id):
+    ''' Adds the task resuming parent worker of given fork. '''
+    fork_payload = get_storage().get(_FORK_MEMCACHE_KEY % {'id': parent_id, 'fork_id': fork_id})
+    if fork_payload is None:
+        logging.error("[gae-workers] Record of fork %s of worker (ID=%s) is lost; worker cannot be resumed",
+                      fork_id, parent_id)
+        return
+
+    queue_name, task_params = codec.decode(fork_payload)
+    try:
+        Task(**task_params).add(queue_name)
+        logging.debug("[gae-workers] All children of worker (ID=%s) have finished", parent_id)
+    except (TaskAlreadyExistsError, TombstonedTaskError):
+        pass    # parent has already been woken up
+
+def _get_result_payloads(parent_id, fork_id, shards_count):
+    keys = [_result_key(parent_id, fork_id, index) for index in xrange(shards_count)]
+    return get_storage().get_multi(keys)
+
+def _result_key(parent_id, fork_id, index):
+    return _FORK_RESULT_MEMCACHE_KEY % {'id': parent_id, 'fork_id': fork_id, 'index': index}
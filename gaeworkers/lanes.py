@@ -0,0 +1,67 @@
+'''
+Priority lanes: task queues for workers of different priorities
+(see config.PRIORITY_LANES and Worker.priority).
+
+Tasks of latency-sensitive workers, such as interactive ones, go to higher lanes
+and don't wait behind long batch jobs in lower ones. Workers that keep running
+out of task's time can be demoted to lower lanes (see Worker.demote_after).
+Priority of worker's task is passed in its header, so worker stays
+in its lane for subsequent tasks.
+
+Created on 2011-12-11
+
+@author: xion
+'''
+from gaeworkers import config
+from google.appengine.api import taskqueue
+from time import time
+import logging
+
+
+def get_lane(worker, priority = None):
+    '''
+    Determines the priority lane for worker's task.
+    @param priority: Priority of the task; worker's priority by default
+    @return: Pair: (priority, queue name). Workers with their own queue_name
+             don't use lanes; priority is None for them.
+    @raise ValueError: If there's no lane of given priority
+    '''
+    if worker.queue_name:
+        return (None, worker.queue_name)
+    priority = priority or worker.priority or config.DEFAULT_PRIORITY
+    for lane_priority, queue_name in config.PRIORITY_LANES:
+        if lane_priority == priority:
+            return (priority, queue_name)
+    raise ValueError("Unknown worker priority: %s" % priority)
+
+def get_lower_priority(priority):
+    ''' Retrieves the priority of next lower lane, or the given one if it's the lowest. '''
+    priorities = [lane_priority for lane_priority, _ in config.PRIORITY_LANES]
+    return priorities[min(priorities.index(priority) + 1, len(priorities) - 1)]
+
+
+def get_occupancy():
+    '''
+    Retrieves the occupancy of lanes' queues from task queue statistics.
+    @return: Dictionary mapping priorities to dictionaries of statistics
+             (empty if they could not be retrieved)
+    '''
+    queue_names = sorted(set(queue_name for _, queue_name in config.PRIORITY_LANES))
+    try:
+        queue_stats = taskqueue.QueueStatistics.fetch([taskqueue.Queue(name) for name in queue_names])
+    except taskqueue.Error, e:
+        logging.warning("[gae-workers] Could not fetch statistics of priority lanes: %s", e)
+        return {}
+
+    now = time()
+    occupancy = {}
+    for queue_name, stats in zip(queue_names, queue_stats):
+        oldest_eta = stats.oldest_eta_usec / 1e6 if stats.oldest_eta_usec else None
+        occupancy[queue_name] = {
+            'queue': queue_name,
+            'queued_tasks': stats.tasks,
+            'in_flight': stats.in_flight,
+            'executed_last_minute': stats.executed_last_minute,
+            'oldest_task_wait': max(now - oldest_eta, 0) if oldest_eta else None,
+        }
+    return dict((priority, dict(occupancy[queue_name])) for priority, queue_name in config.PRIORITY_LANES)
@@ -0,0 +1,140 @@
+'''
+Execution leases, which keep a worker from being run by several tasks at once.
+
+Task queue delivers tasks at least once, and retries them when they fail
+(or only seem to), so two tasks can end up running the same worker from the same
+state: both do its work, and the later checkpoint overwrites the earlier one.
+Therefore the task acquires worker's lease in memcache (with atomic add)
+before running it, and renews it while the worker spins.
+
+Lease records the invocation count of the task holding it. When the task ends,
+lease is marked as released rather than deleted, so that retries of this
+or earlier invocations can tell that the worker has already been run past them.
+
+Created on 2011-12-10
+
+@author: xion
+'''
+from gaeworkers import config
+from google.appengine.api import memcache
+from time import sleep, time
+import logging
+import math
+import uuid
+
+
+_LEASE_MEMCACHE_KEY = "worker://%(id)s/lease"
+
+
+class LeaseError(Exception):
+    '''
+    Raised when worker's lease is held by another task, which may still be running it.
+    Task failing with this error is retried later by the task queue.
+    '''
+    pass
+
+
+class Lease(object):
+    '''
+    Execution lease of a worker, held by the task of given invocation.
+    Lease is stored as a pair: (invocation, token of the task holding it),
+    with None as the token once it's released. Token tells apart
+    tasks of the same invocation, i.e. a task and its retry.
+    '''
+    def __init__(self, worker_id, invocation):
+        self.worker_id = worker_id
+        self.invocation = invocation
+        self.held = False
+        self._key = _LEASE_MEMCACHE_KEY % {'id': worker_id}
+        self._value = (invocation, uuid.uuid4().hex[:16])
+        self._expires_at = None
+
+    def acquire(self):
+        '''
+        Acquires the lease. If it's still held by previous invocation (which is likely
+        handing the worker off to this one), it's waited for up to config.LEASE_WAIT_TIMEOUT seconds.
+        If memcache is unavailable, worker is run without the lease.
+        @return: False if the worker has already been run by this or later invocation,
+                 so the task is a duplicate which shouldn't run it; True otherwise
+        @raise LeaseError: If the lease is held by another task
+        '''
+        client = memcache.Client()
+        wait_deadline = time() + config.LEASE_WAIT_TIMEOUT
+        while True:
+            if memcache.add(self._key, self._value, config.LEASE_TIME, #@UndefinedVariable
+                            namespace = config.MEMCACHE_NAMESPACE):
+                return self._acquired()
+
+            lease = client.gets(self._key, namespace = config.MEMCACHE_NAMESPACE)
+            if lease is not None:
+                invocation, token = lease
+                if invocation > self.invocation or (invocation == self.invocation and token is None):
+                    return False
+                if token is None:
+                    if client.cas(self._key, self._value, config.LEASE_TIME,
+                                  namespace = config.MEMCACHE_NAMESPACE):
+                        return self._acquired()
+                    continue    # someone else has been quicker
+                if invocation == self.invocation:
+                    raise LeaseError("Worker (ID=%s) is being run by another task of invocation %s"
+                                     % (self.worker_id, invocation))
+
+            if time() >= wait_deadline:
+                if lease is None:
+                    logging.warning("[gae-workers] Could not acquire lease of worker (ID=%s); running it without one",
+                                    self.worker_id)
+                    return True
+                raise LeaseError("Worker (ID=%s) is still being run by task of invocation %s"
+                                 % (self.worker_id, lease[0]))
+            sleep(config.HANDOFF_POLL_DELAY)
+
+    def _acquired(self):
+        self.held = True
+        self._expires_at = time() + config.LEASE_TIME
+        return True
+
+    def renew(self, duration = 0):
+        '''
+        Extends the lease, if it's due: every third of config.LEASE_TIME,
+        or sooner if it wouldn't last for given number of seconds.
+        @param duration: Number of seconds the lease has to last, e.g. expected duration
+                         of worker's next spin; it's extended for config.LEASE_TIME more
+        @raise LeaseError: If the lease has expired and has been acquired by another task
+        '''
+        lease_time = int(math.ceil(duration)) + config.LEASE_TIME
+        if not self.held or self._expires_at - time() >= lease_time - config.LEASE_TIME / 3.0:
+            return
+        client = memcache.Client()
+        lease = client.gets(self._key, namespace = config.MEMCACHE_NAMESPACE)
+        if lease is None:   # expired or evicted
+            renewed = memcache.add(self._key, self._value, lease_time, #@UndefinedVariable
+                                   namespace = config.MEMCACHE_NAMESPACE)
+        else:
+            renewed = lease == self._value and client.cas(self._key, lease, lease_time,
+                                                          namespace = config.MEMCACHE_NAMESPACE)
+        if not renewed:
+            self.held = False
+            raise LeaseError("Lease of worker (ID=%s) has been lost" % self.worker_id)
+        self._expires_at = time() + lease_time
+
+    def release(self):
+        '''
+        Releases the lease after the worker has been run, remembering the invocation
+        for config.LEASE_RELEASED_LIFETIME seconds (see acquire()).
+        '''
+        if not self.held:   return
+        self.held = False
+        client = memcache.Client()
+        if client.gets(self._key, namespace = config.MEMCACHE_NAMESPACE) == self._value:
+            client.cas(self._key, (self.invocation, None), config.LEASE_RELEASED_LIFETIME,
+                       namespace = config.MEMCACHE_NAMESPACE)
+
+    def abandon(self):
+        '''
+        Deletes the lease when the task fails, so that its retry can run the worker
+        without waiting for the lease to expire.
+        '''
+        if not self.held:   return
+        self.held = False
+        if memcache.get(self._key, namespace = config.MEMCACHE_NAMESPACE) == self._value: #@UndefinedVariable
+            memcache.delete(self._key, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
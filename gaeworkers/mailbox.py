@@ -0,0 +1,169 @@
+'''
+Module implementing workers' message queues ("mailboxes") in memcache.
+
+Every message is stored under its own slot key. Posters reserve slots
+by atomically incrementing the mailbox's head counter, so they never
+overwrite each other's messages. Worker reading the mailbox keeps
+a cursor pointing past the last slot it has received. The cursor is part
+of worker's saved state, so it can't be evicted, and it moves on only
+when the worker's progress in processing the messages is saved as well.
+
+Worker can also park itself until a message arrives, leaving behind
+the parameters of a task which posters add to wake it up. Since this task
+is named, task queue rejects its duplicates and the worker is woken up once.
+
+Created on 2011-11-28
+
+@author: xion
+'''
+from gaeworkers import codec, config, data
+from google.appengine.api import memcache
+from google.appengine.api.taskqueue import Task, TaskAlreadyExistsError, TombstonedTaskError
+from time import time
+import logging
+
+
+_MAILBOX_HEAD_MEMCACHE_KEY = "worker://%(id)s/messages/head"
+_MAILBOX_SLOT_MEMCACHE_KEY = "worker://%(id)s/messages/%(slot)s"
+_MAILBOX_PARKED_MEMCACHE_KEY = "worker://%(id)s/messages/parked"
+
+
+class Mailbox(object):
+    '''
+    Message queue of a single worker.
+    There can be many posters, but only one reader (the worker itself).
+    '''
+    def __init__(self, worker_id, reader_data = None):
+        '''
+        @param worker_id: ID of the worker owning the mailbox
+        @param reader_data: Dictionary where the reader keeps its cursor, saved along
+                            with worker's state (i.e. worker's _runner_data);
+                            not needed by posters
+        '''
+        self.worker_id = worker_id
+        self.reader_data = reader_data if reader_data is not None else {}
+        self._head_key = _MAILBOX_HEAD_MEMCACHE_KEY % {'id': worker_id}
+        self._parked_key = _MAILBOX_PARKED_MEMCACHE_KEY % {'id': worker_id}
+
+    def post(self, msg):
+        '''
+        Posts a message to the mailbox.
+        @return: Whether the message was posted
+        '''
+        return self.post_many([msg])
+
+    def post_many(self, msgs):
+        '''
+        Posts several messages at once, reserving slots for all of them
+        with single increment of head counter.
+        @return: Whether the messages were posted
+        '''
+        if not msgs:    return True
+        try:
+            payloads = [codec.encode(msg) for msg in msgs]
+        except data.DataError, e:
+            logging.error("[gae-workers] Could not post message to worker (ID=%s): %s", self.worker_id, e)
+            return False
+
+        head = memcache.incr(self._head_key, delta = len(payloads), initial_value = 0, #@UndefinedVariable
+                             namespace = config.MEMCACHE_NAMESPACE)
+        if head is None:
+            logging.error("[gae-workers] Could not reserve message slots in mailbox of worker (ID=%s)", self.worker_id)
+            return False
+
+        first_slot = head - len(payloads) + 1
+        slots = dict((self._slot_key(first_slot + i), payload) for i, payload in enumerate(payloads))
+        failed_keys = memcache.set_multi(slots, config.MEMCACHE_MESSAGE_LIFETIME, #@UndefinedVariable
+                                         namespace = config.MEMCACHE_NAMESPACE)
+        if failed_keys:
+            logging.error("[gae-workers] Could not post %s message(s) to worker (ID=%s)",
+                          len(failed_keys), self.worker_id)
+            return False
+        
+        self.wake()
+        return True
+
+    def receive(self, limit = None):
+        '''
+        Retrieves pending messages, moving reader's cursor past them.
+        @param limit: Maximum number of messages to retrieve;
+                      config.MAX_RECEIVED_MESSAGES by default
+        @return: List of messages, in the order of posting
+        '''
+        limit = limit or config.MAX_RECEIVED_MESSAGES
+        head = int(memcache.get(self._head_key, namespace = config.MEMCACHE_NAMESPACE) or 0) #@UndefinedVariable
+        cursor, gap_since = self.reader_data.get('mailbox_cursor', (0, None))
+        if head < cursor:
+            logging.warning("[gae-workers] Mailbox of worker (ID=%s) has been reset; some messages may be lost",
+                            self.worker_id)
+            cursor, gap_since = 0, None
+            self.reader_data['mailbox_cursor'] = (cursor, gap_since)
+        if head == cursor:
+            return []
+
+        slot_range = range(cursor + 1, min(head, cursor + limit) + 1)
+        payloads = memcache.get_multi([self._slot_key(slot) for slot in slot_range], #@UndefinedVariable
+                                      namespace = config.MEMCACHE_NAMESPACE)
+
+        msgs = []
+        for slot in slot_range:
+            payload = payloads.get(self._slot_key(slot))
+            if payload is None:
+                # slot was reserved, but the message isn't there (yet?); wait for it a little
+                # to preserve ordering, unless the poster has likely failed
+                gap_since = gap_since or time()
+                if time() - gap_since < config.MESSAGE_SLOT_TIMEOUT:
+                    break
+                logging.warning("[gae-workers] Message #%s to worker (ID=%s) was lost", slot, self.worker_id)
+            else:
+                try:
+                    msgs.append(codec.decode(payload))
+                except data.DataError, e:
+                    logging.error("[gae-workers] Invalid message #%s to worker (ID=%s): %s",
+                                  slot, self.worker_id, e)
+            cursor, gap_since = slot, None
+
+        self.reader_data['mailbox_cursor'] = (cursor, gap_since)
+        return msgs
+
+    def has_messages(self):
+        ''' Checks whether there are any pending messages, without receiving them. '''
+        head = int(memcache.get(self._head_key, namespace = config.MEMCACHE_NAMESPACE) or 0) #@UndefinedVariable
+        cursor, _ = self.reader_data.get('mailbox_cursor', (0, None))
+        return head != cursor
+
+
+    def park(self, queue_name, task_params):
+        '''
+        Marks the worker as waiting for messages.
+        @param queue_name: Name of the queue for wake-up task
+        @param task_params: Parameters of wake-up task, as taken by Task constructor.
+                            They must include unique name of the task.
+        @return: Whether the worker has been parked
+        '''
+        return memcache.set(self._parked_key, (queue_name, task_params), config.PARKED_STATE_LIFETIME, #@UndefinedVariable
+                            namespace = config.MEMCACHE_NAMESPACE)
+
+    def unpark(self):
+        ''' Marks the worker as no longer waiting for messages, i.e. woken up. '''
+        memcache.delete(self._parked_key, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+
+    def wake(self):
+        '''
+        Wakes up the worker if it's waiting for messages.
+        @return: Whether the worker was waiting
+        '''
+        parked = memcache.get(self._parked_key, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+        if parked is None:
+            return False
+
+        queue_name, task_params = parked
+        try:
+            Task(**task_params).add(queue_name)
+            logging.debug("[gae-workers] Worker (ID=%s) woken up", self.worker_id)
+        except (TaskAlreadyExistsError, TombstonedTaskError):
+            pass    # someone else has already woken it up
+        return True
+
+    def _slot_key(self, slot):
+        return _MAILBOX_SLOT_MEMCACHE_KEY % {'id': self.worker_id, 'slot': slot}
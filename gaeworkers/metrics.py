@@ -0,0 +1,197 @@
+'''
+Runtime metrics of workers, recorded by the runner at the end of every task
+and exposed as JSON by the stats handler (see config.STATS_URL).
+
+Metrics are aggregated per worker, per worker class and per priority lane
+(see lanes.py) in memcache. Statistics of lanes also include the occupancy
+of their queues, so that queue rates can be tuned to the wait times.
+Aggregates are rolling: with every recorded task, previous values
+are weighted down by config.METRICS_DECAY, so they reflect recent tasks.
+Records are updated without locking, so under heavy contention some
+tasks may be left out; that's fine for statistics.
+
+Created on 2011-12-06
+
+@author: xion
+'''
+from gaeworkers import config, lanes
+from google.appengine.api import memcache
+from time import time
+
+
+_WORKER_METRICS_MEMCACHE_KEY = "worker://%(id)s/metrics"
+_CLASS_METRICS_MEMCACHE_KEY = "metrics://class/%(class)s"
+_CLASSES_MEMCACHE_KEY = "metrics://classes"
+_LANE_METRICS_MEMCACHE_KEY = "metrics://lane/%(lane)s"
+
+# fields of aggregate records, which are stored as lists
+_FIELDS = ('tasks', 'task_time', 'spins', 'spin_time', 'max_spin_time', 'state_bytes',
+           'serialization_time', 'handoffs', 'handoff_gap', 'max_handoff_gap',
+           'waits', 'queue_wait', 'max_queue_wait')
+_TASKS_TOTAL, _INVOCATION, _UPDATED_AT, _WORKER_IDS = xrange(len(_FIELDS), len(_FIELDS) + 4)
+
+
+class TaskMetrics(object):
+    '''
+    Metrics of single worker's execution in current task.
+    '''
+    def __init__(self, invocation = 1, handoff_gap = None, queue_wait = None, lane = None):
+        '''
+        @param invocation: Invocation count of the worker
+        @param handoff_gap: Number of seconds between the checkpoint made
+                            by previous task and the start of this one
+        @param queue_wait: Number of seconds the task has waited in the queue
+                           after its ETA
+        @param lane: Priority lane of the task, if it's in one
+        '''
+        self.invocation = invocation
+        self.handoff_gap = handoff_gap
+        self.queue_wait = queue_wait
+        self.lane = lane
+        self.start_time = time()
+        self.spins = 0
+        self.spin_time = 0.0
+        self.max_spin_time = 0.0
+        self.state_bytes = 0
+        self.serialization_time = 0.0
+
+    def observe_spin(self, spin_duration):
+        ''' Records the duration (in seconds) of a spin. '''
+        self.spins += 1
+        self.spin_time += spin_duration
+        self.max_spin_time = max(self.max_spin_time, spin_duration)
+
+    def get_values(self):
+        ''' Retrieves values of aggregated fields for this task. '''
+        has_handoff = self.handoff_gap is not None
+        has_wait = self.queue_wait is not None
+        return (1, time() - self.start_time, self.spins, self.spin_time, self.max_spin_time,
+                self.state_bytes, self.serialization_time, int(has_handoff),
+                self.handoff_gap or 0.0, self.handoff_gap or 0.0,
+                int(has_wait), self.queue_wait or 0.0, self.queue_wait or 0.0)
+
+
+def record_tasks(task_metrics):
+    '''
+    Adds metrics of finished tasks to the aggregates of their workers,
+    worker classes and priority lanes.
+    @param task_metrics: List of pairs: (worker, TaskMetrics)
+    '''
+    if not task_metrics:    return
+    class_names = set(_get_class_name(worker) for worker, _ in task_metrics)
+    keys = [_CLASSES_MEMCACHE_KEY] \
+           + [_CLASS_METRICS_MEMCACHE_KEY % {'class': class_name} for class_name in class_names] \
+           + [_WORKER_METRICS_MEMCACHE_KEY % {'id': worker._id} for worker, _ in task_metrics] \
+           + [_LANE_METRICS_MEMCACHE_KEY % {'lane': lane}
+              for lane in set(metrics.lane for _, metrics in task_metrics if metrics.lane)]
+    records = _get_records(keys)
+
+    now = time()
+    updated = {}
+    for worker, metrics in task_metrics:
+        values = metrics.get_values()
+        class_key = _CLASS_METRICS_MEMCACHE_KEY % {'class': _get_class_name(worker)}
+        class_record = updated.get(class_key) or records.get(class_key) or _new_record()
+        _aggregate(class_record, values, metrics.invocation, now)
+        worker_ids = class_record[_WORKER_IDS]
+        if worker._id in worker_ids:
+            worker_ids.remove(worker._id)
+        worker_ids.insert(0, worker._id)
+        del worker_ids[config.METRICS_MAX_WORKERS:]
+        updated[class_key] = class_record
+
+        worker_key = _WORKER_METRICS_MEMCACHE_KEY % {'id': worker._id}
+        worker_record = updated.get(worker_key) or records.get(worker_key) or _new_record()
+        _aggregate(worker_record, values, metrics.invocation, now)
+        updated[worker_key] = worker_record
+        
+        if metrics.lane:
+            lane_key = _LANE_METRICS_MEMCACHE_KEY % {'lane': metrics.lane}
+            lane_record = updated.get(lane_key) or records.get(lane_key) or _new_record()
+            _aggregate(lane_record, values, metrics.invocation, now)
+            updated[lane_key] = lane_record
+
+    known_classes = records.get(_CLASSES_MEMCACHE_KEY) or []
+    if not class_names.issubset(known_classes):
+        updated[_CLASSES_MEMCACHE_KEY] = sorted(class_names.union(known_classes))
+    memcache.set_multi(updated, config.METRICS_LIFETIME, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+
+
+def get_stats(include_workers = False):
+    '''
+    Retrieves the aggregated metrics.
+    @param include_workers: Whether to include metrics of individual workers
+                            (up to config.METRICS_MAX_WORKERS most recent ones per class)
+    @return: Dictionary with 'classes', 'lanes' (and 'workers') dictionaries of statistics.
+             Statistics of lanes include the occupancy of their queues.
+    '''
+    class_names = memcache.get(_CLASSES_MEMCACHE_KEY, namespace = config.MEMCACHE_NAMESPACE) or [] #@UndefinedVariable
+    class_keys = dict((_CLASS_METRICS_MEMCACHE_KEY % {'class': class_name}, class_name)
+                      for class_name in class_names)
+    lane_keys = dict((_LANE_METRICS_MEMCACHE_KEY % {'lane': lane}, lane) for lane, _ in config.PRIORITY_LANES)
+    records = _get_records(class_keys.keys() + lane_keys.keys())
+
+    stats = {'classes': dict((class_keys[key], _summarize(records[key]))
+                             for key in class_keys if key in records)}
+    lane_stats = lanes.get_occupancy()
+    for key, lane in lane_keys.iteritems():
+        if key in records:
+            lane_stats.setdefault(lane, {}).update(_summarize(records[key]))
+    stats['lanes'] = lane_stats
+    
+    if include_workers:
+        worker_keys = dict((_WORKER_METRICS_MEMCACHE_KEY % {'id': worker_id}, worker_id)
+                           for key in class_keys if key in records for worker_id in records[key][_WORKER_IDS])
+        worker_records = _get_records(worker_keys.keys())
+        stats['workers'] = dict((worker_keys[key], _summarize(record))
+                                for key, record in worker_records.iteritems())
+    return stats
+
+
+def _get_records(keys):
+    ''' Fetches aggregate records, skipping those of outdated format. '''
+    records = memcache.get_multi(keys, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+    record_length = len(_new_record())
+    return dict((key, record) for key, record in records.iteritems()
+                if key == _CLASSES_MEMCACHE_KEY or len(record) == record_length)
+
+
+def _new_record():
+    return [0.0] * len(_FIELDS) + [0, 0, 0.0, []]
+
+def _aggregate(record, values, invocation, now):
+    ''' Updates rolling aggregate record with values of single task. '''
+    decay = config.METRICS_DECAY
+    for i, field in enumerate(_FIELDS):
+        if field.startswith('max_'):
+            record[i] = max(record[i] * decay, values[i])
+        else:
+            record[i] = record[i] * decay + values[i]
+    record[_TASKS_TOTAL] += 1
+    record[_INVOCATION] = max(record[_INVOCATION], invocation)
+    record[_UPDATED_AT] = now
+
+def _summarize(record):
+    ''' Converts aggregate record into dictionary of statistics. '''
+    aggregates = dict(zip(_FIELDS, record))
+    tasks, spins, handoffs, waits = aggregates['tasks'], aggregates['spins'], aggregates['handoffs'], aggregates['waits']
+    per = lambda value, count: value / count if count else None
+    return {
+        'tasks': record[_TASKS_TOTAL],
+        'max_invocation': record[_INVOCATION],
+        'updated_at': record[_UPDATED_AT],
+        'mean_task_time': per(aggregates['task_time'], tasks),
+        'mean_idle_time': per(aggregates['task_time'] - aggregates['spin_time'], tasks),
+        'spins_per_task': per(spins, tasks),
+        'mean_spin_time': per(aggregates['spin_time'], spins),
+        'max_spin_time': aggregates['max_spin_time'],
+        'mean_state_bytes': per(aggregates['state_bytes'], tasks),
+        'mean_serialization_time': per(aggregates['serialization_time'], tasks),
+        'mean_handoff_gap': per(aggregates['handoff_gap'], handoffs),
+        'max_handoff_gap': aggregates['max_handoff_gap'],
+        'mean_queue_wait': per(aggregates['queue_wait'], waits),
+        'max_queue_wait': aggregates['max_queue_wait'],
+    }
+
+def _get_class_name(worker):
+    return "%s.%s" % (worker.__class__.__module__, worker.__class__.__name__)
@@ -0,0 +1,109 @@
+'''
+Write-behind buffer of datastore mutations made by workers.
+
+Instead of writing entities one by one, worker puts them into its buffer
+(Worker.mutations), which writes them in batches with asynchronous RPCs,
+while the worker carries on. The runner flushes the buffer before saving
+worker's state, so that the state never records progress beyond
+the data that has been written.
+
+Created on 2011-12-08
+
+@author: xion
+'''
+from gaeworkers import config
+from google.appengine.ext import db
+import logging
+
+
+class MutationBuffer(object):
+    '''
+    Buffer of entities to put into datastore and keys to delete from it.
+    Mutations are written when the buffer fills up, or when it's flushed.
+    At most one batch of writes is in flight at any time.
+    '''
+    def __init__(self, max_size = None):
+        '''
+        @param max_size: Number of buffered mutations after which they are written
+                         (config.MUTATION_BATCH_SIZE by default)
+        '''
+        self.max_size = max_size or config.MUTATION_BATCH_SIZE
+        self._puts = {}         # key (or id() of entity without key) -> entity
+        self._deletes = set()   # keys
+        self._rpcs = []         # RPCs of the batch being written
+
+    def __len__(self):
+        return len(self._puts) + len(self._deletes)
+
+    def put(self, entities):
+        '''
+        Buffers entities to be put into datastore.
+        @param entities: Entity or list of entities
+        @raise db.Error: If writing of previous batch has failed; this fails
+                         worker's task, which is then retried from last checkpoint
+        '''
+        for entity in _as_list(entities):
+            key = entity.key() if entity.has_key() else None
+            if key is not None:
+                self._deletes.discard(key)
+            self._puts[key or id(entity)] = entity
+        self._flush_if_full()
+
+    def delete(self, keys):
+        '''
+        Buffers deletion of entities from datastore.
+        @param keys: Key, entity or list of them
+        @raise db.Error: If writing of previous batch has failed (see put())
+        '''
+        for key in _as_list(keys):
+            if isinstance(key, db.Model):
+                key = key.key()
+            self._puts.pop(key, None)
+            self._deletes.add(key)
+        self._flush_if_full()
+
+    def _flush_if_full(self):
+        if len(self) >= self.max_size:
+            self.flush_async()
+
+    def flush_async(self):
+        '''
+        Starts writing buffered mutations, waiting for previous batch
+        to be written first.
+        @raise db.Error: If writing of previous batch has failed
+        '''
+        self.wait()
+        if self._puts:
+            self._rpcs.append(db.put_async(self._puts.values()))
+        if self._deletes:
+            self._rpcs.append(db.delete_async(list(self._deletes)))
+        self._puts = {}
+        self._deletes = set()
+
+    def flush(self):
+        '''
+        Writes all buffered mutations, waiting until they are written.
+        @raise db.Error: If writing has failed
+        '''
+        self.flush_async()
+        self.wait()
+
+    def wait(self):
+        '''
+        Waits for the batch being written (if any).
+        @raise db.Error: If writing has failed
+        '''
+        rpcs, self._rpcs = self._rpcs, []
+        errors = []
+        for rpc in rpcs:
+            try:
+                rpc.get_result()
+            except db.Error, e:
+                logging.error("[gae-workers] Failed to write buffered mutations: %s", e)
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+
+def _as_list(objects):
+    return objects if isinstance(objects, (list, tuple)) else [objects]
@@ -0,0 +1,115 @@
+'''
+Iteration over datastore queries which survives worker's handoffs
+between tasks.
+
+Since worker's run() is invoked from the beginning in every task, plain
+iteration over a query would start from its first entity each time.
+Iterators from this module keep datastore cursor in worker's state
+instead, so that query is resumed where previous task has left off.
+
+Created on 2011-12-07
+
+@author: xion
+'''
+from gaeworkers import config
+from google.appengine.ext import db
+from time import time
+import collections
+import itertools
+
+
+def iterate(worker, query, cursor_attr = 'query_cursor', batch_size = None):
+    '''
+    Iterates over results of datastore query, recording the position
+    in worker's state. When run() is invoked again in next task,
+    iteration continues after the last entity that was returned.
+    @param worker: Worker whose state keeps the cursor
+    @param query: db.Query or db.GqlQuery object; it should be created anew
+                  in every run() rather than kept in worker's state
+    @param cursor_attr: Worker's attribute holding the cursor. Workers iterating
+                        over several queries must use different attributes.
+    @param batch_size: Number of entities fetched by single datastore call
+                       (config.QUERY_BATCH_SIZE by default)
+    @note: Entity counts as processed once it's returned, so worker should
+           yield only after it has finished with the entity.
+    '''
+    cursor = getattr(worker, cursor_attr, None)
+    if cursor:
+        query.with_cursor(cursor)
+    for entity in query.run(batch_size = batch_size or config.QUERY_BATCH_SIZE):
+        setattr(worker, cursor_attr, query.cursor())
+        yield entity
+
+
+def prefetch(worker, query, cursor_attr = 'query_cursor', batch_size = None, depth = None):
+    '''
+    Iterates over entities matching keys-only datastore query, like iterate(),
+    but fetches the entities in batches ahead of time: next batches are being
+    fetched asynchronously while the worker processes the current one.
+    
+    Batches are fetched in advance only if the worker is likely to process them
+    before task's deadline, judging by the time it has taken to process entities
+    so far. Entities that were fetched but not processed when task ends
+    are not kept in worker's state; they are fetched again in next task.
+    @param query: Keys-only db.Query or db.GqlQuery object
+    @param batch_size: Number of entities in a batch (config.QUERY_BATCH_SIZE by default)
+    @param depth: Maximum number of batches fetched in advance
+                  (config.QUERY_PREFETCH_DEPTH by default)
+    @note: Unlike in iterate(), entity counts as processed only when the worker
+           asks for the next one. Entity interrupted by the deadline is therefore
+           returned again in next task, and so is the one the worker yields after
+           (if the task is handed off there).
+    @note: Entities deleted after their keys have been fetched are skipped.
+    @raise ValueError: If the query is not keys-only
+    '''
+    if not query.is_keys_only():
+        raise ValueError("Prefetching requires keys-only query")
+    batch_size = batch_size or config.QUERY_BATCH_SIZE
+    depth = depth or config.QUERY_PREFETCH_DEPTH
+    
+    cursor = getattr(worker, cursor_attr, None)
+    if cursor:
+        query.with_cursor(cursor)
+    keys = query.run(batch_size = batch_size)
+    
+    def fetch_batch():
+        ''' Starts fetching next batch of entities. Returns pair (RPC, cursors) or None. '''
+        batch_keys, cursors = [], []
+        for key in itertools.islice(keys, batch_size):
+            batch_keys.append(key)
+            cursors.append(query.cursor())
+        return (db.get_async(batch_keys), cursors) if batch_keys else None
+    
+    pending = collections.deque()   # batches fetched in advance
+    item_time = None                # average time of processing an entity
+    exhausted = False
+    batch = fetch_batch()
+    while batch:
+        # entities to process before the next batch fetched in advance: current and pending batches
+        while not exhausted and len(pending) < depth \
+              and _can_buffer(worker, (len(pending) + 2) * batch_size, item_time):
+            next_batch = fetch_batch()
+            if next_batch:  pending.append(next_batch)
+            exhausted = not next_batch or len(next_batch[1]) < batch_size
+        
+        rpc, cursors = batch
+        for entity, cursor in zip(rpc.get_result(), cursors):
+            if entity is not None:
+                start_time = time()
+                yield entity
+                duration = time() - start_time
+                item_time = duration if item_time is None else 0.9 * item_time + 0.1 * duration
+            setattr(worker, cursor_attr, cursor)    # only once the worker is done with the entity
+        
+        batch = pending.popleft() if pending else (None if exhausted else fetch_batch())
+
+
+def _can_buffer(worker, count, item_time):
+    '''
+    Checks whether worker can process given number of buffered entities
+    before task's deadline (set by the runner in worker._deadline).
+    '''
+    deadline = getattr(worker, '_deadline', None)
+    if deadline is None or item_time is None:
+        return True
+    return count * item_time <= deadline - time() - config.SAFETY_MARGIN
@@ -0,0 +1,105 @@
+'''
+Rate limits of resources shared by workers, such as datastore kinds
+written by many of them or external services (see config.RATE_LIMITS).
+
+Every resource has a token bucket shared by all workers, which take tokens
+from it before using the resource (see Worker.THROTTLE). Bucket is a memcache
+counter of tokens taken in current refill period, incremented atomically,
+so workers don't contend for it the way they would with read-modify-write.
+Bucket is refilled in full at the start of every period.
+
+Workers that don't get their tokens reserve them in a later period instead,
+judging by how many others are waiting ahead of them. They are told how long
+to wait for it, so that they don't all come back at the start of next period
+only to find the bucket empty again.
+
+Created on 2011-12-12
+
+@author: xion
+'''
+from gaeworkers import config
+from google.appengine.api import memcache
+from time import time
+import logging
+
+
+_BUCKET_MEMCACHE_KEY = "ratelimit://%(resource)s/%(period)s"
+
+# maximum number of later periods tried when reserving tokens
+_MAX_RESERVATION_ATTEMPTS = 5
+
+
+def get_limit(resource):
+    '''
+    Retrieves the rate limit of given resource.
+    @return: Pair: (tokens per second, bucket size)
+    @raise ValueError: If the resource has no rate limit defined
+    '''
+    try:
+        rate, bucket_size = config.RATE_LIMITS[resource]
+    except KeyError:
+        raise ValueError("No rate limit defined for resource: %s" % resource)
+    return (float(rate), int(bucket_size))
+
+
+def acquire(resource, tokens = 1, reservation = None):
+    '''
+    Takes tokens from resource's bucket. If there are not enough of them,
+    they are reserved in a later refill period, if possible.
+    If memcache is unavailable, tokens are granted, so that workers are not stalled by it.
+    @param resource: Name of the resource (key of config.RATE_LIMITS)
+    @param tokens: Number of tokens to take
+    @param reservation: Reservation returned by previous call for the same tokens;
+                        they are granted without taking them again once it's due
+    @return: Pair: (wait, reservation). Wait is 0 if tokens have been granted;
+             otherwise it's the number of seconds after which they are likely
+             to be available, and reservation (or None, if the tokens could not
+             be reserved) is to be passed to the call made after that time.
+    @raise ValueError: If the resource has no rate limit defined, or more tokens
+                       are requested than its bucket holds
+    '''
+    rate, bucket_size = get_limit(resource)
+    if not 0 < tokens <= bucket_size:
+        raise ValueError("Cannot take %s tokens from bucket of %s (size=%s)" % (tokens, resource, bucket_size))
+
+    period_length = bucket_size / rate
+    now = time()
+    period = int(now / period_length)
+    if reservation is not None:
+        if reservation <= period:
+            return (0, None)
+        return (reservation * period_length - now, reservation)
+
+    taken = _take(resource, period, tokens, period_length)
+    if taken is None:
+        logging.warning("[gae-workers] Could not take tokens of %s; proceeding without rate limit", resource)
+        return (0, None)
+    if taken <= bucket_size:
+        return (0, None)
+
+    # tokens taken over bucket's size are those requested by workers waiting in line;
+    # periods where they're reserved may be taken by others, though, so later ones are tried as well
+    reserved_period = period + 1 + (taken - bucket_size - 1) // bucket_size
+    for _ in xrange(_MAX_RESERVATION_ATTEMPTS):
+        taken = _take(resource, reserved_period, tokens, period_length)
+        if taken is not None and taken <= bucket_size:
+            return (reserved_period * period_length - now, reserved_period)
+        reserved_period += 1
+    return (reserved_period * period_length - now, None)
+
+
+def _take(resource, period, tokens, period_length):
+    '''
+    Takes tokens from resource's bucket for given refill period.
+    @return: Number of tokens taken in the period so far (including these),
+             or None if memcache is unavailable
+    '''
+    key = _BUCKET_MEMCACHE_KEY % {'resource': resource, 'period': period}
+    taken = memcache.incr(key, delta = tokens, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+    if taken is None:   # first taker in this period
+        # bucket is kept until its period ends (it may be created in advance by reservations)
+        lifetime = int((period + 1) * period_length - time()) + 1
+        if memcache.add(key, tokens, lifetime, namespace = config.MEMCACHE_NAMESPACE): #@UndefinedVariable
+            return tokens
+        taken = memcache.incr(key, delta = tokens, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+    return taken
@@ -0,0 +1,98 @@
+'''
+Module for passing results from workers back to their clients.
+
+Worker publishes a result with Worker.PUBLISH_RESULT call, under
+an ID of the request it responds to (typically passed to the worker
+in a message). Client waits for it with wait_result() or wait_results().
+
+Created on 2011-11-29
+
+@author: xion
+'''
+from gaeworkers import codec, config, data
+from google.appengine.api import memcache
+import hashlib
+import logging
+import time
+import uuid
+
+
+class ResultTimeout(Exception):
+    ''' Exception signaling that result hasn't been published before the deadline. '''
+    pass
+
+
+_RESULT_MEMCACHE_KEY = "worker://%(id)s/results/%(request_id)s"
+
+
+def new_request_id():
+    ''' Generates unique ID for a request whose result is to be waited for. '''
+    return hashlib.md5(uuid.uuid4().bytes).hexdigest()
+
+
+def publish_result(worker_id, request_id, result):
+    '''
+    Publishes the result of request handled by worker.
+    This is used by the runner to handle Worker.PUBLISH_RESULT call.
+    @return: Whether the result was published
+    '''
+    try:
+        payload = codec.encode(result)
+    except data.DataError, e:
+        logging.error("[gae-workers] Could not publish result of request %s of worker (ID=%s): %s",
+                      request_id, worker_id, e)
+        return False
+
+    mc_key = _RESULT_MEMCACHE_KEY % {'id': worker_id, 'request_id': request_id}
+    return memcache.set(mc_key, payload, config.MEMCACHE_RESULT_LIFETIME, #@UndefinedVariable
+                        namespace = config.MEMCACHE_NAMESPACE)
+
+
+def wait_result(worker_id, request_id, timeout = None):
+    '''
+    Waits for the result of request handled by worker.
+    @param timeout: Maximum number of seconds to wait; config.RESULT_WAIT_TIMEOUT by default
+    @return: Result published by the worker
+    @raise ResultTimeout: If the result hasn't been published in time
+    '''
+    results = wait_results(worker_id, [request_id], timeout)
+    if request_id not in results:
+        raise ResultTimeout("No result of request %s from worker (ID=%s)" % (request_id, worker_id))
+    return results[request_id]
+
+
+def wait_results(worker_id, request_ids, timeout = None):
+    '''
+    Waits for the results of several requests handled by worker.
+    Memcache is polled with exponentially growing delays, starting with
+    config.RESULT_POLL_MIN_DELAY; all pending results are checked at once.
+    Retrieved results are removed from memcache.
+    @param timeout: Maximum number of seconds to wait; config.RESULT_WAIT_TIMEOUT by default
+    @return: Dictionary mapping request IDs to results. When the time runs out,
+             requests whose results haven't been published are missing from it.
+    '''
+    deadline = time.time() + (timeout if timeout is not None else config.RESULT_WAIT_TIMEOUT)
+    pending_keys = dict((_RESULT_MEMCACHE_KEY % {'id': worker_id, 'request_id': request_id}, request_id)
+                        for request_id in request_ids)
+
+    results = {}
+    delay = config.RESULT_POLL_MIN_DELAY
+    while True:
+        payloads = memcache.get_multi(pending_keys.keys(), namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+        if payloads:
+            memcache.delete_multi(payloads.keys(), namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+            for key, payload in payloads.iteritems():
+                request_id = pending_keys.pop(key)
+                try:
+                    results[request_id] = codec.decode(payload)
+                except data.DataError, e:
+                    logging.error("[gae-workers] Invalid result of request %s of worker (ID=%s): %s",
+                                  request_id, worker_id, e)
+
+        time_left = deadline - time.time()
+        if not pending_keys or time_left <= 0:
+            break
+        time.sleep(min(delay, time_left))
+        delay = min(delay * 2, config.RESULT_POLL_MAX_DELAY)
+
+    return results
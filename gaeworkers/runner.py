@@ -7,19 +7,23 @@ Created on 2011-08-31
 
 @author: xion
 '''
-from gaeworkers import config, data
-from gaeworkers.worker import _TASK_HEADER_INVOCATION, _WORKER_MESSAGES_MEMCACHE_KEY
+from gaeworkers import config, estimator, fork, lanes, metrics, ratelimit, results, state, tasks
+from gaeworkers.budget import Budget
+from gaeworkers.lease import Lease, LeaseError
+from gaeworkers.mailbox import Mailbox
+from gaeworkers.worker import _TASK_HEADER_INVOCATION, _TASK_HEADER_PRIORITY, _TASK_HEADER_STATE, \
+                              _TASK_HEADER_WAKEUP, _create_multiplexed_task
 from datetime import datetime, timedelta
-from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.runtime import DeadlineExceededError
-from time import time
+from time import sleep, time
 import webapp2
 import inspect
+import json
 import logging
+import math
 
 
-_WORKER_STATE_MEMCACHE_KEY = "worker://%(id)s/state"
-
 class WorkerHandler(webapp2.RequestHandler):
     '''
     Request handler for workers. It is invoked by the GAE taskqueue
@@ -34,18 +38,24 @@ class WorkerHandler(webapp2.RequestHandler):
         @note: Fatal (irrecoverable) exceptions shall be caught and quenched
                to avoid the task being queued again.
         '''
+        self.start_time = time()
+        
         worker_class_name = self.request.GET.get('class')
         if not worker_class_name:
             logging.error('[gae-workers] No worker class name provided')
             return
         worker_id = self.request.GET.get('id')
-        if not worker_id:
+        worker_ids = self.request.GET.get('ids')
+        if not (worker_id or worker_ids):
             logging.error('[gae-workers] No worker ID provided')
             return
         
         worker_class = self._import_worker_class(worker_class_name)
         if worker_class:
-            self.execute_worker(worker_id, worker_class)
+            if worker_ids:
+                self.execute_workers(worker_ids.split(','), worker_class)
+            else:
+                self.execute_worker(worker_id, worker_class)
         
     def _import_worker_class(self, worker_class_name):
         '''
@@ -77,9 +87,27 @@ class WorkerHandler(webapp2.RequestHandler):
         '''
         worker_name = self.request.headers['X-AppEngine-TaskName']
         worker = class_obj(worker_name, worker_id)
+        if not self.acquire_leases([worker]):
+            return
+        try:
+            self.run_worker_task(worker)
+        except:
+            self.release_leases([worker], abandon = True)
+            raise
+        self.release_leases([worker])
         
-        self.restore_worker_state(worker)
-        if not worker._first_run:
+    def run_worker_task(self, worker):
+        '''
+        Runs given worker in this task, restoring its state first
+        and handing it off to next task if it doesn't finish.
+        '''
+        if self.request.headers.get(_TASK_HEADER_WAKEUP):
+            Mailbox(worker._id).unpark()
+        
+        if not self.restore_handed_off_state([worker]):
+            return
+        self.start_metrics([worker])
+        if worker._first_run:
             logging.debug("[gae-workers] Initializing state of worker '%s'", worker._name)
             worker.setup()
 
@@ -87,17 +115,62 @@ class WorkerHandler(webapp2.RequestHandler):
             if not inspect.isgeneratorfunction(worker.run):
                 logging.warning("[gae-workers] Worker's run() is not a generator function")
                 worker.run()
+                self.finish_worker(worker)
                 finished = True
             else:
                 logging.debug("[gae-worker] Running worker '%s'", worker._name)
                 finished = self.run_worker(worker)
         except DeadlineExceededError:
             logging.warning('[gae-workers] Task deadline exceeded for worker %s', worker._name)
-            self.save_worker_state(worker)
             finished = False
             
         if not finished:
-            self.schedule_worker_execution(worker)            
+            self.handoff_workers([worker])
+        self.record_metrics([worker])
+        
+    def execute_workers(self, worker_ids, class_obj):
+        '''
+        Commences execution of several workers of the same class, which are run
+        in turns within this task. Their state is restored and saved in batches.
+        @param worker_ids: IDs of the workers
+        @param class_obj: Worker class
+        '''
+        workers = self.acquire_leases([class_obj(None, worker_id) for worker_id in worker_ids])
+        if not workers:
+            return
+        try:
+            self.run_workers_task(workers)
+        except:
+            self.release_leases(workers, abandon = True)
+            raise
+        self.release_leases(workers)
+        
+    def run_workers_task(self, workers):
+        '''
+        Runs given workers of the same class in turns within this task
+        (see run_worker_task()).
+        '''
+        class_obj = workers[0].__class__
+        workers = self.restore_handed_off_state(workers)
+        if not workers:
+            return
+        self.start_metrics(workers)
+        for worker in workers:
+            if worker._first_run:
+                logging.debug("[gae-workers] Initializing state of worker (ID=%s)", worker._id)
+                worker.setup()
+        
+        if not inspect.isgeneratorfunction(class_obj.run):
+            logging.warning("[gae-workers] Worker's run() is not a generator function")
+            for worker in workers:
+                worker.run()
+                self.finish_worker(worker)
+        else:
+            logging.debug("[gae-worker] Running %s workers of class %s", len(workers), class_obj.__name__)
+            unfinished_workers = self.run_workers(workers)
+            if unfinished_workers:
+                self.handoff_workers(unfinished_workers)
+        self.record_metrics(workers)
         
     def run_worker(self, worker):
         '''
@@ -105,78 +178,424 @@ class WorkerHandler(webapp2.RequestHandler):
         the time it takes and estimating the remaining time until deadline.
         This is the main method of the workers' runner.
         @param worker: Worker object to run. Its run() method shall be a generator function.
-        @return: Whether worker's execution shall be continued
+        @return: Whether worker's execution is over in this task; if it's not, worker
+                 shall be handed off to next task (see handoff_workers())
         '''
         worker_run = worker.run()
         api_result = self.NULL
-        finished = False
         
-        # initialize measurement/statistical variables
-        estimated_time_left = config.DEADLINE_SECONDS
-        total_running_time = 0
-        spins_count = 0
-        max_spin_time = max_running_average = 0
+        spin_estimator = self.get_deadline_estimator(worker)
+        self.deadline = (getattr(self, 'start_time', None) or time()) + config.DEADLINE_SECONDS
+        worker._deadline = self.deadline
+        worker._budgeted_spin = False
+        worker._checkpoint_at, worker._checkpoint_spins = time(), 0
+        
+        while True:
+            api_result, runner_action = self.spin_worker(worker, worker_run, api_result)
+            if runner_action == "finish":       return True
+            elif runner_action == "defer":      return False
+            elif runner_action == "terminate":  return True # pretend worker has finished
+            
+            # if we don't seem to manage to squeeze in another spin, we finish this task
+            if self.deadline - time() - (spin_estimator.estimate() + self.get_safety_margin(worker)) <= 0:
+                return False
+    
+    def run_workers(self, workers):
+        '''
+        Spins run() methods of several workers in turns (round-robin),
+        until they finish or the deadline approaches.
+        @param workers: Worker objects to run. Their run() methods shall be generator functions.
+        @return: List of workers whose execution shall be continued in next task
+                 (see handoff_workers())
+        '''
+        self.deadline = (getattr(self, 'start_time', None) or time()) + config.DEADLINE_SECONDS
+        running = []    # list of [worker, its run() generator, api_result]
+        for worker in workers:
+            self.get_deadline_estimator(worker)
+            worker._deadline = self.deadline
+            worker._budgeted_spin = False
+            worker._checkpoint_at, worker._checkpoint_spins = time(), 0
+            running.append([worker, worker.run(), self.NULL])
+        
+        deferred_workers = []
+        try:
+            while running:
+                for spin in list(running):
+                    worker, worker_run, api_result = spin
+                    if self.deadline - time() - (worker._deadline_estimator.estimate()
+                                                 + self.get_safety_margin(worker)) <= 0:
+                        break
+                    
+                    spin[2], runner_action = self.spin_worker(worker, worker_run, api_result)
+                    if runner_action:
+                        running.remove(spin)
+                        if runner_action == "defer":
+                            deferred_workers.append(worker)
+                else:
+                    continue
+                break   # next spin won't fit before the deadline
+        except DeadlineExceededError:
+            logging.warning('[gae-workers] Task deadline exceeded for %s worker(s)', len(running))
         
-        current_time = time()
-        while estimated_time_left > 0:
+        return deferred_workers + [worker for worker, _, _ in running]
+    
+    def spin_worker(self, worker, worker_run, api_result):
+        '''
+        Performs single spin of worker's run() method, handling the "API" call
+        the worker makes (if any) and measuring how long the spin takes.
+        @param worker_run: Generator returned by worker's run()
+        @param api_result: Result of previous "API" call, to be sent to the worker
+        @return: Pair: (api_result, runner_action), where the latter is None if the worker
+                 can be spun further, "finish" if the worker has finished, or runner action
+                 returned by invoke_worker_api() other than "proceed"
+        '''
+        # spin following TIME_LEFT call is sized by the worker itself,
+        # so it doesn't tell much about typical spin duration
+        budgeted_spin = worker._budgeted_spin
+        worker._budgeted_spin = False
+        # periodic checkpoint started after previous spin is only there once its index is written,
+        # and the task may hit its deadline during this one
+        self.finish_checkpoint(worker)
+        spin_start_time = time()
+        
+        try:
+            # proceed with next iteration and see whether the worker wants to call our "API"
+            api_call = worker_run.next() \
+                        if api_result is self.NULL \
+                        else worker_run.send(api_result)
+        except StopIteration:
+            logging.info("[gae-workers] '%s' finished", worker._name or worker._id)
+            self.finish_worker(worker)
+            return (self.NULL, "finish")
+        
+        api_result = self.NULL
+        if api_call:
             try:
-                # proceed with next iteration and see whether the worker wants to call our "API"
-                api_call = worker_run.next() \
-                            if api_result is self.NULL \
-                            else worker_run.send(api_result) 
-                if api_call:
-                    try:
-                        api_name, api_params = api_call
-                        api_result, runner_action = self.invoke_worker_api(worker, api_name, *api_params)
-                            
-                        # proceed with execution or terminate task/worker
-                        if runner_action == "proceed":  pass
-                        elif runner_action == "defer":  return False
-                        elif runner_action == "terminate":  return True # pretend worker has finished                        
-                    except ValueError:
-                        logging.warning("[gae-workers] Invalid API call coming from worker %s (ID=%s): %s",
-                                        worker._name, worker._id, api_call)
-                        
-                spin_finish_time = time()
-                spin_duration = spin_finish_time - current_time
-                current_time = spin_finish_time # intentionally including our own control code in measurement
-                total_running_time += spin_duration
-                spins_count += 1
-                
-                # update statistics
-                max_spin_time = max(max_spin_time, spin_duration)
-                running_average = total_running_time / float(spins_count)
-                max_running_average = max(max_running_average, running_average)
-                
-                # if we don't seem to manage to squeeze in another spin, we finish this task
-                if estimated_time_left - (max_running_average + config.SAFETY_MARGIN) <= 0:
-                    break
-                
-                estimated_time_left -= spin_duration
-            except StopIteration:
-                logging.info("[gae-workers] '%s' finished", worker._name)
-                finished = True
-                break
+                api_name, api_params = api_call
+                api_result, runner_action = self.invoke_worker_api(worker, api_name, *api_params)
+                if runner_action != "proceed":
+                    return (api_result, runner_action)
+            except ValueError:
+                logging.warning("[gae-workers] Invalid API call coming from worker %s (ID=%s): %s",
+                                worker._name, worker._id, api_call)
         
-        if not finished:        
-            self.save_worker_state(worker)
-        return finished
+        # intentionally including our own control code in measurement
+        spin_duration = time() - spin_start_time
+        worker._task_metrics.observe_spin(spin_duration)
+        if not budgeted_spin:
+            worker._deadline_estimator.observe(spin_duration)
+        self.checkpoint_worker(worker)
+        # lease has to outlast next spin, which may take all the time left if it's sized by the worker
+        next_spin = self.deadline - time() if worker._budgeted_spin else worker._deadline_estimator.estimate()
+        worker._lease.renew(next_spin)
+        return (api_result, None)
+    
+    def checkpoint_worker(self, worker):
+        '''
+        Starts periodic checkpoint of worker's state, if it's due
+        (see config.CHECKPOINT_INTERVAL and config.CHECKPOINT_SPINS).
+        State is written asynchronously until worker's next spin starts (see spin_worker()),
+        e.g. while other workers of the task spin.
+        '''
+        interval, spins = config.CHECKPOINT_INTERVAL, config.CHECKPOINT_SPINS
+        worker._checkpoint_spins += 1
+        if not ((interval and time() - worker._checkpoint_at >= interval)
+                or (spins and worker._checkpoint_spins >= spins)):
+            return
+        
+        self.finish_checkpoint(worker)
+        start_time = time()
+        worker._checkpoint_at, worker._checkpoint_spins = start_time, 0
+        self.prepare_workers_save([worker])
+        pending_save = state.save_states_async([worker], config.MEMCACHE_DATA_LIFETIME)
+        worker._pending_checkpoint = (pending_save, time() - start_time)
+        
+    def finish_checkpoint(self, worker):
+        ''' Completes periodic checkpoint of the worker, if there's one in progress. '''
+        pending_checkpoint = worker.__dict__.pop('_pending_checkpoint', None)
+        if pending_checkpoint:
+            pending_save, start_duration = pending_checkpoint
+            start_time = time()
+            if not pending_save.get_result()[0]:
+                logging.warning("[gae-workers] Periodic checkpoint of worker '%s' (ID=%s) has failed",
+                                worker._name, worker._id)
+            self.observe_checkpoint_time(worker, start_duration + time() - start_time)
+    
+    def observe_checkpoint_time(self, worker, duration):
+        '''
+        Records the time (in seconds) runner has spent on checkpoint of worker's state,
+        which is taken into account by get_safety_margin().
+        '''
+        # slowest recent checkpoint, forgotten gradually
+        checkpoint_time = worker._runner_data.get('checkpoint_time', 0.0)
+        worker._runner_data['checkpoint_time'] = max(duration, 0.9 * checkpoint_time)
+    
+    def get_safety_margin(self, worker):
+        '''
+        Retrieves the number of seconds reserved before the deadline for saving
+        worker's state and handing it off to next task: config.SAFETY_MARGIN,
+        or more if worker's checkpoints take long.
+        '''
+        return max(config.SAFETY_MARGIN, 2 * worker._runner_data.get('checkpoint_time', 0.0))
+    
+    def get_deadline_estimator(self, worker):
+        '''
+        Creates deadline estimator for the worker, restoring its statistics
+        from previous tasks if possible.
+        @return: DeadlineEstimator object, also stored in worker._deadline_estimator
+        '''
+        name = worker.deadline_estimator or config.DEADLINE_ESTIMATOR
+        saved_estimator = getattr(worker, '_runner_data', {}).get('estimator')
+        saved_state = saved_estimator[1] if saved_estimator and saved_estimator[0] == name else None
+        
+        worker._deadline_estimator = estimator.create_estimator(name, saved_state)
+        return worker._deadline_estimator
+    
+    def start_metrics(self, workers):
+        '''
+        Starts measuring runtime metrics of workers in current task.
+        Metrics are kept in worker._task_metrics and recorded by record_metrics().
+        '''
+        start_time = getattr(self, 'start_time', None) or time()
+        task_eta = self.request.headers.get('X-AppEngine-TaskETA')
+        queue_wait = max(start_time - float(task_eta), 0) if task_eta else None
+        for worker in workers:
+            # set when previous task has saved the state for this one (see save_workers_state())
+            resume_at = worker._runner_data.pop('resume_at', None)
+            handoff_gap = max(start_time - resume_at, 0) if resume_at is not None else None
+            lane = None if worker.queue_name else self.get_priority(worker)
+            worker._task_metrics = metrics.TaskMetrics(self.get_invocation(), handoff_gap, queue_wait, lane)
+    
+    def record_metrics(self, workers):
+        ''' Records runtime metrics of workers at the end of current task. '''
+        for worker in workers:
+            task_metrics = worker._task_metrics
+            task_metrics.state_bytes = sum(getattr(worker, '_state_sizes', {}).itervalues())
+            task_metrics.serialization_time = getattr(worker, '_serialization_time', 0.0)
+        metrics.record_tasks([(worker, worker._task_metrics) for worker in workers])
     
     def schedule_worker_execution(self, worker, delay = None):
         '''
         Queues up a next task that is to carry on execution of specified worker.
         @param delay: Whether the task should be delayed (timedelta object or None) 
+        @raise taskqueue.Error: If the task could not be added; current task shall then
+                                fail, so that it's retried
         '''
-        queue_name = self.request.headers['X-AppEngine-QueueName']
-        invocation = self.request.headers.get(_TASK_HEADER_INVOCATION, 1)
+        priority, queue_name = self.get_next_lane([worker])
         eta = datetime.now() + delay if delay else None
         
-        task = worker._create_task(invocation + 1, eta)
-        task.add(queue_name)
+        invocation = self.get_invocation() + 1
+        task = worker._create_task(invocation, eta, name = "%s-%s" % (worker._id, invocation), priority = priority)
+        try:
+            tasks.add_task(queue_name, task)
+        except taskqueue.Error:
+            logging.error("[gae-workers] Could not enqueue worker '%s' (ID=%s) for further execution",
+                          worker._name, worker._id)
+            raise
         logging.debug("[gae-workers] Worker '%s' (ID=%s) enqueued for further execution",
                       worker._name, worker._id)
         
         
+    def handoff_workers(self, workers):
+        '''
+        Hands workers off to next task, which is to carry on their execution
+        (in turns, if there are several of them). Their state is saved concurrently
+        with adding the task, which carries the generations of saved states,
+        so that it can tell whether they have been written (see restore_handed_off_state()).
+        @return: Whether the workers have been handed off
+        @raise taskqueue.Error: If the task could not be added
+        '''
+        priority, queue_name = self.get_next_lane(workers, handoff = True)
+        start_time = time()
+        pending_save = self.start_workers_save(workers)
+        
+        invocation = self.get_invocation() + 1
+        if len(workers) == 1:
+            worker = workers[0]
+            task = worker._create_task(invocation, name = "%s-%s" % (worker._id, invocation),
+                                       state_generation = pending_save.generations[0], priority = priority)
+        else:
+            task = _create_multiplexed_task(workers, invocation, state_generations = pending_save.generations,
+                                            priority = priority)
+        pending_add = tasks.add_task_async(queue_name, task)
+        
+        saved = self.finish_workers_save(workers, pending_save, start_time)
+        try:
+            pending_add.get_result()
+        except taskqueue.Error:
+            # leases are abandoned as the task fails, so that its retry hands the workers off again
+            logging.error("[gae-workers] Could not enqueue %s worker(s) for further execution: %s",
+                          len(workers), ", ".join(worker._id for worker in workers))
+            raise
+        self.release_leases(workers)    # so that next task doesn't wait for them
+        if not all(saved):
+            # next task will wait for the state in vain, then settle for older one
+            logging.error("[gae-workers] State of %s worker(s) handed off to next task could not be saved",
+                          saved.count(False))
+        logging.debug("[gae-workers] %s worker(s) enqueued for further execution", len(workers))
+        return True
+        
+    def park_worker(self, worker, mailbox):
+        '''
+        Saves the worker state and leaves it waiting for messages, to be woken up
+        by the task added when a message is posted.
+        @param mailbox: Worker's mailbox
+        @return: Whether the worker has been parked
+        @raise taskqueue.Error: If messages arrived while parking, but the worker
+                                could not be woken up
+        '''
+        if not self.save_worker_state(worker, lifetime = config.PARKED_STATE_LIFETIME,
+                                      durable = True, resume_delay = None):
+            return False
+        
+        invocation = self.get_invocation()
+        task_name = "%s-wakeup-%s" % (worker._id, invocation)
+        priority, queue_name = self.get_next_lane([worker])
+        task_params = worker._get_task_params(invocation + 1, name = task_name, wakeup = True, priority = priority)
+        if not mailbox.park(queue_name, task_params):
+            return False
+        
+        # messages posted while we were parking might have missed it
+        if mailbox.has_messages():
+            mailbox.wake()
+        logging.debug("[gae-workers] Worker '%s' (ID=%s) is waiting for messages", worker._name, worker._id)
+        return True
+        
+    def fork_worker(self, worker, shards):
+        '''
+        Forks the worker into children, one for each shard, and leaves it waiting
+        until they all finish. When woken up, worker repeats its FORK call
+        which then returns the results of children.
+        @param shards: List of parts of work for the children
+        @return: Pair: (api_result, runner_action), as in invoke_worker_api()
+        @raise ForkError: If some children could not be started, or parent's state saved
+        @raise taskqueue.Error: If tasks of the children could not be added
+        '''
+        priority, queue_name = self.get_next_lane([worker])
+        invocation = self.get_invocation()
+        
+        pending_fork = worker._runner_data.get('fork')
+        if pending_fork:
+            fork_id, shards_count = pending_fork
+            fork_results = fork.collect_results(worker, fork_id, shards_count)
+            if fork_results is not None:
+                del worker._runner_data['fork']
+                return (fork_results, "proceed")
+            
+            # woken up too early (e.g. the task was retried); wait again
+            task_name = "%s-join-%s-%s" % (worker._id, fork_id, invocation)
+            task_params = worker._get_task_params(invocation + 1, name = task_name, priority = priority)
+            if not fork.rearm_barrier(worker, fork_id, queue_name, task_params):
+                logging.error("[gae-workers] Could not wait for children of worker '%s' (ID=%s)",
+                              worker._name, worker._id)
+                return (None, "proceed")
+            if fork.collect_results(worker, fork_id, shards_count) is not None:
+                fork.wake_parent(worker._id, fork_id)    # children have finished in the meantime
+            return (self.NULL, "terminate")
+        
+        shards = list(shards)
+        if not shards:  return ([], "proceed")
+        
+        fork_id = fork.new_fork_id()
+        task_name = "%s-join-%s-%s" % (worker._id, fork_id, invocation)
+        task_params = worker._get_task_params(invocation + 1, name = task_name, priority = priority)
+        if not fork.open_barrier(worker, fork_id, len(shards), queue_name, task_params):
+            logging.error("[gae-workers] Could not fork worker '%s' (ID=%s)", worker._name, worker._id)
+            return (None, "proceed")
+        
+        # parent's state records the fork only once all children have been started; if some can't be,
+        # the task fails and its retry forks anew (children started so far never complete this barrier)
+        children = fork.create_children(worker, fork_id, shards)
+        # children's state has to be there when their tasks run (see restore_workers_state())
+        if not all(self.save_workers_state(children, lifetime = config.PARKED_STATE_LIFETIME, durable = True)):
+            raise fork.ForkError("Could not save state of children of worker '%s' (ID=%s)"
+                                 % (worker._name, worker._id))
+        tasks.add_tasks(queue_name, [child._create_task(priority = priority) for child in children],
+                        raise_errors = True)
+        
+        worker._runner_data['fork'] = (fork_id, len(shards))
+        if not self.save_worker_state(worker, lifetime = config.PARKED_STATE_LIFETIME,
+                                      durable = True, resume_delay = None):
+            raise fork.ForkError("Could not save state of worker '%s' (ID=%s) waiting for its children"
+                                 % (worker._name, worker._id))
+        
+        logging.debug("[gae-workers] Worker '%s' (ID=%s) forked into %s children",
+                      worker._name, worker._id, len(shards))
+        return (self.NULL, "terminate")   # worker will be woken up by the last child to finish
+        
+    def get_next_lane(self, workers, handoff = False):
+        '''
+        Determines the priority lane of next task running given workers (see lanes.py).
+        Workers stay in the lane of current task, unless they are handed off
+        often enough to be demoted to lower one (see Worker.demote_after).
+        @param handoff: Whether workers are handed off after running out of time
+        @return: Pair: (priority, queue name); priority is None for workers
+                 with their own queue, which continue in the queue of current task
+        '''
+        worker = workers[0]
+        if worker.queue_name:
+            return (None, self.request.headers['X-AppEngine-QueueName'])
+        priority = self.get_priority(worker)
+        
+        demote_after = worker.demote_after or config.DEMOTE_AFTER
+        if handoff and demote_after:
+            for w in workers:
+                w._runner_data['lane_handoffs'] = w._runner_data.get('lane_handoffs', 0) + 1
+            if max(w._runner_data['lane_handoffs'] for w in workers) >= demote_after:
+                lower_priority = lanes.get_lower_priority(priority)
+                if lower_priority != priority:
+                    logging.info("[gae-workers] Demoting %s worker(s) of class %s to '%s' priority lane",
+                                 len(workers), worker.__class__.__name__, lower_priority)
+                    priority = lower_priority
+                for w in workers:
+                    w._runner_data['lane_handoffs'] = 0
+        return lanes.get_lane(worker, priority)
+    
+    def get_priority(self, worker):
+        ''' Retrieves the priority of current task running the worker (see lanes.py). '''
+        return self.request.headers.get(_TASK_HEADER_PRIORITY) or worker.priority or config.DEFAULT_PRIORITY
+    
+    def acquire_leases(self, workers):
+        '''
+        Acquires execution leases of workers for this task (see lease.py).
+        Workers which have already been run by this or later invocation are left out.
+        @return: List of workers whose leases have been acquired
+        @raise LeaseError: If some worker is (or may still be) run by another task;
+                           leases acquired so far are abandoned then
+        '''
+        invocation = self.get_invocation()
+        acquired = []
+        try:
+            for worker in workers:
+                worker._lease = Lease(worker._id, invocation)
+                if worker._lease.acquire():
+                    acquired.append(worker)
+                else:
+                    logging.warning("[gae-workers] Worker (ID=%s) has already been run past invocation %s; "
+                                    "dropping duplicate task", worker._id, invocation)
+        except LeaseError, e:
+            logging.warning("[gae-workers] %s", e)
+            self.release_leases(acquired, abandon = True)
+            raise
+        return acquired
+    
+    def release_leases(self, workers, abandon = False):
+        '''
+        Releases execution leases of workers held by this task.
+        @param abandon: Whether the task has failed, so that leases shall be
+                        deleted for its retry to run the workers
+        '''
+        for worker in workers:
+            if abandon:
+                worker._lease.abandon()
+            else:
+                worker._lease.release()
+        
+    def get_invocation(self):
+        ''' Retrieves the invocation count of worker handled by current task. '''
+        return int(self.request.headers.get(_TASK_HEADER_INVOCATION, 1))
+        
+        
     def invoke_worker_api(self, worker, api_name, *args):
         '''
         Performs an "API" call which was requested by a worker via yielding.
@@ -198,24 +617,58 @@ class WorkerHandler(webapp2.RequestHandler):
                                 worker._name, worker._id, secs)
                 return (False, "proceed")
             else:
-                self.save_worker_state(worker, lifetime = secs)
+                self.save_worker_state(worker, lifetime = secs, resume_delay = secs)
                 self.schedule_worker_execution(worker, delay = timedelta(seconds = secs))
                 return (self.NULL, "terminate")  # we pretend worker has finished since we queue its next ask above
             
         elif api_name == 'fork':
-            child_worker = worker.__class__(name = worker.name)
-            child_worker.__dict__.update(worker._get_state_dict())  # TODO: deep copy of worker state
-            child_worker.start()
+            return self.fork_worker(worker, args[0])
+        
+        elif api_name == 'join':
+            if not worker._runner_data.get('fork_parent'):
+                logging.warning("[gae-workers] Worker '%s' (ID=%s) has no parent to join",
+                                worker._name, worker._id)
+            self.finish_worker(worker, args[0])
+            return (self.NULL, "terminate")
         
         elif api_name == 'get_messages':
-            mc_key = _WORKER_MESSAGES_MEMCACHE_KEY % {'id':id}
-            msg_queue = memcache.get(mc_key, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
-            if not msg_queue:   return (None, "proceed")
+            msgs = Mailbox(worker._id, worker._runner_data).receive()
+            return (msgs or None, "proceed")
+        
+        elif api_name == 'wait_messages':
+            mailbox = Mailbox(worker._id, worker._runner_data)
+            msgs = mailbox.receive()
+            if msgs:    return (msgs, "proceed")
             
-            if not memcache.delete(mc_key, namespace = config.MEMCACHE_NAMESPACE): #@UndefinedVariable
-                logging.warning('[gae-workers] Could not clear message queue for worker %s (ID=%s)',
+            if not self.park_worker(worker, mailbox):
+                logging.warning("[gae-workers] Could not park worker '%s' (ID=%s) waiting for messages",
                                 worker._name, worker._id)
-            return (msg_queue, "proceed")
+                return (None, "proceed")
+            return (self.NULL, "terminate")   # worker will be woken up by next message
+        
+        elif api_name == 'time_left':
+            spin_estimate = worker._deadline_estimator.estimate()
+            time_left = self.deadline - time() - self.get_safety_margin(worker)
+            worker._budgeted_spin = True
+            return (Budget(time_left, spin_estimate), "proceed")
+        
+        elif api_name == 'publish_result':
+            request_id, result = args
+            published = results.publish_result(worker._id, request_id, result)
+            return (published, "proceed")
+        
+        elif api_name == 'throttle':
+            resource, tokens, park = args
+            reservations = worker._runner_data.setdefault('reservations', {})
+            wait, reservation = ratelimit.acquire(resource, tokens, reservations.pop(resource, None))
+            if reservation is not None:
+                reservations[resource] = reservation    # tokens are waiting for the worker in later period
+            if park and wait >= config.MIN_SLEEP_SECONDS:
+                # rather than spin waiting for tokens, worker sleeps until they're likely to be there
+                logging.debug("[gae-workers] Worker '%s' (ID=%s) is waiting %.1f seconds for tokens of %s",
+                              worker._name, worker._id, wait, resource)
+                return self.invoke_worker_api(worker, 'sleep', int(math.ceil(wait)))
+            return (wait, "proceed")
             
         else:
             logging.error("[gae-workers] Unknown API call: %s", api_name)
@@ -223,48 +676,177 @@ class WorkerHandler(webapp2.RequestHandler):
         return (self.NULL, "proceed")
     
                 
-    def save_worker_state(self, worker, lifetime = None):
+    def save_worker_state(self, worker, lifetime = None, durable = None, resume_delay = 0):
         '''
         Saves the worker state in memcache in order to retrieve it later,
         in subsequent tasks dedicated to run this worker.
+        Only the attributes that have changed since last save are written.
         @param worker: Worker object whose state is to be saved
-        @param lifetime: How long the state shall be kept in memcache.
+        @param lifetime: How long the state shall be kept in memcache
+                         in addition to config.MEMCACHE_DATA_LIFETIME.
+        @param durable: Whether the state must be written to datastore as well
+                        (by default it's done every config.DURABLE_CHECKPOINT_INTERVAL)
+        @param resume_delay: Number of seconds after which next task shall resume the worker,
+                             or None if it's not known (worker waits for something);
+                             used to measure the gap between tasks in metrics
+        @return: Whether the state has been saved
+        '''
+        return self.save_workers_state([worker], lifetime, durable, resume_delay)[0]
+    
+    def save_workers_state(self, workers, lifetime = None, durable = None, resume_delay = 0):
+        '''
+        Saves the state of several workers at once (see save_worker_state()).
+        @return: List of flags telling whether respective workers' states have been saved
         '''
-        if not lifetime and lifetime < config.MEMCACHE_DATA_LIFETIME:
-            lifetime = config.MEMCACHE_DATA_LIFETIME
+        start_time = time()
+        pending_save = self.start_workers_save(workers, lifetime, durable, resume_delay)
+        return self.finish_workers_save(workers, pending_save, start_time)
+    
+    def start_workers_save(self, workers, lifetime = None, durable = None, resume_delay = 0):
+        '''
+        Starts saving the state of several workers (see save_worker_state()),
+        which is completed by finish_workers_save().
+        @return: Pending save, as returned by state.save_states_async()
+        '''
+        for worker in workers:
+            self.finish_checkpoint(worker)
+        self.prepare_workers_save(workers, resume_delay)
+        lifetime = config.MEMCACHE_DATA_LIFETIME + (lifetime or 0)
+        return state.save_states_async(workers, lifetime, durable)
+    
+    def finish_workers_save(self, workers, pending_save, start_time):
+        '''
+        Completes saving the state of workers started by start_workers_save().
+        @param start_time: Time when saving has started, for measuring its duration
+        @return: List of flags telling whether respective workers' states have been saved
+        '''
+        saved = pending_save.get_result()
+        duration = time() - start_time
+        for worker in workers:
+            self.observe_checkpoint_time(worker, duration)
+        return saved
+    
+    def prepare_workers_save(self, workers, resume_delay = 0):
+        '''
+        Prepares workers for saving their state: writes their buffered mutations
+        and stores runner's data about them (see save_worker_state()).
+        @raise db.Error: If mutations could not be written. The task then fails,
+                         so that it's retried from last checkpoint, rather than
+                         saving the state which records progress beyond the data.
+        '''
+        for worker in workers:
+            self.flush_worker_mutations(worker)
         
-        # dump worker state into dictionary
-        state = {}
-        for attr, value in worker._get_state_dict().iteritems():
-            try:
-                state[attr] = data.save_value(value)
-            except data.DataError, e:
-                logging.error("[gae-workers] Error while saving %s: %s", attr, e)
-            
-        mc_key = _WORKER_STATE_MEMCACHE_KEY % {'id': worker._id}
-        if not memcache.set(mc_key, state, lifetime, namespace = config.MEMCACHE_NAMESPACE): #@UndefinedVariable
-            logging.error("[gae-workers] Failed to save state for worker '%s' (ID=%s)",
-                          worker._name, worker._id)
+        now = time()
+        for worker in workers:
+            spin_estimator = getattr(worker, '_deadline_estimator', None)
+            if spin_estimator:
+                worker._runner_data['estimator'] = (spin_estimator.name, spin_estimator.get_state())
+            if resume_delay is None:
+                worker._runner_data.pop('resume_at', None)
+            else:
+                worker._runner_data['resume_at'] = now + resume_delay
+    
+    def flush_worker_mutations(self, worker):
+        '''
+        Writes datastore mutations buffered by the worker (see Worker.mutations).
+        @raise db.Error: If they could not be written
+        '''
+        mutation_buffer = worker.__dict__.get('_mutations')
+        if mutation_buffer is not None:
+            mutation_buffer.flush()
             
     def restore_worker_state(self, worker):
         '''
-        Loads the worker state from memcache if it was saved previously.
+        Loads the worker state from memcache (or datastore) if it was saved previously.
         @param worker: Worker object whose state is to be restored 
+        @return: Whether the worker shall be run (see restore_workers_state())
         '''
-        mc_key = _WORKER_STATE_MEMCACHE_KEY % {'id': worker._id}
-        state = memcache.get(mc_key, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
-        if state is None:
-            worker._first_run = True
-            return
+        return bool(self.restore_workers_state([worker]))
         
-        for attr, value in state.iteritems():
-            try:
-                value = data.restore_value(value)
-                setattr(worker, attr, value)
-            except data.DataError, e:
-                logging.error("[gae-workers] Error while restoring %s: %s", attr, e)
-                
-        worker._first_run = False
+    def restore_workers_state(self, workers):
+        '''
+        Loads the state of several workers at once (see restore_worker_state()).
+        Workers are started with their initial state saved (see Worker.start()), so those
+        without any saved state have already finished; task running them is a duplicate
+        whose lease record has been lost, and they are left out.
+        @return: List of workers which shall be run
+        '''
+        restored = state.restore_states(workers)
+        lost = [worker for worker, was_restored in zip(workers, restored) if not was_restored]
+        finished = [worker for worker, generation in zip(lost, state.get_generations(lost)) if generation is None] \
+                   if lost else []
+        
+        running = []
+        for worker, was_restored in zip(workers, restored):
+            if worker in finished:
+                logging.warning("[gae-workers] Worker (ID=%s) has no saved state, so it has already finished; "
+                                "dropping duplicate task", worker._id)
+                continue
+            if not was_restored:
+                logging.error("[gae-workers] State of worker '%s' (ID=%s) is lost; running it from the beginning",
+                              worker._name, worker._id)
+            # set for the initial state, until the worker is set up
+            worker._first_run = not was_restored or worker._runner_data.pop('setup_pending', False)
+            running.append(worker)
+        return running
+            
+    def restore_handed_off_state(self, workers):
+        '''
+        Loads the state of workers handed off to this task (see handoff_workers()).
+        Since the state is written concurrently with adding the task, it may not have
+        been written yet; this waits for it for up to config.HANDOFF_STATE_TIMEOUT seconds,
+        after which workers continue from their older checkpoints (if any).
+        @return: List of workers which shall be run (see restore_workers_state())
+        '''
+        header = self.request.headers.get(_TASK_HEADER_STATE)
+        if header:
+            # listed in the order of worker IDs in task's URL, some of which may have been left out
+            worker_ids = (self.request.GET.get('ids') or self.request.GET.get('id')).split(',')
+            expected_generations = dict(zip(worker_ids, map(int, header.split(','))))
+            wait_deadline = time() + config.HANDOFF_STATE_TIMEOUT
+            while True:
+                generations = state.get_generations(workers)
+                stale_count = sum(1 for worker, generation in zip(workers, generations)
+                                  if (generation or 0) < expected_generations.get(worker._id, 0))
+                if not stale_count: break
+                if time() >= wait_deadline:
+                    logging.warning("[gae-workers] State of %s worker(s) handed off to this task has not been written; "
+                                    "continuing from older checkpoint", stale_count)
+                    break
+                sleep(config.HANDOFF_POLL_DELAY)
+        return self.restore_workers_state(workers)
+
+    def finish_worker(self, worker, result = None):
+        '''
+        Cleans up after the worker which has finished. If it was forked,
+        its parent is passed the result.
+        @param result: Result of forked worker
+        '''
+        # if mutations can't be written, task fails and is retried from last checkpoint
+        self.flush_worker_mutations(worker)
+        self.finish_checkpoint(worker)  # so that it doesn't write the state after it's cleared
+        fork.join(worker, result)
+        self.clear_worker_state(worker)
+        
+    def clear_worker_state(self, worker):
+        '''
+        Deletes the saved state of worker which has finished.
+        @param worker: Worker object whose state is to be deleted
+        '''
+        state.clear_state(worker)
+
+
+class StatsHandler(webapp2.RequestHandler):
+    '''
+    Request handler reporting runtime metrics of workers as JSON.
+    Metrics of individual workers are included if "workers" query argument is given.
+    '''
+    def get(self):
+        stats = metrics.get_stats(include_workers = bool(self.request.GET.get('workers')))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(stats, indent = 2, sort_keys = True))
         
           
-app = webapp2.WSGIApplication([ (config.WORKER_URL, WorkerHandler) ])
+app = webapp2.WSGIApplication([ (config.WORKER_URL, WorkerHandler),
+                                (config.STATS_URL, StatsHandler) ])
@@ -0,0 +1,230 @@
+'''
+Harness for simulating workers' execution in a single process,
+without App Engine. Memcache and task queue are replaced with in-memory
+stand-ins (see standins.py), datastore with DictStorage, and time
+is virtual: it only passes when worker code says so (or with every
+reading of the clock, if tick is set). Tasks are executed one by one,
+in order of their ETA, through the regular WorkerHandler.
+
+Simulation can also inject the failures that workers face on App Engine:
+task deadlines, memcache evictions, task retries and duplicate deliveries.
+It's deterministic, given the seed of its random number generator.
+
+Typical usage:
+
+    with Simulation(tick = 0.001) as sim:
+        MyWorker().start()
+        sim.run()
+        print sim.stats
+
+Created on 2011-12-04
+
+@author: xion
+'''
+from gaeworkers import standins
+standins.install()  # does nothing if App Engine SDK is available
+
+from gaeworkers import fork, lease, mailbox, metrics, query, ratelimit, results, runner, state, storage, tasks, worker
+import logging
+import random
+
+
+class VirtualClock(object):
+    '''
+    Clock measuring simulated time. Besides the time() method, it provides
+    sleep(), so that it can stand in for the time module.
+    '''
+    def __init__(self, start_time = 1325376000.0, tick = 0.0):
+        '''
+        @param start_time: Initial time (timestamp)
+        @param tick: Number of seconds that pass with every reading of the clock
+        '''
+        self.now = start_time
+        self.tick = tick
+        self.deadline = None
+        self.deadline_error = None
+        self.deadline_exceeded = False
+
+    def time(self):
+        if self.tick:
+            self.advance(self.tick)
+        return self.now
+
+    def advance(self, secs):
+        '''
+        Advances the time. If it passes the deadline of current request,
+        DeadlineExceededError is raised (once per request), like on App Engine.
+        '''
+        self.now += secs
+        if self.deadline is not None and self.now >= self.deadline:
+            self.deadline = None
+            self.deadline_exceeded = True
+            raise self.deadline_error()
+
+    sleep = advance
+
+    def set_deadline(self, deadline, error_class):
+        '''
+        Sets the time at which request being executed exceeds its deadline.
+        @param deadline: Timestamp of the deadline, or None if there's no request
+        '''
+        self.deadline = deadline
+        self.deadline_error = error_class
+        self.deadline_exceeded = False
+
+    def datetime(self):
+        ''' Creates a replacement for datetime class whose now() reads this clock. '''
+        clock = self
+        class VirtualDatetime(runner.datetime):
+            @classmethod
+            def now(cls, tz = None):
+                return standins.to_datetime(clock.now)
+            utcnow = now
+        return VirtualDatetime
+
+
+class _Request(object):
+    ''' Request of simulated task, with the bits of webapp2.Request that WorkerHandler uses. '''
+    def __init__(self, queue_name, task, eta):
+        self.GET = task.query
+        self.headers = dict((name, str(value)) for name, value in task.headers.iteritems())
+        self.headers['X-AppEngine-QueueName'] = queue_name
+        self.headers['X-AppEngine-TaskName'] = task.name or ""
+        self.headers['X-AppEngine-TaskRetryCount'] = str(task.retry_count)
+        self.headers['X-AppEngine-TaskETA'] = "%.6f" % eta
+
+
+class Simulation(object):
+    '''
+    Simulated App Engine environment for running workers.
+    It's active inside of a "with" block, or between activate() and deactivate() calls.
+    '''
+    def __init__(self, seed = 0, tick = 0.0, request_deadline = 600,
+                 eviction_rate = 0.0, retry_rate = 0.0, retry_delay = 1.0, durable = True):
+        '''
+        @param seed: Seed of random number generator deciding on injected failures
+        @param tick: Number of seconds that pass with every reading of the clock
+        @param request_deadline: Number of seconds after which tasks get DeadlineExceededError
+        @param eviction_rate: Probability of every memcache item being evicted after each task
+        @param retry_rate: Probability of a successful task being executed again
+        @param retry_delay: Number of seconds after which failed task is retried
+        @param durable: Whether to simulate durable tier of state storage (datastore)
+        '''
+        self.random = random.Random(seed)
+        self.clock = VirtualClock(tick = tick)
+        self.memcache = standins.Memcache(self.clock)
+        self.taskqueue = standins.TaskQueue(self.clock)
+        self.datastore = storage.DictStorage(keep_forever = True) if durable else None
+
+        self.request_deadline = request_deadline
+        self.eviction_rate = eviction_rate
+        self.retry_rate = retry_rate
+        self.retry_delay = retry_delay
+
+        self.start_time = self.clock.now
+        self.stats = dict(tasks = 0, failed_tasks = 0, retries = 0, deadlines = 0, evictions = 0)
+        self.worker_tasks = {}  # worker ID -> number of tasks that executed it
+        self._patches = []
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.deactivate()
+
+    def activate(self):
+        ''' Replaces App Engine services used by gae-workers with the simulated ones. '''
+        if self._patches:
+            return
+        virtual_time = self.clock.time
+        self._patch(storage, memcache = self.memcache, time = virtual_time,
+                    _storage = storage.TieredStorage(storage.MemcacheStorage(), self.datastore)
+                               if self.datastore is not None else storage.MemcacheStorage())
+        self._patch(mailbox, memcache = self.memcache, time = virtual_time, Task = standins.Task,
+                    TaskAlreadyExistsError = standins.TaskAlreadyExistsError,
+                    TombstonedTaskError = standins.TombstonedTaskError)
+        self._patch(fork, memcache = self.memcache, Task = standins.Task,
+                    TaskAlreadyExistsError = standins.TaskAlreadyExistsError,
+                    TombstonedTaskError = standins.TombstonedTaskError)
+        self._patch(results, memcache = self.memcache, time = self.clock)
+        self._patch(metrics, memcache = self.memcache, time = virtual_time)
+        self._patch(tasks, taskqueue = standins)
+        self._patch(worker, Task = standins.Task)
+        self._patch(query, time = virtual_time)
+        self._patch(lease, time = virtual_time, sleep = self.clock.sleep)
+        self._patch(ratelimit, time = virtual_time)
+        self._patch(state, time = virtual_time)
+        self._patch(runner, time = virtual_time, sleep = self.clock.sleep, datetime = self.clock.datetime(),
+                    taskqueue = standins)
+        standins.activate(self.memcache, self.taskqueue)
+
+    def deactivate(self):
+        ''' Restores App Engine services replaced by activate(). '''
+        for module, attr, value in reversed(self._patches):
+            setattr(module, attr, value)
+        self._patches = []
+        standins.activate(None, None)
+
+    def _patch(self, module, **attrs):
+        for attr, value in attrs.iteritems():
+            self._patches.append((module, attr, getattr(module, attr)))
+            setattr(module, attr, value)
+
+
+    def run(self, until = None, max_tasks = None):
+        '''
+        Executes queued tasks (including those they add) in order of their ETA.
+        @param until: Virtual time (timestamp) at which the simulation stops
+        @param max_tasks: Maximum number of tasks to execute
+        @return: Number of executed tasks
+        '''
+        executed = 0
+        while self.taskqueue and (max_tasks is None or executed < max_tasks):
+            if until is not None and self.taskqueue.next_eta() > until:
+                self.clock.now = max(self.clock.now, until)
+                break
+            eta, queue_name, task = self.taskqueue.pop()
+            self.clock.now = max(self.clock.now, eta)
+            self.run_task(queue_name, task, eta)
+            executed += 1
+        return executed
+
+    def run_task(self, queue_name, task, eta = None):
+        '''
+        Executes single task through WorkerHandler. If it fails, it's queued again.
+        @param eta: Time at which the task was due (current time by default)
+        @return: Whether the task has succeeded
+        '''
+        query = task.query
+        worker_ids = query['ids'].split(',') if 'ids' in query else [query.get('id')]
+        for worker_id in worker_ids:
+            self.worker_tasks[worker_id] = self.worker_tasks.get(worker_id, 0) + 1
+        self.stats['tasks'] += 1
+
+        handler = runner.WorkerHandler()
+        handler.request = _Request(queue_name, task, self.clock.now if eta is None else eta)
+        self.clock.set_deadline(self.clock.now + self.request_deadline, runner.DeadlineExceededError)
+        try:
+            handler.get()
+            succeeded = True
+        except (Exception, runner.DeadlineExceededError), e:
+            logging.exception("[gae-workers] Simulated task %s failed: %s", task.name, e)
+            self.stats['failed_tasks'] += 1
+            succeeded = False
+        if self.clock.deadline_exceeded:
+            self.stats['deadlines'] += 1
+        self.clock.set_deadline(None, None)
+
+        if not succeeded or self.random.random() < self.retry_rate:
+            task.retry_count += 1
+            self.stats['retries'] += 1
+            self.taskqueue.push(queue_name, task, self.clock.now + self.retry_delay)
+        if self.eviction_rate:
+            self.stats['evictions'] += self.memcache.evict(self.eviction_rate, self.random)
+        return succeeded
+
+    @property
+    def elapsed(self):
+        ''' Virtual time (in seconds) which has passed since the simulation has started. '''
+        return self.clock.now - self.start_time
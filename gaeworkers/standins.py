@@ -0,0 +1,437 @@
+'''
+In-memory stand-ins for App Engine services used by gae-workers:
+memcache and task queue. They are used by the simulation harness
+(see simulation.py) to run workers outside of App Engine.
+
+If the App Engine SDK is not available, install() registers
+placeholder modules in its place, so that gae-workers can still be
+imported. This is done by the simulation harness (and benchmarks) only;
+a plain import of gaeworkers leaves sys.modules alone. The services
+only work inside of an active simulation, though.
+
+Created on 2011-12-04
+
+@author: xion
+'''
+from datetime import datetime
+import calendar
+import collections
+import cPickle
+import heapq
+import itertools
+import sys
+import types
+import urlparse
+
+
+_active = None  # (memcache, task queue) of active simulation
+
+def activate(memcache, taskqueue):
+    ''' Makes given services the ones used by stand-in SDK modules. '''
+    global _active
+    _active = (memcache, taskqueue) if memcache else None
+
+def _get_active():
+    if _active is None:
+        raise RuntimeError("App Engine services are only available inside of gae-workers simulation")
+    return _active
+
+
+###############################################################################
+# Memcache
+
+class Memcache(object):
+    '''
+    In-memory memcache, with interface of google.appengine.api.memcache module.
+    Like the real one, it stores copies (pickles) of values.
+    '''
+    MAX_RELATIVE_TIME = 30 * 24 * 60 * 60   # longer times are absolute timestamps
+    STORED = 1                              # status of stored value, as in memcache.STORED
+
+    def __init__(self, clock):
+        '''
+        @param clock: Object whose time() method returns current (virtual) time
+        '''
+        self.clock = clock
+        self.items = {}     # (namespace, key) -> (pickled value, expiration time or None)
+        self.cas_values = {}  # (namespace, key) -> pickled value last retrieved by gets()
+
+    def get(self, key, namespace = None):
+        return self.get_multi([key], namespace = namespace).get(key)
+
+    def get_multi(self, keys, key_prefix = '', namespace = None):
+        result = {}
+        for key in keys:
+            value = self._get(namespace, key_prefix + key)
+            if value is not None:
+                result[key] = cPickle.loads(value)
+        return result
+
+    def set(self, key, value, time = 0, namespace = None):
+        return not self.set_multi({key: value}, time, namespace = namespace)
+
+    def set_multi(self, mapping, time = 0, key_prefix = '', namespace = None):
+        expires_at = self._expiration_time(time)
+        for key, value in mapping.iteritems():
+            self.items[(namespace, key_prefix + key)] = (cPickle.dumps(value, 2), expires_at)
+        return []
+
+    def set_multi_async(self, mapping, time = 0, key_prefix = '', namespace = None):
+        self.set_multi(mapping, time, key_prefix, namespace)
+        return _Rpc(dict((key, self.STORED) for key in mapping))
+
+    def Client(self):
+        ''' Returns the memcache itself, which stands in for memcache.Client objects too. '''
+        return self
+
+    def gets(self, key, namespace = None):
+        value = self._get(namespace, key)
+        if value is None:
+            return None
+        self.cas_values[(namespace, key)] = value
+        return cPickle.loads(value)
+
+    def cas(self, key, value, time = 0, namespace = None):
+        ''' Stores the value if the item hasn't changed since gets() (comparing its values). '''
+        seen_value = self.cas_values.pop((namespace, key), None)
+        if seen_value is None or self._get(namespace, key) != seen_value:
+            return False
+        return self.set(key, value, time, namespace = namespace)
+
+    def add(self, key, value, time = 0, namespace = None):
+        if self._get(namespace, key) is not None:
+            return False
+        return self.set(key, value, time, namespace = namespace)
+
+    def delete(self, key, namespace = None):
+        found = self._get(namespace, key) is not None
+        self.items.pop((namespace, key), None)
+        return 2 if found else 1    # DELETE_SUCCESSFUL / DELETE_ITEM_MISSING
+
+    def delete_multi(self, keys, key_prefix = '', namespace = None):
+        for key in keys:
+            self.items.pop((namespace, key_prefix + key), None)
+        return True
+
+    def incr(self, key, delta = 1, namespace = None, initial_value = None):
+        value = self._get(namespace, key)
+        if value is None:
+            if initial_value is None:
+                return None
+            value, expires_at = int(initial_value), None
+        else:
+            value, expires_at = long(cPickle.loads(value)), self.items[(namespace, key)][1]
+        value = max(value + delta, 0)
+        self.items[(namespace, key)] = (cPickle.dumps(value, 2), expires_at)
+        return value
+
+    def decr(self, key, delta = 1, namespace = None, initial_value = None):
+        return self.incr(key, -delta, namespace, initial_value)
+
+    def flush_all(self):
+        self.items.clear()
+        return True
+
+    def evict(self, probability, random):
+        '''
+        Evicts items, simulating memory pressure.
+        @param probability: Probability of evicting each item
+        @param random: random.Random object to use
+        @return: Number of evicted items
+        '''
+        evicted = [key for key in sorted(self.items) if random.random() < probability]
+        for key in evicted:
+            del self.items[key]
+        return len(evicted)
+
+    def _get(self, namespace, key):
+        item = self.items.get((namespace, key))
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= self.clock.time():
+            del self.items[(namespace, key)]
+            return None
+        return value
+
+    def _expiration_time(self, time):
+        if not time:
+            return None
+        return time if time > self.MAX_RELATIVE_TIME else self.clock.time() + time
+
+
+###############################################################################
+# Task queue
+
+class Error(Exception): pass
+class TaskAlreadyExistsError(Error): pass
+class TombstonedTaskError(Error): pass
+
+MAX_TASKS_PER_ADD = 100
+
+
+class Task(object):
+    '''
+    Task, with (a subset of) interface of google.appengine.api.taskqueue.Task.
+    '''
+    def __init__(self, payload = None, name = None, url = None, method = 'POST',
+                 headers = None, params = None, countdown = None, eta = None):
+        self.payload = payload
+        self.name = name
+        self.url = url
+        self.method = method
+        self.headers = dict(headers or {})
+        self.params = params
+        self.countdown = countdown
+        self.eta = eta
+        self.was_enqueued = False
+        self.retry_count = 0
+
+    @property
+    def query(self):
+        ''' Dictionary of task URL's query string arguments. '''
+        return dict(urlparse.parse_qsl(urlparse.urlparse(self.url).query))
+
+    def add(self, queue_name = 'default', transactional = False):
+        Queue(queue_name).add(self)
+        return self
+
+
+class _Rpc(object):
+    ''' Result of asynchronous operation which has already completed. '''
+    def __init__(self, result = None, error = None):
+        self.result = result
+        self.error = error
+
+    def get_result(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Queue(object):
+    '''
+    Task queue, with (a subset of) interface of google.appengine.api.taskqueue.Queue.
+    '''
+    def __init__(self, name = 'default'):
+        self.name = name
+
+    def add(self, task, transactional = False):
+        return self.add_async(task).get_result()
+
+    def add_async(self, task, transactional = False, rpc = None):
+        tasks = task if isinstance(task, (list, tuple)) else [task]
+        _, taskqueue = _get_active()
+        try:
+            taskqueue.add(self.name, tasks)
+        except Error, e:
+            return _Rpc(error = e)
+        return _Rpc(task)
+
+
+class QueueStatistics(object):
+    '''
+    Statistics of task queue, with (a subset of) interface
+    of google.appengine.api.taskqueue.QueueStatistics.
+    '''
+    def __init__(self, queue, tasks, oldest_eta_usec, executed_last_minute):
+        self.queue = queue
+        self.tasks = tasks
+        self.oldest_eta_usec = oldest_eta_usec
+        self.executed_last_minute = executed_last_minute
+        self.in_flight = 0
+        self.enforced_rate = None
+
+    @classmethod
+    def fetch(cls, queue_or_queues):
+        queues = queue_or_queues if isinstance(queue_or_queues, (list, tuple)) else [queue_or_queues]
+        _, taskqueue = _get_active()
+        stats = [cls(queue, *taskqueue.get_statistics(queue.name)) for queue in queues]
+        return stats if isinstance(queue_or_queues, (list, tuple)) else stats[0]
+
+
+class TaskQueue(object):
+    '''
+    In-memory task queue service, holding tasks of all queues
+    in order of their ETA.
+    '''
+    def __init__(self, clock):
+        '''
+        @param clock: Object whose time() method returns current (virtual) time
+        '''
+        self.clock = clock
+        self.pending = []       # heap of (ETA, sequence number, queue name, task)
+        self.names = set()      # names of all tasks ever added
+        self.tombstones = set() # names of tasks that have been executed
+        self.executed = collections.deque()     # (time, queue name) of tasks executed in the last minute
+        self._sequence = itertools.count()
+
+    def add(self, queue_name, tasks):
+        '''
+        Adds tasks to given queue. Tasks with duplicate names are rejected,
+        but others are added nevertheless.
+        @raise TaskAlreadyExistsError: If some of the tasks were rejected
+        '''
+        if len(tasks) > MAX_TASKS_PER_ADD:
+            raise Error("Too many tasks in single call: %s" % len(tasks))
+
+        duplicates = []
+        for task in tasks:
+            if task.name is not None:
+                if task.name in self.names:
+                    duplicates.append(task.name)
+                    continue
+                self.names.add(task.name)
+            self.push(queue_name, task)
+        if duplicates:
+            error_class = TombstonedTaskError if self.tombstones.issuperset(duplicates) else TaskAlreadyExistsError
+            raise error_class("Tasks already exist: %s" % ", ".join(duplicates))
+
+    def push(self, queue_name, task, eta = None):
+        ''' Puts the task in the queue, bypassing the checks of its name. '''
+        if eta is None:
+            eta = self.clock.time() + (task.countdown or 0)
+            if task.eta is not None:
+                eta = _to_timestamp(task.eta)
+        task.was_enqueued = True
+        heapq.heappush(self.pending, (eta, next(self._sequence), queue_name, task))
+
+    def pop(self):
+        '''
+        Removes the task with earliest ETA from the queue.
+        @return: Tuple (ETA, queue name, task), or None if there are no tasks
+        '''
+        if not self.pending:
+            return None
+        eta, _, queue_name, task = heapq.heappop(self.pending)
+        if task.name is not None:
+            self.tombstones.add(task.name)
+        self.executed.append((max(eta, self.clock.time()), queue_name))
+        return (eta, queue_name, task)
+
+    def get_statistics(self, queue_name):
+        '''
+        Retrieves statistics of given queue.
+        @return: Tuple (number of tasks, ETA of the oldest one in microseconds or None,
+                 number of tasks executed in the last minute)
+        '''
+        now = self.clock.time()
+        while self.executed and self.executed[0][0] <= now - 60:
+            self.executed.popleft()
+        etas = [eta for eta, _, name, _ in self.pending if name == queue_name]
+        return (len(etas), int(min(etas) * 1e6) if etas else None,
+                sum(1 for _, name in self.executed if name == queue_name))
+
+    def next_eta(self):
+        ''' Retrieves ETA of the task which is next in the queue, or None if there are no tasks. '''
+        return self.pending[0][0] if self.pending else None
+
+    def __len__(self):
+        return len(self.pending)
+
+
+def _to_timestamp(dt):
+    ''' Converts naive datetime in UTC to timestamp. '''
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+def to_datetime(timestamp):
+    ''' Converts timestamp to naive datetime in UTC. '''
+    return datetime.utcfromtimestamp(timestamp)
+
+
+###############################################################################
+# Runtime
+
+class DeadlineExceededError(BaseException):
+    ''' Stand-in for google.appengine.runtime.DeadlineExceededError. '''
+    pass
+
+
+###############################################################################
+# SDK modules
+
+def sdk_available():
+    '''
+    Checks whether App Engine SDK (or stand-ins installed in its place)
+    can be imported, together with webapp2.
+    '''
+    try:
+        import google.appengine.api.memcache #@UnusedImport
+        import webapp2 #@UnusedImport
+    except ImportError:
+        return False
+    return True
+
+def install():
+    '''
+    Registers placeholder modules for parts of App Engine SDK
+    which cannot be imported, so that gae-workers can be imported without it.
+    Afterwards, gaeworkers.Worker is available as usual.
+    '''
+    try:
+        import google.appengine.api.memcache #@UnusedImport
+    except ImportError:
+        _install_module('google')
+        _install_module('google.appengine')
+        _install_module('google.appengine.api')
+        _install_module('google.appengine.api.memcache', STORED = Memcache.STORED,
+                        **dict((name, _delegate_to_memcache(name))
+                               for name in ('get', 'get_multi', 'set', 'set_multi', 'add', 'delete',
+                                            'delete_multi', 'incr', 'decr', 'flush_all', 'Client')))
+        _install_module('google.appengine.api.taskqueue',
+                        Error = Error, TaskAlreadyExistsError = TaskAlreadyExistsError,
+                        TombstonedTaskError = TombstonedTaskError, MAX_TASKS_PER_ADD = MAX_TASKS_PER_ADD,
+                        Task = Task, Queue = Queue, QueueStatistics = QueueStatistics)
+        _install_module('google.appengine.ext')
+        _install_module('google.appengine.ext.db',
+                        Error = Exception, Model = _Model, BlobProperty = _Property, Blob = str,
+                        Key = None, get = _no_datastore, get_async = _no_datastore,
+                        put_async = _no_datastore, delete = _no_datastore, delete_async = _no_datastore)
+        _install_module('google.appengine.runtime', DeadlineExceededError = DeadlineExceededError)
+
+    try:
+        import webapp2 #@UnusedImport
+    except ImportError:
+        _install_module('webapp2', RequestHandler = _RequestHandler, WSGIApplication = _WSGIApplication)
+
+    import gaeworkers
+    from gaeworkers import worker
+    gaeworkers.Worker = worker.Worker
+
+
+def _install_module(name, **attrs):
+    module = sys.modules.get(name)
+    if module is None:
+        module = sys.modules[name] = types.ModuleType(name)
+        if '.' in name:
+            parent_name, attr = name.rsplit('.', 1)
+            setattr(sys.modules[parent_name], attr, module)
+    for attr, value in attrs.iteritems():
+        setattr(module, attr, value)
+
+def _delegate_to_memcache(name):
+    def memcache_function(*args, **kwargs):
+        memcache, _ = _get_active()
+        return getattr(memcache, name)(*args, **kwargs)
+    memcache_function.__name__ = name
+    return memcache_function
+
+def _no_datastore(*args, **kwargs):
+    raise RuntimeError("Datastore is not available without App Engine SDK")
+
+class _Model(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class _Property(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+class _RequestHandler(object):
+    def __init__(self, request = None, response = None):
+        self.request = request
+        self.response = response
+
+class _WSGIApplication(object):
+    def __init__(self, routes = None, debug = False, config = None):
+        self.routes = routes
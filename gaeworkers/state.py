@@ -0,0 +1,625 @@
+'''
+Module responsible for checkpointing worker's state in storage
+(see storage.py) and restoring it in subsequent tasks.
+
+Every public attribute of the worker is stored under its own key(s),
+while the state index key lists the attributes along with digests
+of their saved values. This way, checkpoints only need to write
+attributes that have changed since the previous one.
+
+Big values are compressed and split into chunks fitting in memcache.
+Chunks are written under keys specific to checkpoint's generation
+before the index is updated, so the index never refers to values
+from partially written checkpoint.
+
+Workers which declare their state schema (see Worker.state_fields) save only
+the declared attributes. Those of immutable types are stored together,
+by position, in a single record entry, rather than each under its own keys.
+
+The index also holds the runner's own data about the worker (e.g. statistics
+of spin durations), which is persisted along with worker's state.
+
+Every now and then, checkpoint is also written to durable tier of the storage,
+so that the worker can be restored even if memcache has evicted its state.
+
+States of many workers can be saved and restored together, sharing
+the storage calls (see save_states() and restore_states()).
+Checkpoints can also be written asynchronously (see save_states_async()),
+while the worker carries on.
+
+Created on 2011-11-26
+
+@author: xion
+'''
+from gaeworkers import codec, config, data
+from gaeworkers.storage import get_storage
+from time import time
+import hashlib
+import logging
+import zlib
+
+
+_STATE_INDEX_KEY = "worker://%(id)s/state"
+_STATE_CHUNK_KEY = "worker://%(id)s/state/%(attr)s/%(generation)s/%(chunk)s"
+
+_STATE_FORMAT_VERSION = 5
+
+# types whose values can only be changed by assigning to worker's attribute
+_IMMUTABLE_TYPES = frozenset([type(None), bool, int, long, float, complex, str, unicode])
+
+# prefix of stored attribute values compressed with zlib; codec payloads never start with it
+_COMPRESSED_PREFIX = 'Z'
+
+# name of state entry holding the record of declared fields of immutable types;
+# it cannot clash with attribute names
+_RECORD_ENTRY = '#record'
+
+
+def save_state(worker, lifetime = None, durable = None):
+    '''
+    Saves the worker's state, writing only those attributes
+    which have changed since last checkpoint.
+    @param worker: Worker object whose state is to be saved
+    @param lifetime: Minimum number of seconds the state shall be kept in memcache
+    @param durable: Whether the checkpoint shall be written to durable storage tier.
+                    By default, it is written there every config.DURABLE_CHECKPOINT_INTERVAL seconds.
+    @return: Whether the state has been saved successfully
+    @raise data.DataError: If the state doesn't match worker's schema (see Worker.state_fields);
+                           rather than carry on without saving, the task fails
+    '''
+    return save_states([worker], lifetime, durable)[0]
+
+def save_states(workers, lifetime = None, durable = None):
+    '''
+    Saves the state of many workers at once, with single write to storage
+    for their attributes and another one for their state indexes.
+    @param workers: List of worker objects whose state is to be saved
+    @param lifetime: Minimum number of seconds the state shall be kept in memcache
+    @param durable: Whether the checkpoint shall be written to durable storage tier
+                    (as in save_state())
+    @return: List of flags telling whether respective workers' states have been saved
+    @raise data.DataError: If the state of some worker doesn't match its schema
+    '''
+    return save_states_async(workers, lifetime, durable).get_result()
+
+def save_states_async(workers, lifetime = None, durable = None):
+    '''
+    Starts saving the state of many workers (see save_states()). Attributes
+    are written asynchronously, if the storage supports it, while the caller
+    carries on; the index is written when the result is retrieved.
+    Attributes changed in the meantime are saved by the next checkpoint,
+    which must not be started before this one is completed.
+    @return: Object whose get_result() method completes the checkpoint
+             and returns the list of flags, as save_states()
+    @raise data.DataError: If the state of some worker doesn't match its schema
+    '''
+    storage = get_storage()
+    lifetime = lifetime or config.MEMCACHE_DATA_LIFETIME
+    chunks_lifetime = lifetime + config.MEMCACHE_STATE_REFRESH_INTERVAL
+    now = time()
+
+    checkpoints = [_prepare_checkpoint(worker, storage, lifetime, durable, now) for worker in workers]
+    pending = [checkpoint for checkpoint in checkpoints if checkpoint]
+
+    # chunks go first, so that the index never refers to values which haven't been completely written
+    rpcs = []
+    for is_durable in (False, True):
+        to_write = {}
+        for checkpoint in pending:
+            if checkpoint.durable == is_durable:
+                to_write.update(checkpoint.to_write)
+        if to_write:
+            rpcs.append(storage.set_multi_async(to_write, chunks_lifetime, is_durable))
+    to_write_durable = {}
+    for checkpoint in pending:
+        to_write_durable.update(checkpoint.to_write_durable)
+    if to_write_durable:
+        rpcs.append(storage.durable.set_multi_async(to_write_durable))
+    return _PendingSave(storage, lifetime, checkpoints, rpcs)
+
+
+class _PendingSave(object):
+    '''
+    Checkpoints of workers' states whose attributes are being written.
+    '''
+    def __init__(self, storage, lifetime, checkpoints, rpcs):
+        self.storage = storage
+        self.lifetime = lifetime
+        self.checkpoints = checkpoints
+        self.rpcs = rpcs
+        self.result = None
+
+    @property
+    def generations(self):
+        ''' Generations of the states being saved (None for those which cannot be saved). '''
+        return [checkpoint.generation if checkpoint else None for checkpoint in self.checkpoints]
+
+    def get_result(self):
+        '''
+        Waits for the attributes to be written, then writes the indexes.
+        @return: List of flags telling whether respective workers' states have been saved
+        '''
+        if self.result is None:
+            self.result = self._complete()
+        return self.result
+
+    def _complete(self):
+        storage, lifetime, checkpoints = self.storage, self.lifetime, self.checkpoints
+        pending = [checkpoint for checkpoint in checkpoints if checkpoint]
+        failed_keys = set()
+        for rpc in self.rpcs:
+            failed_keys.update(rpc.get_result())
+
+        if failed_keys:
+            for checkpoint in pending:
+                failed_count = sum(1 for key in checkpoint.to_write if key in failed_keys) \
+                               + sum(1 for key in checkpoint.to_write_durable if key in failed_keys)
+                if failed_count:
+                    logging.error("[gae-workers] Failed to save state for worker '%s' (ID=%s): %s chunk(s) not written",
+                                  checkpoint.worker._name, checkpoint.worker._id, failed_count)
+                    checkpoint.failed = True
+            pending = [checkpoint for checkpoint in pending if not checkpoint.failed]
+
+        for is_durable in (False, True):
+            indexes = dict((checkpoint.index_key, checkpoint.index_payload)
+                           for checkpoint in pending if checkpoint.durable == is_durable)
+            if indexes:
+                failed_keys = set(storage.set_multi(indexes, lifetime, is_durable))
+                for checkpoint in pending:
+                    if checkpoint.index_key in failed_keys:
+                        logging.error("[gae-workers] Failed to save state for worker '%s' (ID=%s)",
+                                      checkpoint.worker._name, checkpoint.worker._id)
+                        checkpoint.failed = True
+        pending = [checkpoint for checkpoint in pending if not checkpoint.failed]
+
+        superseded_keys = [key for checkpoint in pending for key in checkpoint.superseded_keys]
+        if superseded_keys:
+            storage.delete_multi(superseded_keys)
+        superseded_durable_keys = [key for checkpoint in pending for key in checkpoint.superseded_durable_keys]
+        if superseded_durable_keys:
+            storage.delete_multi(superseded_durable_keys, durable = True)   # with their cached copies
+
+        for checkpoint in checkpoints:
+            if not checkpoint:      continue
+            if checkpoint.failed:   checkpoint.rollback()
+            else:                   checkpoint.commit()
+        return [bool(checkpoint) and not checkpoint.failed for checkpoint in checkpoints]
+
+
+class _Checkpoint(object):
+    '''
+    Checkpoint of single worker's state, prepared for writing to storage.
+    '''
+    def __init__(self, worker):
+        self.worker = worker
+        self.failed = False
+        self.durable = False
+        self.to_write = {}
+        self.to_write_durable = {}  # chunks already in cache, but not in durable tier
+        self.superseded_keys = []
+        self.superseded_durable_keys = []
+
+    def commit(self):
+        ''' Updates worker's bookkeeping after the checkpoint has been written. '''
+        worker = self.worker
+        logging.debug("[gae-workers] Saved %s chunk(s) (%s bytes) of worker '%s' (ID=%s)%s",
+                      len(self.to_write), sum(map(len, self.to_write.itervalues())), worker._name, worker._id,
+                      " (durable)" if self.durable else "")
+        worker._state_index = self.index
+        worker._state_durable_entries = self.durable_entries
+        worker._state_durable_at = self.durable_at
+        worker._state_generation = self.generation
+        worker._state_sizes = self.sizes
+
+    def rollback(self):
+        ''' Marks the attributes as changed again after the checkpoint has failed. '''
+        self.worker._dirty_attrs.update(self.dirty_attrs)
+
+
+def _prepare_checkpoint(worker, storage, lifetime, durable, now):
+    '''
+    Determines what has to be written to save the worker's state.
+    @return: _Checkpoint object, or None if the state cannot be saved
+    @raise data.DataError: If the state doesn't match worker's schema
+    '''
+    chunks_lifetime = lifetime + config.MEMCACHE_STATE_REFRESH_INTERVAL
+    checkpoint = _Checkpoint(worker)
+    start_time = time()
+
+    saved_index = getattr(worker, '_state_index', {})
+    durable_entries = getattr(worker, '_state_durable_entries', {})
+    durable_at = getattr(worker, '_state_durable_at', 0)
+    generation = getattr(worker, '_state_generation', 0) + 1
+    dirty_attrs = worker._dirty_attrs
+    saved_sizes = getattr(worker, '_state_sizes', {})
+
+    if storage.durable is None:
+        durable = False
+    elif durable is None:
+        durable = now - durable_at >= config.DURABLE_CHECKPOINT_INTERVAL
+
+    entries = _get_state_entries(worker)
+
+    index = {}
+    sizes = {}
+    for attr, value, changed in entries:
+        saved_entry = saved_index.get(attr)
+        needs_durable = durable and (not saved_entry or durable_entries.get(attr) != saved_entry[2:])
+        if saved_entry:
+            expires_at = saved_entry[1]
+            if expires_at < now + lifetime:
+                saved_entry = None  # would expire before the state is restored
+            elif not changed and not needs_durable:
+                index[attr] = saved_entry
+                sizes[attr] = saved_sizes.get(attr, 0)
+                continue
+
+        try:
+            payload = codec.encode(value)
+        except data.DataError, e:
+            logging.error("[gae-workers] Error while saving %s of worker '%s' (ID=%s): %s",
+                          attr, worker._name, worker._id, e)
+            return None
+
+        digest = hashlib.md5(payload).digest()
+        if saved_entry and saved_entry[0] == digest:
+            index[attr] = saved_entry
+            sizes[attr] = saved_sizes.get(attr, len(payload))
+            if needs_durable:
+                for i, chunk in enumerate(_split_payload(payload)):
+                    checkpoint.to_write_durable[_chunk_key(worker, attr, saved_entry[2], i)] = chunk
+            continue
+
+        chunks = _split_payload(payload)
+        for i, chunk in enumerate(chunks):
+            checkpoint.to_write[_chunk_key(worker, attr, generation, i)] = chunk
+        index[attr] = (digest, now + chunks_lifetime, generation, len(chunks))
+        sizes[attr] = sum(map(len, chunks))
+
+    new_durable_entries = durable_entries
+    if durable:
+        durable_at = now
+        new_durable_entries = dict((attr, entry[2:]) for attr, entry in index.iteritems())
+        checkpoint.superseded_durable_keys = [
+            key for attr, (gen, chunks_count) in durable_entries.iteritems()
+            if new_durable_entries.get(attr) != (gen, chunks_count)
+            for key in _entry_keys(worker, attr, (None, None, gen, chunks_count))]
+
+    # chunks of values replaced by this checkpoint are deleted once its index is written,
+    # unless the durable copy of the state still refers to them
+    checkpoint.superseded_keys = [
+        key for attr, old_entry in saved_index.iteritems()
+        if attr in index and index[attr][2:] != old_entry[2:] and new_durable_entries.get(attr) != old_entry[2:]
+        for key in _entry_keys(worker, attr, old_entry)]
+
+    runner_data = getattr(worker, '_runner_data', {})
+    checkpoint.index_key = _STATE_INDEX_KEY % {'id': worker._id}
+    checkpoint.index_payload = codec.encode((_STATE_FORMAT_VERSION, generation, index,
+                                             new_durable_entries, durable_at, runner_data))
+    checkpoint.durable = durable
+    checkpoint.index = index
+    checkpoint.durable_entries = new_durable_entries
+    checkpoint.durable_at = durable_at
+    checkpoint.generation = generation
+    checkpoint.sizes = sizes
+    # attributes changed from now on (e.g. while checkpoint is written asynchronously) are saved next time
+    checkpoint.dirty_attrs = set(dirty_attrs)
+    dirty_attrs.clear()
+    worker._serialization_time = getattr(worker, '_serialization_time', 0.0) + time() - start_time
+    return checkpoint
+
+def _get_state_entries(worker):
+    '''
+    Lists the entries of worker's state, each of which is stored under its own keys.
+    @return: List of triples: (entry name, value, whether it may have changed since last checkpoint)
+    @raise data.DataError: If value of declared field doesn't match its type
+    '''
+    dirty_attrs = worker._dirty_attrs
+    check_mutations = worker.track_mutations
+    state = worker._get_state_dict()
+    schema = _get_schema(worker.__class__)
+    if schema:
+        schema.check(state)
+        attrs = schema.entry_fields
+    else:
+        attrs = state.iterkeys()
+
+    entries = [(attr, state[attr],
+                attr in dirty_attrs or (check_mutations and type(state[attr]) not in _IMMUTABLE_TYPES))
+               for attr in attrs]
+    if schema and schema.record_fields:
+        record = tuple(state[attr] for attr in schema.record_fields)
+        entries.append((_RECORD_ENTRY, record, any(attr in dirty_attrs for attr in schema.record_fields)))
+    return entries
+
+
+def restore_state(worker):
+    '''
+    Loads the worker's state if it was saved previously.
+    If the latest checkpoint cannot be restored (e.g. because memcache has evicted
+    some of it), the one from durable storage tier is tried.
+    @param worker: Worker object whose state is to be restored
+    @return: Whether the state has been found and restored
+    '''
+    return restore_states([worker])[0]
+
+def restore_states(workers):
+    '''
+    Loads the state of many workers at once, with single read from storage
+    for their state indexes and another one for their attributes.
+    @param workers: List of worker objects whose state is to be restored
+    @return: List of flags telling whether respective workers' states have been restored
+    '''
+    storage = get_storage()
+    index_keys = [_STATE_INDEX_KEY % {'id': worker._id} for worker in workers]
+    index_payloads = storage.get_multi(index_keys)
+
+    saved_indexes = {}  # worker -> decoded index
+    states = {}         # worker -> state dictionary
+    for worker, index_key in zip(workers, index_keys):
+        index_payload = index_payloads.get(index_key)
+        if index_payload is None:
+            continue
+        if isinstance(index_payload, dict):
+            states[worker] = _restore_legacy_state(index_payload)
+            saved_indexes[worker] = (_STATE_FORMAT_VERSION, 0, {}, {}, 0, {})
+        else:
+            saved_index = _decode_index(worker, index_payload)
+            if saved_index:
+                saved_indexes[worker] = saved_index
+
+    fetched_states = _fetch_attributes(dict((worker, saved_index[2])
+                                            for worker, saved_index in saved_indexes.iteritems()
+                                            if worker not in states))
+    states.update(fetched_states)
+
+    restored = []
+    for worker, index_key in zip(workers, index_keys):
+        state = states.get(worker)
+        saved_index = saved_indexes.get(worker)
+        index_payload = index_payloads.get(index_key)
+        if state is None and index_payload is not None and storage.durable is not None:
+            durable_index_payload = storage.durable.get(index_key)
+            if durable_index_payload is not None and durable_index_payload != index_payload:
+                logging.warning("[gae-workers] Restoring worker '%s' (ID=%s) from last durable checkpoint",
+                                worker._name, worker._id)
+                saved_index = _decode_index(worker, durable_index_payload)
+                if saved_index:
+                    state = _fetch_attributes({worker: saved_index[2]}).get(worker)
+        if state is not None:
+            try:
+                state = _unpack_state(worker, state)
+            except data.DataError, e:
+                logging.error("[gae-workers] Invalid state of worker '%s' (ID=%s): %s", worker._name, worker._id, e)
+                state = None
+        if state is None:
+            restored.append(False)
+            continue
+
+        for attr, value in state.iteritems():
+            setattr(worker, attr, value)
+        _, worker._state_generation, worker._state_index, \
+            worker._state_durable_entries, worker._state_durable_at, worker._runner_data = saved_index
+        worker._dirty_attrs.clear()
+        restored.append(True)
+    return restored
+
+def _unpack_state(worker, state):
+    '''
+    Converts restored state entries into worker's attributes, unpacking the record
+    of declared fields (see Worker.state_fields) and leaving out undeclared attributes.
+    @return: State dictionary
+    @raise data.DataError: If the state doesn't match worker's schema
+    '''
+    schema = _get_schema(worker.__class__)
+    record = state.pop(_RECORD_ENTRY, None)
+    if not schema:
+        if record is not None:
+            raise data.DataError("State has record of fields, but worker's class doesn't declare any")
+        return state
+
+    if record is not None:
+        if len(record) > len(schema.record_fields):
+            raise data.DataError("State has %s fields in record, but only %s are declared"
+                                 % (len(record), len(schema.record_fields)))
+        state.update(zip(schema.record_fields, record))   # fields added since are missing from the record
+    state = dict((attr, value) for attr, value in state.iteritems() if attr in schema.types)
+    schema.check(state)
+    return state
+
+def get_generations(workers):
+    '''
+    Checks which checkpoints of workers are the latest ones saved,
+    reading only their state indexes.
+    @return: List of generation numbers of respective workers' checkpoints
+             (0 for state in legacy format), or None where there is no saved state
+    '''
+    index_keys = [_STATE_INDEX_KEY % {'id': worker._id} for worker in workers]
+    index_payloads = get_storage().get_multi(index_keys)
+
+    generations = []
+    for worker, index_key in zip(workers, index_keys):
+        index_payload = index_payloads.get(index_key)
+        if index_payload is None:
+            generations.append(None)
+        elif isinstance(index_payload, dict):
+            generations.append(0)
+        else:
+            saved_index = _decode_index(worker, index_payload)
+            generations.append(saved_index[1] if saved_index else None)
+    return generations
+
+
+def clear_state(worker):
+    '''
+    Deletes the saved state of worker, including its durable copy.
+    @param worker: Worker object whose state is to be deleted
+    '''
+    keys = set([_STATE_INDEX_KEY % {'id': worker._id}])
+    for attr, entry in getattr(worker, '_state_index', {}).iteritems():
+        keys.update(_entry_keys(worker, attr, entry))
+    for attr, (gen, chunks_count) in getattr(worker, '_state_durable_entries', {}).iteritems():
+        keys.update(_entry_keys(worker, attr, (None, None, gen, chunks_count)))
+    get_storage().delete_multi(list(keys), durable = True)
+
+
+def _decode_index(worker, index_payload):
+    '''
+    Decodes the state index.
+    @return: Tuple (version, generation, entries, durable_entries, durable_at, runner_data),
+             or None if it's invalid
+    '''
+    try:
+        saved_index = codec.decode(index_payload)
+    except data.DataError, e:
+        logging.error("[gae-workers] Invalid state index of worker '%s' (ID=%s): %s",
+                      worker._name, worker._id, e)
+        return None
+
+    if saved_index[0] != _STATE_FORMAT_VERSION:
+        logging.error("[gae-workers] Unsupported state format (%s) of worker '%s' (ID=%s)",
+                      saved_index[0], worker._name, worker._id)
+        return None
+    return saved_index
+
+
+class _Schema(object):
+    '''
+    Declared schema of worker's state (see Worker.state_fields).
+    '''
+    def __init__(self, fields):
+        self.types = {}
+        self.record_fields = []     # fields of immutable types, in declared order
+        self.entry_fields = []      # fields stored under their own keys
+        for attr, types in fields:
+            if attr.startswith('_'):
+                raise data.DataError("State field cannot be private: %s" % attr)
+            types = tuple(types) if isinstance(types, (tuple, list)) else (types,)
+            if float in types:
+                types += (int, long)    # e.g. float field holding a whole number
+            elif int in types:
+                types += (long,)    # ints overflow to longs silently
+            self.types[attr] = types
+            if _IMMUTABLE_TYPES.issuperset(types):
+                self.record_fields.append(attr)
+            else:
+                self.entry_fields.append(attr)
+
+    def check(self, state):
+        '''
+        Checks whether values of state's attributes (other than None) match their declared types.
+        @raise data.DataError: If they don't
+        '''
+        for attr, value in state.iteritems():
+            if value is not None and not isinstance(value, self.types[attr]):
+                raise data.DataError("Value of %s is of type %s, not %s" % (attr, type(value).__name__,
+                                     " or ".join(type_.__name__ for type_ in self.types[attr])))
+
+_schemas = {}   # worker class -> _Schema, or None if the class doesn't declare one
+
+def _get_schema(worker_class):
+    ''' Retrieves declared schema of state of workers of given class (see _Schema), if there is one. '''
+    try:
+        return _schemas[worker_class]
+    except KeyError:
+        fields = worker_class.state_fields
+        return _schemas.setdefault(worker_class, _Schema(fields) if fields is not None else None)
+
+
+def _split_payload(payload):
+    '''
+    Prepares attribute's payload for storing, compressing it if it's big enough
+    and splitting into chunks which fit in memcache.
+    @return: List of chunks
+    '''
+    if len(payload) >= config.STATE_COMPRESSION_THRESHOLD:
+        compressed = _COMPRESSED_PREFIX + zlib.compress(payload, config.STATE_COMPRESSION_LEVEL)
+        if len(compressed) < len(payload):
+            payload = compressed
+
+    chunk_size = config.MEMCACHE_CHUNK_SIZE
+    return [payload[i:i + chunk_size] for i in xrange(0, len(payload), chunk_size)] or ['']
+
+def _join_payload(chunks):
+    ''' Reverses the transformation done by _split_payload(). '''
+    payload = ''.join(chunks)
+    if payload.startswith(_COMPRESSED_PREFIX):
+        payload = zlib.decompress(buffer(payload, len(_COMPRESSED_PREFIX)))
+    return payload
+
+
+def _chunk_key(worker, attr, generation, chunk):
+    return _STATE_CHUNK_KEY % {'id': worker._id, 'attr': attr,
+                                        'generation': generation, 'chunk': chunk}
+
+def _entry_keys(worker, attr, entry):
+    ''' Lists memcache keys of all chunks of attribute described by given index entry. '''
+    _, _, generation, chunks_count = entry
+    return [_chunk_key(worker, attr, generation, i) for i in xrange(chunks_count)]
+
+
+def _fetch_attributes(indexes):
+    '''
+    Fetches values of all attributes listed in state indexes of workers.
+    @param indexes: Dictionary mapping workers to their state index entries
+    @return: Dictionary mapping workers to their state dictionaries.
+             Workers whose state is incomplete or corrupt are missing from it.
+    '''
+    entry_keys = dict((worker, dict((attr, _entry_keys(worker, attr, entry))
+                                    for attr, entry in index.iteritems()))
+                      for worker, index in indexes.iteritems())
+    all_keys = [key for worker_keys in entry_keys.itervalues()
+                for keys in worker_keys.itervalues() for key in keys]
+    chunks = get_storage().get_multi(all_keys) if all_keys else {}
+
+    states = {}
+    for worker, worker_keys in entry_keys.iteritems():
+        state = _decode_attributes(worker, indexes[worker], worker_keys, chunks)
+        if state is not None:
+            states[worker] = state
+    return states
+
+def _decode_attributes(worker, index, entry_keys, chunks):
+    '''
+    Decodes values of worker's attributes from fetched chunks.
+    @return: State dictionary, or None if the state is incomplete or corrupt
+    '''
+    missing = sorted(attr for attr, keys in entry_keys.iteritems()
+                     if any(key not in chunks for key in keys))
+    if missing:
+        logging.error("[gae-workers] State of worker '%s' (ID=%s) is incomplete, missing: %s",
+                      worker._name, worker._id, ", ".join(missing))
+        return None
+
+    start_time = time()
+    state = {}
+    sizes = {}
+    for attr, keys in entry_keys.iteritems():
+        try:
+            attr_chunks = [chunks[key] for key in keys]
+            payload = _join_payload(attr_chunks)
+            if hashlib.md5(payload).digest() != index[attr][0]:
+                raise data.DataError("Digest mismatch")
+            state[attr] = codec.decode(payload)
+            sizes[attr] = sum(map(len, attr_chunks))
+        except (data.DataError, zlib.error), e:
+            logging.error("[gae-workers] Error while restoring %s of worker '%s' (ID=%s): %s",
+                          attr, worker._name, worker._id, e)
+            return None
+
+    worker._state_sizes = sizes
+    worker._serialization_time = getattr(worker, '_serialization_time', 0.0) + time() - start_time
+    return state
+
+def _restore_legacy_state(state):
+    '''
+    Restores state saved by older versions of gae-workers, which stored
+    dictionary of values saved separately with data.save_value().
+    '''
+    restored_state = {}
+    for attr, value in state.iteritems():
+        try:
+            restored_state[attr] = data.restore_value(value)
+        except data.DataError, e:
+            logging.error("[gae-workers] Error while restoring %s: %s", attr, e)
+    return restored_state
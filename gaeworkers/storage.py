@@ -0,0 +1,263 @@
+'''
+Key-value storages used for persisting worker's state.
+
+By default, state is kept in memcache, with datastore serving
+as a durable tier which survives memcache evictions.
+Other storages (e.g. in-process DictStorage) can be installed
+with set_storage(), which is mostly useful for testing.
+
+Created on 2011-11-27
+
+@author: xion
+'''
+from gaeworkers import config
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from time import time
+import logging
+
+
+class Storage(object):
+    '''
+    Base class for storages. Keys and values are (binary) strings.
+    '''
+    durable = None  # durable tier, if the storage has one
+
+    def get_multi(self, keys):
+        '''
+        Retrieves values of given keys.
+        @return: Dictionary with found keys and their values
+        '''
+        raise NotImplementedError()
+
+    def set_multi(self, mapping, lifetime = 0, durable = False):
+        '''
+        Stores values of given keys.
+        @param mapping: Dictionary of keys and values
+        @param lifetime: How long (in seconds) the values shall be kept; 0 means no limit.
+                         Storages may keep values for longer.
+        @param durable: Whether values shall be written to durable tier too,
+                        if the storage has one
+        @return: List of keys that could not be stored
+        '''
+        raise NotImplementedError()
+
+    def set_multi_async(self, mapping, lifetime = 0, durable = False):
+        '''
+        Starts storing values of given keys (see set_multi()).
+        Storages which cannot do it asynchronously store them right away.
+        @return: Object whose get_result() method waits until the values are stored
+                 and returns the list of keys that could not be stored
+        '''
+        return _Result(self.set_multi(mapping, lifetime, durable))
+
+    def delete_multi(self, keys, durable = False):
+        ''' Deletes values of given keys (from durable tier too, if requested). '''
+        raise NotImplementedError()
+
+    def get(self, key):
+        ''' Retrieves value of given key, or None if it's not found. '''
+        return self.get_multi([key]).get(key)
+
+    def set(self, key, value, lifetime = 0, durable = False):
+        ''' Stores value of given key. @return: Whether it succeeded '''
+        return not self.set_multi({key: value}, lifetime, durable)
+
+
+class MemcacheStorage(Storage):
+    '''
+    Storage keeping values in memcache, in gae-workers' namespace.
+    '''
+    def get_multi(self, keys):
+        return memcache.get_multi(keys, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+
+    def set_multi(self, mapping, lifetime = 0, durable = False):
+        return memcache.set_multi(mapping, lifetime, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+
+    def set_multi_async(self, mapping, lifetime = 0, durable = False):
+        rpc = memcache.Client().set_multi_async(mapping, time = lifetime, #@UndefinedVariable
+                                                namespace = config.MEMCACHE_NAMESPACE)
+        return _MemcacheSetResult(rpc, mapping.keys())
+
+    def delete_multi(self, keys, durable = False):
+        memcache.delete_multi(keys, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
+
+
+class _MemcacheSetResult(object):
+    ''' Result of asynchronous memcache write, converting statuses of keys into list of failed ones. '''
+    def __init__(self, rpc, keys):
+        self.rpc = rpc
+        self.keys = keys
+
+    def get_result(self):
+        statuses = self.rpc.get_result()
+        if statuses is None:    # network error
+            return list(self.keys)
+        return [key for key in self.keys if statuses.get(key) != memcache.STORED] #@UndefinedVariable
+
+
+class _Result(object):
+    ''' Result of storage operation which has already completed. '''
+    def __init__(self, result):
+        self.result = result
+
+    def get_result(self):
+        return self.result
+
+
+class _StateEntity(db.Model):
+    ''' Datastore entity holding single value stored in DatastoreStorage. '''
+    value = db.BlobProperty()
+
+    @classmethod
+    def kind(cls):
+        return config.DATASTORE_STATE_KIND
+
+
+class DatastoreStorage(Storage):
+    '''
+    Storage keeping values in datastore, as entities keyed by storage keys.
+    Values are kept until deleted, regardless of lifetime.
+    Writes are split into batches which are issued concurrently.
+    '''
+    MAX_BATCH_ENTITIES = 500
+    MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+    def get_multi(self, keys):
+        db_keys = [db.Key.from_path(_StateEntity.kind(), key) for key in keys]
+        entities = db.get(db_keys)
+        return dict((key, entity.value)
+                    for key, entity in zip(keys, entities) if entity is not None)
+
+    def set_multi(self, mapping, lifetime = 0, durable = False):
+        rpcs = [(db.put_async(batch), batch) for batch in self._make_batches(mapping)]
+
+        failed_keys = []
+        for rpc, batch in rpcs:
+            try:
+                rpc.get_result()
+            except db.Error, e:
+                logging.error("[gae-workers] Failed to store %s value(s) in datastore: %s", len(batch), e)
+                failed_keys.extend(entity.key().name() for entity in batch)
+        return failed_keys
+
+    def delete_multi(self, keys, durable = False):
+        db.delete([db.Key.from_path(_StateEntity.kind(), key) for key in keys])
+
+    def _make_batches(self, mapping):
+        ''' Splits the values into batches of entities which fit in single datastore RPC. '''
+        batch, batch_bytes = [], 0
+        for key, value in mapping.iteritems():
+            value_bytes = len(value)
+            if batch and (len(batch) == self.MAX_BATCH_ENTITIES
+                          or batch_bytes + value_bytes > self.MAX_BATCH_BYTES):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(_StateEntity(key_name = key, value = db.Blob(value)))
+            batch_bytes += value_bytes
+        if batch:
+            yield batch
+
+
+class DictStorage(Storage):
+    '''
+    In-process storage keeping values in a dictionary.
+    Intended for tests and local simulations, as a stand-in for both
+    memcache and datastore (with keep_forever = True).
+    '''
+    def __init__(self, keep_forever = False):
+        self.values = {}    # key -> (value, expiration time or None)
+        self.keep_forever = keep_forever
+
+    def get_multi(self, keys):
+        now = time()
+        result = {}
+        for key in keys:
+            item = self.values.get(key)
+            if item is None:    continue
+            value, expires_at = item
+            if expires_at is not None and expires_at <= now:
+                del self.values[key]
+                continue
+            result[key] = value
+        return result
+
+    def set_multi(self, mapping, lifetime = 0, durable = False):
+        expires_at = time() + lifetime if lifetime and not self.keep_forever else None
+        for key, value in mapping.iteritems():
+            self.values[key] = (value, expires_at)
+        return []
+
+    def delete_multi(self, keys, durable = False):
+        for key in keys:
+            self.values.pop(key, None)
+
+
+class TieredStorage(Storage):
+    '''
+    Storage combining fast cache (e.g. memcache) with durable tier (e.g. datastore).
+    Reads are served from cache, falling back to the durable tier for missing keys
+    (which are then put back into cache). Writes go to cache only, unless
+    durable tier is requested explicitly, so that callers can decide
+    how often they need to pay for durability.
+    '''
+    def __init__(self, cache, durable):
+        self.cache = cache
+        self.durable = durable
+
+    def get_multi(self, keys):
+        result = self.cache.get_multi(keys)
+        if len(result) < len(keys):
+            missing_keys = [key for key in keys if key not in result]
+            durable_result = self.durable.get_multi(missing_keys)
+            if durable_result:
+                self.cache.set_multi(durable_result, config.MEMCACHE_DATA_LIFETIME)
+                result.update(durable_result)
+        return result
+
+    def set_multi(self, mapping, lifetime = 0, durable = False):
+        failed_keys = self.cache.set_multi(mapping, lifetime)
+        if not durable:
+            return failed_keys
+        
+        # stale cached values would shadow the durable ones
+        if failed_keys:
+            self.cache.delete_multi(failed_keys)
+        return self.durable.set_multi(mapping, lifetime)
+
+    def set_multi_async(self, mapping, lifetime = 0, durable = False):
+        if durable:
+            return Storage.set_multi_async(self, mapping, lifetime, durable)
+        return self.cache.set_multi_async(mapping, lifetime)
+
+    def delete_multi(self, keys, durable = False):
+        self.cache.delete_multi(keys)
+        if durable:
+            self.durable.delete_multi(keys)
+
+
+###############################################################################
+# Default storage
+
+_storage = None
+
+def get_storage():
+    '''
+    Retrieves the storage used for worker's state.
+    Unless set_storage() was called, it's memcache, backed with datastore
+    if config.DURABLE_STATE is enabled.
+    '''
+    global _storage
+    if _storage is None:
+        _storage = TieredStorage(MemcacheStorage(), DatastoreStorage()) \
+                   if config.DURABLE_STATE \
+                   else MemcacheStorage()
+    return _storage
+
+def set_storage(storage):
+    '''
+    Sets the storage used for worker's state.
+    @param storage: Storage object, or None to revert to default one
+    '''
+    global _storage
+    _storage = storage
@@ -0,0 +1,94 @@
+'''
+Module for adding workers' tasks to task queues in bulk.
+
+Tasks are added in batches as big as the task queue API allows,
+with several batches in flight at once, which is much faster
+than adding them one by one.
+
+Created on 2011-12-02
+
+@author: xion
+'''
+from google.appengine.api import taskqueue
+import logging
+
+
+# Maximum number of batches being added concurrently.
+MAX_PENDING_BATCHES = 10
+
+
+def add_tasks(queue_name, tasks, raise_errors = False):
+    '''
+    Adds tasks to the queue.
+    @param queue_name: Name of the queue
+    @param tasks: List of Task objects
+    @param raise_errors: Whether failure to add some of the tasks shall be raised
+                         rather than only logged. Named tasks that already exist
+                         (or have already run) count as added then.
+    @return: List of flags telling whether respective tasks have been added
+    @raise taskqueue.Error: If some of the tasks could not be added (with raise_errors)
+    '''
+    queue = taskqueue.Queue(queue_name)
+    batch_size = taskqueue.MAX_TASKS_PER_ADD
+
+    pending = []
+    for i in xrange(0, len(tasks), batch_size):
+        if len(pending) == MAX_PENDING_BATCHES:
+            _finish_batch(queue_name, raise_errors, *pending.pop(0))
+        batch = tasks[i:i + batch_size]
+        pending.append((queue.add_async(batch), batch))
+    for rpc, batch in pending:
+        _finish_batch(queue_name, raise_errors, rpc, batch)
+
+    if raise_errors:
+        return [True] * len(tasks)
+    return [task.was_enqueued for task in tasks]
+
+def add_task(queue_name, task):
+    '''
+    Adds single task to the queue. Named task that already exists
+    (or has already run) counts as added.
+    @raise taskqueue.Error: If the task could not be added
+    '''
+    add_task_async(queue_name, task).get_result()
+
+def add_task_async(queue_name, task):
+    '''
+    Starts adding single task to the queue.
+    @return: Object whose get_result() method waits until the task is added
+             (see _PendingAdd.get_result())
+    '''
+    return _PendingAdd(queue_name, task, taskqueue.Queue(queue_name).add_async([task]))
+
+
+class _PendingAdd(object):
+    ''' Task being added to the queue. '''
+    def __init__(self, queue_name, task, rpc):
+        self.queue_name = queue_name
+        self.task = task
+        self.rpc = rpc
+
+    def get_result(self):
+        '''
+        Waits until the task is added. Named task that already exists
+        (or has already run) counts as added, e.g. when a retried task adds it again.
+        @raise taskqueue.Error: If the task could not be added
+        '''
+        _finish_batch(self.queue_name, True, self.rpc, [self.task])
+
+
+def _finish_batch(queue_name, raise_errors, rpc, batch):
+    '''
+    Waits for the batch to be added, logging the errors.
+    @param raise_errors: Whether errors shall be re-raised, except for rejected duplicates
+    '''
+    try:
+        rpc.get_result()
+    except taskqueue.Error, e:
+        if raise_errors and isinstance(e, (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError)):
+            return  # named tasks have already been added, e.g. by previous attempt of current task
+        # tasks that were added nevertheless are marked as enqueued
+        failed_count = sum(1 for task in batch if not task.was_enqueued)
+        logging.error("[gae-workers] Could not add %s task(s) to queue '%s': %s", failed_count, queue_name, e)
+        if raise_errors:
+            raise
@@ -5,8 +5,9 @@ Created on 2011-08-31
 
 @author: Xion
 '''
-from gaeworkers import config, data
-from google.appengine.api import memcache
+from gaeworkers import config, lanes, query, state, tasks
+from gaeworkers.mailbox import Mailbox
+from gaeworkers.mutations import MutationBuffer
 from google.appengine.api.taskqueue import Task
 import hashlib
 import logging
@@ -25,19 +26,58 @@ class InvalidWorkerState(Exception):
         
 _TASK_HEADERS_PREFIX = 'X-GAEWorkers-'
 _TASK_HEADER_INVOCATION = _TASK_HEADERS_PREFIX + 'Invocation'
-
-_WORKER_MESSAGES_MEMCACHE_KEY = "worker://%(id)s/messages"
+_TASK_HEADER_WAKEUP = _TASK_HEADERS_PREFIX + 'Wakeup'
+_TASK_HEADER_STATE = _TASK_HEADERS_PREFIX + 'State'
+_TASK_HEADER_PRIORITY = _TASK_HEADERS_PREFIX + 'Priority'
 
 class Worker(object):
     '''
     Base class for worker objects.
     '''
-    queue_name = config.QUEUE_NAME
+    # Priority of the worker: name of its lane in config.PRIORITY_LANES, whose queue
+    # worker's tasks go to (config.DEFAULT_PRIORITY if None). It can be set for the class
+    # or for worker object before it's started; worker keeps it in subsequent tasks.
+    priority = None
+    
+    # Number of handoffs to next task after which worker is demoted to the next lower
+    # priority lane; config.DEMOTE_AFTER is used if None.
+    demote_after = None
+    
+    # Name of task queue for worker's tasks, bypassing priority lanes if set.
+    queue_name = None
+    
+    # Whether attributes holding mutable objects (lists, dicts, etc.) shall be
+    # checked for in-place changes on every checkpoint. If disabled, only the
+    # assignments and mark_dirty() calls cause an attribute to be saved again,
+    # which saves re-serializing big, rarely changing structures.
+    track_mutations = True
+    
+    # Declared schema of worker's state: sequence of (attribute, type) pairs, where type
+    # can also be a tuple of types. If set, only these attributes are saved (others
+    # are transient), and attributes of immutable types (int, str, etc.) are stored
+    # together in a compact record, by position. Their values are checked against
+    # the types on every checkpoint (float fields accept ints as well), and the task
+    # fails if they don't match. Fields can be added at the end of the schema
+    # while workers are running, but not removed or reordered.
+    state_fields = None
+    
+    # Name of deadline estimator (see estimator.py) predicting the duration
+    # of run()'s spins for this worker; config.DEADLINE_ESTIMATOR is used if None.
+    deadline_estimator = None
+    
+    # Part of the work assigned to child worker by its parent's FORK call;
+    # None for workers that weren't forked.
+    shard = None
     
     # API "calls" available to workers
     SLEEP = staticmethod(lambda secs: ("sleep", (secs,)))
-    FORK = staticmethod(lambda: ("fork", ()))
+    FORK = staticmethod(lambda shards: ("fork", (shards,)))
+    JOIN = staticmethod(lambda result = None: ("join", (result,)))
     GET_MESSAGES = staticmethod(lambda: ("get_messages", ()))
+    WAIT_MESSAGES = staticmethod(lambda: ("wait_messages", ()))
+    TIME_LEFT = staticmethod(lambda: ("time_left", ()))
+    PUBLISH_RESULT = staticmethod(lambda request_id, result: ("publish_result", (request_id, result)))
+    THROTTLE = staticmethod(lambda resource, tokens = 1, park = True: ("throttle", (resource, tokens, park)))
     
     def __init__(self, worker_name = None, worker_id = None):
         '''
@@ -46,33 +86,103 @@ class Worker(object):
         '''
         self._name = worker_name
         self._id = worker_id
+        self._runner_data = {}
         
-    def _create_task(self, invocation = 1, eta = None):
+    def __setattr__(self, attr, value):
+        ''' Tracks the changes of worker's state attributes. '''
+        if not attr.startswith('_'):
+            self._dirty_attrs.add(attr)
+        object.__setattr__(self, attr, value)
+        
+    @property
+    def _dirty_attrs(self):
+        ''' Set of state attributes that have changed since last checkpoint. '''
+        try:                return self.__dict__['_dirty_attrs_set']
+        except KeyError:    return self.__dict__.setdefault('_dirty_attrs_set', set())
+        
+    @property
+    def mutations(self):
+        '''
+        Buffer of datastore mutations (MutationBuffer), written in batches.
+        Worker shall use its put() and delete() instead of writing entities
+        one by one. Buffered mutations are written before worker's state is saved.
+        '''
+        try:                return self.__dict__['_mutations']
+        except KeyError:    return self.__dict__.setdefault('_mutations', MutationBuffer())
+        
+    def mark_dirty(self, *attrs):
+        '''
+        Marks given attributes as changed, so that they are saved on next checkpoint.
+        This is only needed for objects modified in place when track_mutations is disabled.
+        '''
+        self._dirty_attrs.update(attrs)
+        
+    def iterate_query(self, query_obj, cursor_attr = 'query_cursor', batch_size = None):
+        '''
+        Iterates over results of datastore query, continuing after the last
+        returned entity when run() is invoked again in next task.
+        The position is kept in worker's state as datastore cursor.
+        See query.iterate() for description of parameters.
+        '''
+        return query.iterate(self, query_obj, cursor_attr, batch_size)
+    
+    def prefetch_query(self, query_obj, cursor_attr = 'query_cursor', batch_size = None, depth = None):
+        '''
+        Iterates over entities matching keys-only datastore query, like iterate_query(),
+        but fetches next batches of entities while the worker processes the current one.
+        See query.prefetch() for description of parameters.
+        '''
+        return query.prefetch(self, query_obj, cursor_attr, batch_size, depth)
+        
+    def _create_task(self, invocation = 1, eta = None, name = None, state_generation = None, priority = None):
         '''
         Creates a Task object for this worker.
         This method is used internally by the gae-workers library.
         @param invocation: Invocation count for this worker, passed as header
         @param eta: ETA (earliest execution time) for the task
+        @param name: Name of the task; by default, it's worker's name or ID
+                     followed by invocation count (see _get_task_params())
+        @param state_generation: Generation of worker's state the task shall restore, if known
+        @param priority: Priority of the task, passed as header (see lanes.py)
         '''
-        # construct URL for the worker task
-        qs_args = {}
-        qs_args['class'] = "%s.%s" % (self.__class__.__module__, self.__class__.__name__)
-        qs_args['id'] = self._id
-        task_qs = urllib.urlencode(qs_args)
-        task_url = "%s?%s" % (config.WORKER_URL, task_qs)
-        
+        return Task(eta = eta, **self._get_task_params(invocation, name, state_generation = state_generation,
+                                                       priority = priority))
+    
+    def _get_task_params(self, invocation = 1, name = None, wakeup = False, state_generation = None,
+                         priority = None):
+        '''
+        Prepares parameters of Task object for this worker.
+        This method is used internally by the gae-workers library.
+        @param invocation: Invocation count for this worker, passed as header
+        @param name: Name of the task; by default, it's worker's name or ID followed
+                     by invocation count, so that task queue rejects duplicates of the task
+                     while allowing the next invocation
+        @param wakeup: Whether the task wakes up worker waiting for messages
+        @param state_generation: Generation of worker's state the task shall restore, if known
+        @param priority: Priority of the task, passed as header (see lanes.py)
+        @return: Dictionary of keyword arguments for Task constructor
+        '''
+        task_url = _get_task_url(self.__class__, id = self._id)
         headers = {
                    _TASK_HEADER_INVOCATION: invocation,
                    }
-        return Task(name = self._name or self._id,
-                    url = task_url, method = 'GET', headers = headers,
-                    eta = eta)
+        if wakeup:
+            headers[_TASK_HEADER_WAKEUP] = '1'
+        if state_generation:
+            headers[_TASK_HEADER_STATE] = str(state_generation)
+        if priority:
+            headers[_TASK_HEADER_PRIORITY] = priority
+        return dict(name = name or "%s-%s" % (self._name or self._id, invocation),
+                    url = task_url, method = 'GET', headers = headers)
         
     def _get_state_dict(self):
         '''
-        Retrieves the dictionary of worker attributes that consist of its state.
+        Retrieves the dictionary of worker attributes that consist of its state:
+        fields declared in state_fields or, if there are none, all public attributes.
         @return: Worker's state dictionary
         '''
+        if self.state_fields is not None:
+            return dict((attr, getattr(self, attr, None)) for attr, _ in self.state_fields)
         return dict((attr, value)
                     for attr, value in self.__dict__.iteritems()
                     if not attr.startswith('_'))
@@ -97,39 +207,145 @@ class Worker(object):
     def start(self):
         '''
         Starts the worker by queuing a task that will commence its execution.
+        The task goes to the queue of worker's priority lane (see config.PRIORITY_LANES).
+        Worker's initial state is saved first, so that tasks which find no state
+        can tell that the worker has finished.
+        @return: Whether the worker has been started; False if its state could not be saved
+        @raise ValueError: If worker's priority is unknown
         '''
         if getattr(self, '_id', None):
             raise InvalidWorkerState('Worker is already running')
+        priority, queue_name = lanes.get_lane(self)
         self._id = _generate_worker_id()
+        if not _save_initial_states([self])[0]:
+            self._id = None
+            return False
         
-        task = self._create_task()
-        task.add(self.queue_name or config.QUEUE_NAME)
+        task = self._create_task(priority = priority)
+        try:
+            task.add(queue_name)
+        except:
+            state.clear_state(self)
+            self._id = None
+            raise
+        return True
+        
+    @classmethod
+    def start_many(cls, workers, multiplex = None):
+        '''
+        Starts many workers at once, queuing their tasks in batches.
+        This is considerably faster than starting them one by one.
+        Workers that could not be started can be passed here again.
+        @param workers: List of worker objects; they can be of different classes
+        @param multiplex: Maximum number of workers (of the same class) run in turns
+                          by single task, up to config.MAX_MULTIPLEXED_WORKERS.
+                          By default, every worker gets its own task. Running many
+                          workers in one task pays off if they are short-lived.
+        @return: List of flags telling whether respective workers have been started
+        @raise ValueError: If priority of some worker is unknown
+        '''
+        workers = list(workers)
+        if any(getattr(worker, '_id', None) for worker in workers):
+            raise InvalidWorkerState('Worker is already running')
+        multiplex = min(multiplex or 1, config.MAX_MULTIPLEXED_WORKERS)
+        worker_lanes = [lanes.get_lane(worker) for worker in workers]
+        
+        for worker in workers:
+            worker._id = _generate_worker_id()
+        saved = _save_initial_states(workers)
+        
+        groups = {}     # (priority, queue name, class) -> list of worker indices
+        for i, (worker, lane) in enumerate(zip(workers, worker_lanes)):
+            if not saved[i]:
+                continue
+            group_class = worker.__class__ if multiplex > 1 else None
+            groups.setdefault(lane + (group_class,), []).append(i)
+        
+        started = [False] * len(workers)
+        for (priority, queue_name, _), indices in groups.iteritems():
+            batches = [indices[j:j + multiplex] for j in xrange(0, len(indices), multiplex)]
+            queue_tasks = [workers[batch[0]]._create_task(priority = priority) if len(batch) == 1
+                           else _create_multiplexed_task([workers[i] for i in batch], priority = priority)
+                           for batch in batches]
+            for batch, was_added in zip(batches, tasks.add_tasks(queue_name, queue_tasks)):
+                for i in batch:
+                    started[i] = was_added
+        
+        for worker, was_saved, was_started in zip(workers, saved, started):
+            if not was_started:
+                if was_saved:
+                    state.clear_state(worker)
+                worker._id = None
+        return started
         
-    
     def post_message(self, msg):
         '''
         Posts a message to worker of given ID. Worker will receive it
-        the when calling Worker.GET_MESSAGES routine.
+        the when calling Worker.GET_MESSAGES or Worker.WAIT_MESSAGES routine.
+        If the worker is waiting for messages, it is woken up.
         @param msg: Message to pass to worker. This can be any object,
                     although simple Python types are recommended.
         @return: Whether the message was posted (this doesn't mean it was processed!)
         '''
+        return self.post_messages([msg])
+    
+    def post_messages(self, msgs):
+        '''
+        Posts several messages to worker of given ID at once.
+        This is considerably faster than posting them one by one.
+        @param msgs: List of messages
+        @return: Whether the messages were posted
+        '''
         worker_id = getattr(self, '_id', None)
         if not worker_id:
             raise InvalidWorkerState('Worker object has not been initialized')
         
-        mc_key = _WORKER_MESSAGES_MEMCACHE_KEY % {'id':worker_id}
-        msg_queue = memcache.get(mc_key, namespace = config.MEMCACHE_NAMESPACE) #@UndefinedVariable
-        msg_queue = msg_queue or []
-        
-        msg_queue.append(data.save_value(msg))
-        if not memcache.set(mc_key, messages, namespace = config.MEMCACHE_NAMESPACE): #@UndefinedVariable
-            logging.error("[gae-workers] Could not post message -- possible overflow of message queue")
-            return False
-        
-        return True
+        return Mailbox(worker_id).post_many(msgs)
                 
 
+def _save_initial_states(workers):
+    '''
+    Saves the state of workers being started, for their first task to restore.
+    It's kept for as long as the state of parked workers, since the task may wait long in the queue.
+    @return: List of flags telling whether respective workers' states have been saved
+    '''
+    for worker in workers:
+        worker._runner_data['setup_pending'] = True     # see WorkerHandler.restore_workers_state()
+    saved = state.save_states(workers, lifetime = config.PARKED_STATE_LIFETIME, durable = True)
+    for worker, was_saved in zip(workers, saved):
+        if not was_saved:
+            logging.error("[gae-workers] Could not save initial state of worker '%s'", worker._name or worker._id)
+    return saved
+
+def _create_multiplexed_task(workers, invocation = 1, eta = None, state_generations = None, priority = None):
+    '''
+    Creates a Task object running several workers of the same class in turns.
+    This method is used internally by the gae-workers library.
+    @param invocation: Invocation count for the workers, passed as header
+    @param eta: ETA (earliest execution time) for the task
+    @param state_generations: Generations of workers' states the task shall restore, if known
+    @param priority: Priority of the task, passed as header (see lanes.py)
+    @note: Task is named after the first worker and invocation count (see Worker._get_task_params()).
+           Every worker is run by one task at a time, so the name is unique.
+    '''
+    task_url = _get_task_url(workers[0].__class__, ids = ",".join(worker._id for worker in workers))
+    headers = {
+               _TASK_HEADER_INVOCATION: invocation,
+               }
+    if state_generations:
+        headers[_TASK_HEADER_STATE] = ",".join(str(generation or 0) for generation in state_generations)
+    if priority:
+        headers[_TASK_HEADER_PRIORITY] = priority
+    return Task(name = "%s-%s" % (workers[0]._id, invocation),
+                url = task_url, method = 'GET', headers = headers, eta = eta)
+
+def _get_task_url(worker_class, **qs_args):
+    ''' Constructs URL of the task running worker(s) of given class. '''
+    qs_args['class'] = "%s.%s" % (worker_class.__module__, worker_class.__name__)
+    task_qs = urllib.urlencode(qs_args)
+    return "%s?%s" % (config.WORKER_URL, task_qs)
+
+
 def _generate_worker_id():
     '''
     Internal method for generating unique IDs for the workers.